@@ -11,9 +11,14 @@ import sys
 import argparse
 import json
 import traceback
+import signal
+import tempfile
+import time
 
 import gevent
 import gevent.monkey; gevent.monkey.patch_all()
+import gevent.pool
+import gevent.lock
 from gevent_zeromq import zmq
 
 # ----------------------------------------------------------------------
@@ -33,7 +38,75 @@ logger.addHandler(ch)
 logger = logging.getLogger(APP_NAME)
 # ----------------------------------------------------------------------
 
+import apsw
 import authauth_model_database
+import authauth_model_codec
+import authauth_model_stats
+import authauth_model_broker
+import authauth_model_group_commit
+import authauth_model_executor
+import authauth_model_hash_ring
+import authauth_model_sharding
+import authauth_model_replica
+import authauth_model_index
+import authauth_model_roles
+import authauth_view_utilities
+from authauth_model_broker import PPP_READY, PPP_HEARTBEAT
+
+# Counters and latency histograms for this process, as reported by the
+# 'stats' message. With --workers each worker keeps its own.
+stats = authauth_model_stats.Stats()
+
+# With --group_commit_window, the authauth_model_group_commit.GroupCommitter
+# that add_user requests go through.
+group_committer = None
+
+# With --replica_of, the authauth_model_replica.Replica we serve lookups
+# from.
+replica = None
+
+# (database, filepath) for each cache we save when we're told to stop; see
+# open_database().
+cache_dumps = []
+
+# Workers share one database file, so give writers a chance to wait out
+# each other's locks rather than failing with SQLITE_BUSY. In milliseconds.
+WORKER_BUSY_TIMEOUT = 5000
+
+# Longest we wait, in seconds, between attempts to reconnect to a broker
+# that has gone quiet.
+MAX_RECONNECT_INTERVAL = 32.0
+
+# Seconds between bringing the Bloom filter of identities up to date.
+FILTER_REFRESH_INTERVAL = 1.0
+
+# Seconds between checkpointing the write-ahead log, when there is one, and
+# between letting SQLite refresh its query planner statistics.
+CHECKPOINT_INTERVAL = 1.0
+OPTIMIZE_INTERVAL = 3600.0
+
+# Seconds between publishing snapshots for replicas, and between replicas
+# looking for a new one.
+SNAPSHOT_INTERVAL = 10.0
+
+# The change feed: how often we look for new changes to publish, the most
+# we publish, or return for a 'get_changes', at once, how many changes we
+# keep for subscribers catching up, and how often we trim the rest.
+CHANGE_POLL_INTERVAL = 0.1
+CHANGE_BATCH_SIZE = 1000
+CHANGE_LOG_SIZE = 100000
+CHANGE_LOG_TRIM_INTERVAL = 1.0
+
+# Users whose role we remember for authorizing, and seconds between
+# picking up roles changed by other processes.
+ROLE_CACHE_SIZE = 100000
+ROLE_REFRESH_INTERVAL = 1.0
+
+# Lists whose ACLs we keep in memory for 'check_access'.
+ACL_CACHE_SIZE = 10000
+
+# Most users written in one transaction by group commit.
+GROUP_COMMIT_SIZE = 100
 
 class InvalidMessageTypeException(Exception):
     def __init__(self, reason):
@@ -47,57 +120,211 @@ class InvalidMessageFormatException(Exception):
     def __str__(self):
         return repr(self.reason)
 
-valid_message_types = set([ \
-                            "ping",
-                            "get_user",
-                            "add_user",
-                          ])
+class MessageType(object):
+    """ Declares a message type that we accept: the fields every message of
+    this type must carry, the handler that answers it and, for messages
+    about a particular kind of user, the extra fields each 'user_type'
+    needs. An optional validator can check anything the field lists
+    can't express.
+
+    The field lists are compiled into frozensets once, when the message
+    type is registered, so validating a message costs a dict lookup and a
+    set difference however many message and user types there are."""
+    def __init__(self,
+                 name,
+                 handler,
+                 required_fields = (),
+                 user_type_fields = None,
+                 validator = None):
+        self.name = name
+        self.handler = handler
+        self.required_fields = frozenset(required_fields)
+        self.user_type_fields = None
+        if user_type_fields is not None:
+            self.required_fields = self.required_fields.union(["user_type"])
+            self.user_type_fields = dict((user_type, frozenset(fields))
+                                         for (user_type, fields) in user_type_fields.iteritems())
+        self.validator = validator
+
+    def validate(self, message):
+        missing_fields = self.required_fields.difference(message)
+        if missing_fields:
+            raise InvalidMessageFormatException("'%s' message missing '%s' field" % (self.name, sorted(missing_fields)[0]))
+        if self.user_type_fields is not None:
+            user_type = message["user_type"]
+            fields = self.user_type_fields.get(user_type, None)
+            if fields is None:
+                raise InvalidMessageFormatException("'%s' message user type '%s' not supported" % (self.name, user_type))
+            missing_fields = fields.difference(message)
+            if missing_fields:
+                raise InvalidMessageFormatException("'%s' for '%s' user type missing '%s' field" % (self.name, user_type, sorted(missing_fields)[0]))
+        if self.validator is not None:
+            self.validator(self, message)
+
+message_types = {}
+def register_message_type(message_type):
+    message_types[message_type.name] = message_type
+
 def validate_message(message):
+    """ Return the MessageType for this message, or raise an exception if
+    the message isn't valid."""
     if "message_type" not in message:
         raise InvalidMessageFormatException("message_type field not present")
-    message_type = message["message_type"]
-    if message_type not in valid_message_types:
-        raise InvalidMessageTypeException("message_type '%s' not recognised" % (message_type, ))
-    if message_type == "get_user":
-        if "user_type" not in message:
-            raise InvalidMessageFormatException("'get_user' message missing 'user_type' field")
-        user_type = message["user_type"]
-        if user_type == "google":
-            if "email" not in message:
-                raise InvalidMessageFormatException("'get_user' for 'google' user type missing 'email' field")
-    if message_type == "add_user":
-        if "user_type" not in message:
-            raise InvalidMessageFormatException("'get_user' message missing 'user_type' field")
-        user_type = message["user_type"]
-        if user_type == "google":
-            if "email" not in message:
-                raise InvalidMessageFormatException("'get_user' for 'google' user type missing 'email' field")
-
-def handle_server_request(server, database):
-    logger = logging.getLogger("%s.handle_server_request" % (APP_NAME, ))
-    message_encoded = server.recv()
+    message_type = message_types.get(message["message_type"], None)
+    if message_type is None:
+        raise InvalidMessageTypeException("message_type '%s' not recognised" % (message["message_type"], ))
+    message_type.validate(message)
+    return message_type
+
+def validate_users_field(message_type, message):
+    """ Validator for the bulk messages, whose 'users' field is a list of
+    [user_type, external_id] pairs, e.g. ["google", email]. 'add_users'
+    may also carry 'profiles', an object of profile fields per user."""
+    users = message["users"]
+    if not isinstance(users, list):
+        raise InvalidMessageFormatException("'%s' message 'users' field is not a list" % (message_type.name, ))
+    for user in users:
+        if not isinstance(user, list) or len(user) != 2:
+            raise InvalidMessageFormatException("'%s' message 'users' items must be [user_type, external_id] pairs" % (message_type.name, ))
+        if user[0] not in BULK_USER_TYPES:
+            raise InvalidMessageFormatException("'%s' message user type '%s' not supported" % (message_type.name, user[0]))
+    if "profiles" in message:
+        profiles = message["profiles"]
+        if not isinstance(profiles, list) or len(profiles) != len(users) or \
+           not all(isinstance(profile, dict) for profile in profiles):
+            raise InvalidMessageFormatException("'%s' message 'profiles' field must be a profile object per user" % (message_type.name, ))
+
+def validate_get_changes(message_type, message):
+    for (field, minimum) in [("after", 0), ("limit", 1)]:
+        if field not in message:
+            continue
+        value = message[field]
+        if not isinstance(value, (int, long)) or isinstance(value, bool) or value < minimum:
+            raise InvalidMessageFormatException("'%s' message '%s' field must be an integer of at least %s" % (message_type.name, field, minimum))
+
+def validate_role_fields(message_type, message):
+    """ Validator for the authorization messages: IDs are strings, and
+    privileges and actions are privilege names."""
+    for field in ["user_id", "role_id", "role_name", "list_id"]:
+        if field in message and not isinstance(message[field], basestring):
+            raise InvalidMessageFormatException("'%s' message '%s' field is not a string" % (message_type.name, field))
+    if "privilege" in message and not authauth_model_roles.is_privilege_name(message["privilege"]):
+        raise InvalidMessageFormatException("'%s' message 'privilege' field is not a privilege name" % (message_type.name, ))
+    for field in ["privileges", "actions"]:
+        if field not in message:
+            continue
+        names = message[field]
+        if not isinstance(names, list) or not all(authauth_model_roles.is_privilege_name(name) for name in names):
+            raise InvalidMessageFormatException("'%s' message '%s' field is not a list of privilege names" % (message_type.name, field))
+
+def validate_checks_field(message_type, message):
+    """ Validator for 'check_access', whose 'checks' field is a list of
+    [user_id, list_id, action] triples."""
+    checks = message["checks"]
+    if not isinstance(checks, list):
+        raise InvalidMessageFormatException("'%s' message 'checks' field is not a list" % (message_type.name, ))
+    for check in checks:
+        if not isinstance(check, list) or len(check) != 3 or not all(isinstance(value, basestring) for value in check):
+            raise InvalidMessageFormatException("'%s' message 'checks' items must be [user_id, list_id, action] strings" % (message_type.name, ))
+
+class ReplySocket(object):
+    """ Stands in for the server socket while a request is handled.
+    Handlers reply with send() exactly as they would on a REP socket.
+
+    If the request arrived on a ROUTER socket the reply goes back out
+    prefixed with the envelope of the client that sent it. All
+    ReplySockets for a given ROUTER socket share one lock so that the
+    frames of replies sent by concurrent greenlets never interleave.
+
+    We also remember the protocol version the client asked for, so that
+    send_message() encodes the reply the way the client expects, and the
+    request's 'request_id', if any, so that send_message() can echo it.
+    A DEALER client that sets request_id can keep many requests in flight
+    on one socket and match up the replies, which arrive in the order the
+    requests complete rather than the order they were sent."""
+    def __init__(self, socket, envelope = None, lock = None):
+        self.socket = socket
+        self.envelope = envelope
+        self.lock = lock
+        self.version = authauth_model_codec.DEFAULT_VERSION
+        self.request_id = None
+
+    def send(self, data):
+        if self.envelope is None:
+            self.socket.send(data)
+            return
+        with self.lock:
+            self.socket.send_multipart(self.envelope + [data])
+
+def handle_server_request(server, database, pool = None, send_lock = None):
+    """ Receive one request from the server socket and handle it.
+
+    Without a pool the server socket is a REP socket and the request is
+    handled to completion before we return. With a pool the server socket
+    is a ROUTER socket; the request is handed to a greenlet in the pool and
+    we return immediately, or block until the pool has room.
+
+    Frames are received without copying them out of ZeroMQ; the codec
+    decodes straight from the frame's buffer where it can."""
+    if pool is None:
+        frame = server.recv(copy = False)
+        return process_server_request(ReplySocket(server), frame, database)
+    frames = server.recv_multipart(copy = False)
+    envelope = frames[:-1]
+    frame = frames[-1]
+    reply_socket = ReplySocket(server, envelope, send_lock)
+    pool.spawn(process_server_request, reply_socket, frame, database)
+
+def process_server_request(server, frame, database):
+    logger = logging.getLogger("%s.process_server_request" % (APP_NAME, ))
+    start_time = time.time()
     try:
-        message_decoded = json.loads(message_encoded)
+        message_decoded = authauth_model_codec.decode(frame.buffer)
     except:
+        stats.record_error("undecodable")
         return None
     try:
-        validate_message(message_decoded)
+        message_type = validate_message(message_decoded)
     except:
         logger.exception("unhandled exception")
+        # Only count errors against message types we know, so that garbage
+        # can't grow the table of counters without bound.
+        name = "invalid"
+        if isinstance(message_decoded, dict) and message_decoded.get("message_type", None) in message_types:
+            name = message_decoded["message_type"]
+        stats.record_error(name)
         return None
+    server.version = authauth_model_codec.negotiate_version(message_decoded)
+    server.request_id = message_decoded.get("request_id", None)
+    try:
+        message_type.handler(server, message_decoded, database)
+    except authauth_model_replica.ReplicaException as e:
+        # Tell the client, so it can go to the primary instead.
+        stats.record_error(message_type.name)
+        return send_message(server, "%s_response" % (message_type.name, ), {"status": "error",
+                                                                           "reason": str(e)})
+    except:
+        stats.record_error(message_type.name)
+        raise
+    stats.record_message(message_type.name, time.time() - start_time)
 
-    message_type = message_decoded["message_type"]
-    if message_type == "ping":
-        handle_ping(server)
-    elif message_type == "get_user":
-        handle_get_user(server, message_decoded, database)
-    elif message_type == "add_user":
-        handle_add_user(server, message_decoded, database)
-
-def handle_ping(server):
-    message_type = "pong"
-    message_args = {"status": "ok"}
-    return send_message(server, message_type, message_args)
+def handle_ping(server, message_decoded, database):
+    if server.request_id is not None:
+        return send_message(server, "pong", {"status": "ok"})
+    return server.send(PONG_REPLIES[server.version])
+
+def get_identity(message_decoded):
+    """ The (provider, external_id) a get_user or add_user message is
+    about."""
+    user_type = message_decoded["user_type"]
+    return (user_type, message_decoded[EXTERNAL_ID_FIELDS[user_type]])
+
+def get_profile(provider, message_decoded):
+    """ Whichever of provider's profile fields an 'add_user' or
+    'get_or_create_user' message carries."""
+    return dict((key, message_decoded[key])
+                for key in authauth_model_database.Database.PROFILE_FIELDS.get(provider, [])
+                if message_decoded.get(key, None) is not None)
 
 def handle_get_user(server, message_decoded, database):
     # ------------------------------------------------------------------------
@@ -107,19 +334,13 @@ def handle_get_user(server, message_decoded, database):
     # ------------------------------------------------------------------------
 
     message_type = "get_user_response"
-    user_type = message_decoded["user_type"]
-    if user_type == "google":
-        assert("email" in message_decoded)
-        email = message_decoded["email"]
-        google_user = database.get_google_user(email)
-        if google_user is None:
-            message_args = {"status": "ok",
-                            "user_id": None}
-        else:
-            user_id = google_user.user_id
-            message_args = {"status": "ok",
-                            "user_id": user_id}
-        return send_message(server, message_type, message_args)
+    (provider, external_id) = get_identity(message_decoded)
+    user_id = database.get_user_id(provider, external_id)
+    message_args = {"status": "ok",
+                    "user_id": format_user_id(user_id)}
+    if replica is not None:
+        message_args["staleness"] = replica.staleness()
+    return send_message(server, message_type, message_args)
 
 def handle_add_user(server, message_decoded, database):
     # ------------------------------------------------------------------------
@@ -129,42 +350,481 @@ def handle_add_user(server, message_decoded, database):
     # ------------------------------------------------------------------------
 
     message_type = "add_user_response"
-    user_type = message_decoded["user_type"]
-    if user_type == "google":
-        assert("email" in message_decoded)
-        email = message_decoded["email"]
-        google_user = database.add_google_user(email)
-        user_id = google_user.user_id
+    (provider, external_id) = get_identity(message_decoded)
+    profile = get_profile(provider, message_decoded)
+    if group_committer is not None:
+        user_id = group_committer.add_user(provider, external_id, **profile)
+    else:
+        user_id = database.add_user(provider, external_id, **profile)
+    message_args = {"status": "ok",
+                    "user_id": format_user_id(user_id)}
+    return send_message(server, message_type, message_args)
+
+def handle_get_or_create_user(server, message_decoded, database):
+    """ A login in one round trip: the user's user_id, whether or not they
+    had to be created first, and whether they were."""
+    # ------------------------------------------------------------------------
+    #   Validate assumptions.
+    # ------------------------------------------------------------------------
+    assert("user_type" in message_decoded)
+    # ------------------------------------------------------------------------
+
+    message_type = "get_or_create_user_response"
+    (provider, external_id) = get_identity(message_decoded)
+    profile = get_profile(provider, message_decoded)
+    (user_id, created) = database.get_or_create_user(provider, external_id, **profile)
+    message_args = {"status": "ok",
+                    "user_id": format_user_id(user_id),
+                    "created": created}
+    return send_message(server, message_type, message_args)
+
+def handle_get_users(server, message_decoded, database):
+    # ------------------------------------------------------------------------
+    #   Validate assumptions.
+    # ------------------------------------------------------------------------
+    assert("users" in message_decoded)
+    # ------------------------------------------------------------------------
+
+    message_type = "get_users_response"
+    identities = [(user_type, external_id) for (user_type, external_id) in message_decoded["users"]]
+    user_ids = [format_user_id(user_id) for user_id in database.get_user_ids(identities)]
+    message_args = {"status": "ok",
+                    "user_ids": user_ids}
+    if replica is not None:
+        message_args["staleness"] = replica.staleness()
+    return send_message(server, message_type, message_args)
+
+def handle_add_users(server, message_decoded, database):
+    """ Add all the users in one transaction. If any of them can't be
+    added, e.g. because the email is already taken, none of them are.
+    With --shard that only holds within each shard."""
+    logger = logging.getLogger("%s.handle_add_users" % (APP_NAME, ))
+
+    # ------------------------------------------------------------------------
+    #   Validate assumptions.
+    # ------------------------------------------------------------------------
+    assert("users" in message_decoded)
+    # ------------------------------------------------------------------------
+
+    message_type = "add_users_response"
+    identities = [(user_type, external_id) for (user_type, external_id) in message_decoded["users"]]
+    profiles = None
+    if "profiles" in message_decoded:
+        profiles = [get_profile(provider, profile)
+                    for ((provider, external_id), profile) in zip(identities, message_decoded["profiles"])]
+    try:
+        user_ids = database.add_users(identities, profiles)
+    except apsw.ConstraintError as e:
+        logger.debug("add_users failed: %s" % (e, ))
+        message_args = {"status": "error",
+                        "reason": str(e)}
+    else:
         message_args = {"status": "ok",
-                        "user_id": user_id}
-        return send_message(server, message_type, message_args)
+                        "user_ids": [format_user_id(user_id) for user_id in user_ids]}
+    return send_message(server, message_type, message_args)
+
+def handle_get_changes(server, message_decoded, database):
+    """ The changes logged after sequence number 'after', in order, for a
+    subscriber to the change feed catching up on what it missed while it
+    wasn't connected. 'truncated' says that some of them have already
+    been trimmed from the log, so the subscriber can't know everything
+    that changed and must drop whatever it has cached."""
+    message_type = "get_changes_response"
+    if not database.change_log:
+        return send_message(server, message_type, {"status": "error",
+                                                   "reason": "no change log; see --changes_binding"})
+    after = message_decoded["after"]
+    limit = min(message_decoded.get("limit", CHANGE_BATCH_SIZE), CHANGE_BATCH_SIZE)
+    (first_sequence, last_sequence) = database.get_change_sequences()
+    changes = database.get_changes(after, limit)
+    message_args = {"status": "ok",
+                    "changes": [format_change(change) for change in changes],
+                    "last_sequence": last_sequence or 0,
+                    "truncated": first_sequence is not None and after < first_sequence - 1}
+    return send_message(server, message_type, message_args)
+
+def handle_authorize(server, message_decoded, database):
+    """ Whether a user holds a privilege through their role."""
+    message_type = "authorize_response"
+    authorized = database.authorize(message_decoded["user_id"], message_decoded["privilege"])
+    message_args = {"status": "ok",
+                    "authorized": authorized}
+    return send_message(server, message_type, message_args)
+
+def handle_set_role(server, message_decoded, database):
+    """ Create a role, or replace its privileges."""
+    message_type = "set_role_response"
+    database.set_role(message_decoded["role_id"],
+                      message_decoded["privileges"],
+                      message_decoded.get("role_name", None))
+    return send_message(server, message_type, {"status": "ok"})
+
+def handle_set_user_role(server, message_decoded, database):
+    message_type = "set_user_role_response"
+    if not database.set_user_role(message_decoded["user_id"], message_decoded["role_id"]):
+        return send_message(server, message_type, {"status": "error",
+                                                   "reason": "no such user"})
+    return send_message(server, message_type, {"status": "ok"})
+
+def handle_check_access(server, message_decoded, database):
+    """ Whether each user may take each action on each list, all at once,
+    e.g. for everyone an edit to a list would be sent to."""
+    message_type = "check_access_response"
+    checks = [(user_id, list_id, action) for (user_id, list_id, action) in message_decoded["checks"]]
+    message_args = {"status": "ok",
+                    "allowed": database.check_access(checks)}
+    return send_message(server, message_type, message_args)
+
+def handle_set_list_access(server, message_decoded, database):
+    """ Set the actions a user may take on a list; none removes them from
+    the list's ACL."""
+    message_type = "set_list_access_response"
+    try:
+        database.set_list_access(message_decoded["list_id"],
+                                 message_decoded["user_id"],
+                                 message_decoded["actions"])
+    except ValueError as e:
+        return send_message(server, message_type, {"status": "error",
+                                                   "reason": str(e)})
+    return send_message(server, message_type, {"status": "ok"})
+
+def handle_stats(server, message_decoded, database):
+    message_type = "stats_response"
+    message_args = stats.as_dict()
+    if database.user_id_cache is not None:
+        message_args["user_id_cache"] = database.user_id_cache.as_dict()
+    if database.user_role_cache is not None:
+        message_args["user_role_cache"] = database.user_role_cache.as_dict()
+    if database.list_acl_cache is not None:
+        message_args["list_acl_cache"] = database.list_acl_cache.as_dict()
+    if database.identity_filter is not None:
+        message_args["identity_filter"] = database.identity_filter.as_dict()
+        message_args["identity_filter"]["rejections"] = database.identity_filter_rejections
+    if database.identity_index is not None:
+        message_args["identity_index"] = database.identity_index.as_dict()
+    if database.executor is not None:
+        message_args["executor"] = database.executor.as_dict()
+    if replica is not None:
+        message_args["replica"] = replica.as_dict()
+    message_args["status"] = "ok"
+    return send_message(server, message_type, message_args)
 
-def get_base_message():
-    rv = {"version": "1.0"}
+def format_user_id(user_id):
+    """ User IDs go over the wire as hex, whether or not the database
+    stores them as 16-byte BLOBs, and a user that doesn't exist is
+    None."""
+    if isinstance(user_id, buffer):
+        return authauth_view_utilities.convert_uuid_bytes_to_string(user_id)
+    return user_id
+
+def format_change(change):
+    """ A change log row as it goes over the wire."""
+    (sequence, change_type, provider, external_id, user_id, changed_at) = change
+    return {"sequence": sequence,
+            "change_type": change_type,
+            "user_type": provider,
+            "external_id": external_id,
+            "user_id": format_user_id(user_id),
+            "changed_at": changed_at}
+
+def get_base_message(version = authauth_model_codec.DEFAULT_VERSION):
+    rv = {"version": version}
     return rv
 
 def send_message(socket, message_type, message_args = None):
     if not message_args:
         message_args = {}
 
-    message = get_base_message()
+    version = getattr(socket, "version", authauth_model_codec.DEFAULT_VERSION)
+    message = get_base_message(version)
     message["message_type"] = message_type
+    request_id = getattr(socket, "request_id", None)
+    if request_id is not None:
+        message["request_id"] = request_id
     for (key, value) in message_args.iteritems():
         message[key] = value
-    socket.send(json.dumps(message))
+    socket.send(authauth_model_codec.encode(message, version))
+
+def get_constant_replies(message_type, message_args):
+    """ Encode a reply that never changes once, up front, for every
+    version we support."""
+    rv = {}
+    for version in authauth_model_codec.SUPPORTED_VERSIONS:
+        message = get_base_message(version)
+        message["message_type"] = message_type
+        for (key, value) in message_args.iteritems():
+            message[key] = value
+        rv[version] = authauth_model_codec.encode(message, version)
+    return rv
+
+PONG_REPLIES = get_constant_replies("pong", {"status": "ok"})
+
+# ----------------------------------------------------------------------------
+#   Message types. To accept a new message type write its handler above and
+#   register it here; to support a new user type add the field that
+#   identifies its users to EXTERNAL_ID_FIELDS, and its provider to
+#   authauth_model_database.Database.PROVIDERS. Any profile fields an
+#   'add_user' may carry are listed in Database.PROFILE_FIELDS.
+# ----------------------------------------------------------------------------
+EXTERNAL_ID_FIELDS = {"google": "email",
+                      "browserid": "email",
+                      "twitter": "username",
+                      "facebook": "facebook_id",
+                      "api": "api_secret_key"}
+USER_TYPE_FIELDS = dict((user_type, [field]) for (user_type, field) in EXTERNAL_ID_FIELDS.iteritems())
+
+# User types that the bulk messages know how to look up and add.
+BULK_USER_TYPES = frozenset(EXTERNAL_ID_FIELDS)
+
+register_message_type(MessageType("ping", handle_ping))
+register_message_type(MessageType("stats", handle_stats))
+register_message_type(MessageType("get_user",
+                                  handle_get_user,
+                                  user_type_fields = USER_TYPE_FIELDS))
+register_message_type(MessageType("add_user",
+                                  handle_add_user,
+                                  user_type_fields = USER_TYPE_FIELDS))
+register_message_type(MessageType("get_or_create_user",
+                                  handle_get_or_create_user,
+                                  user_type_fields = USER_TYPE_FIELDS))
+register_message_type(MessageType("get_users",
+                                  handle_get_users,
+                                  required_fields = ["users"],
+                                  validator = validate_users_field))
+register_message_type(MessageType("add_users",
+                                  handle_add_users,
+                                  required_fields = ["users"],
+                                  validator = validate_users_field))
+register_message_type(MessageType("get_changes",
+                                  handle_get_changes,
+                                  required_fields = ["after"],
+                                  validator = validate_get_changes))
+register_message_type(MessageType("authorize",
+                                  handle_authorize,
+                                  required_fields = ["user_id", "privilege"],
+                                  validator = validate_role_fields))
+register_message_type(MessageType("set_role",
+                                  handle_set_role,
+                                  required_fields = ["role_id", "privileges"],
+                                  validator = validate_role_fields))
+register_message_type(MessageType("set_user_role",
+                                  handle_set_user_role,
+                                  required_fields = ["user_id", "role_id"],
+                                  validator = validate_role_fields))
+register_message_type(MessageType("check_access",
+                                  handle_check_access,
+                                  required_fields = ["checks"],
+                                  validator = validate_checks_field))
+register_message_type(MessageType("set_list_access",
+                                  handle_set_list_access,
+                                  required_fields = ["list_id", "user_id", "actions"],
+                                  validator = validate_role_fields))
+# ----------------------------------------------------------------------------
 
 def get_args():
     parser = argparse.ArgumentParser("Authenticate and authorise users.")
     parser.add_argument("--zeromq_binding",
                         dest="zeromq_binding",
                         metavar="ZEROMQ_BINDING",
-                        required=True,
+                        default=None,
                         help="ZeroMQ binding we REP on for clients.")
-    parser.add_argument("--database_filepath",
-                        dest="database_filepath",
+    parser.add_argument("--broker_binding",
+                        dest="broker_binding",
+                        metavar="ZEROMQ_BINDING",
+                        default=None,
+                        help="Rather than binding for clients, connect to the backend of an authauth_model_broker at this binding and serve the requests it hands us.")
+    parser.add_argument("--heartbeat_interval",
+                        dest="heartbeat_interval",
+                        type=float,
+                        default=authauth_model_broker.HEARTBEAT_INTERVAL,
+                        help="Seconds between heartbeats to the broker.")
+    parser.add_argument("--heartbeat_liveness",
+                        dest="heartbeat_liveness",
+                        type=int,
+                        default=authauth_model_broker.HEARTBEAT_LIVENESS,
+                        help="Heartbeats from the broker we may miss before reconnecting.")
+    parser.add_argument("--pool_size",
+                        dest="pool_size",
+                        metavar="POOL_SIZE",
+                        type=int,
+                        default=0,
+                        help="If greater than zero bind a ROUTER rather than a REP socket and handle up to this many requests concurrently, each in its own greenlet.")
+    parser.add_argument("--workers",
+                        dest="workers",
+                        metavar="WORKERS",
+                        type=int,
+                        default=0,
+                        help="If greater than zero fork this many worker processes, each with its own database connection, behind a queue device bound on the ZeroMQ binding.")
+    parser.add_argument("--workers_binding",
+                        dest="workers_binding",
+                        metavar="ZEROMQ_BINDING",
+                        default=None,
+                        help="ZeroMQ binding the queue device hands requests to workers on. Defaults to an IPC endpoint private to this process.")
+    database_group = parser.add_mutually_exclusive_group(required=True)
+    database_group.add_argument("--database_filepath",
+                                dest="database_filepath",
+                                metavar="FILEPATH",
+                                help="Full path to the database filepath to use.")
+    database_group.add_argument("--shard",
+                                dest="shards",
+                                metavar="NAME=LOCATION",
+                                type=authauth_model_hash_ring.parse_shard,
+                                action="append",
+                                default=[],
+                                help="Rather than one database, spread users over several by consistent hashing. Give once per shard. LOCATION is a database filepath, or the ZeroMQ binding of another authauth_model to pass the shard's requests on to. Clients routing for themselves must use the same NAMEs.")
+    database_group.add_argument("--replica_of",
+                                dest="replica_of",
+                                metavar="SNAPSHOT_FILEPATH",
+                                help="Rather than a database, serve lookups read-only from the snapshots another authauth_model publishes with --snapshot_filepath, switching to each new one as it appears. Adding users is refused.")
+    parser.add_argument("--snapshot_filepath",
+                        dest="snapshot_filepath",
                         metavar="FILEPATH",
-                        required=True,
-                        help="Full path to the database filepath to use.")
+                        default=None,
+                        help="Publish a snapshot of the database here every --snapshot_interval seconds, for replicas run with --replica_of. Each replaces the last in one rename, so it's safe to copy them to other machines, e.g. with rsync.")
+    parser.add_argument("--snapshot_interval",
+                        dest="snapshot_interval",
+                        metavar="SECONDS",
+                        type=float,
+                        default=SNAPSHOT_INTERVAL,
+                        help="Seconds between publishing snapshots with --snapshot_filepath, and between looking for a new one with --replica_of.")
+    parser.add_argument("--max_staleness",
+                        dest="max_staleness",
+                        metavar="SECONDS",
+                        type=float,
+                        default=None,
+                        help="With --replica_of, refuse lookups rather than answer them from a snapshot taken more than this many seconds ago, so that clients go to the primary instead. By default we answer however stale we are.")
+    parser.add_argument("--changes_binding",
+                        dest="changes_binding",
+                        metavar="ZEROMQ_BINDING",
+                        default=None,
+                        help="Log every change to the users in the database, and publish each, in order, as a 'change' message on a PUB socket bound here. Subscribers catch up on changes they missed with 'get_changes'.")
+    parser.add_argument("--change_log_size",
+                        dest="change_log_size",
+                        metavar="CHANGES",
+                        type=int,
+                        default=CHANGE_LOG_SIZE,
+                        help="With --changes_binding, how many of the latest changes to keep for 'get_changes'.")
+    parser.add_argument("--shard_timeout",
+                        dest="shard_timeout",
+                        metavar="SECONDS",
+                        type=float,
+                        default=authauth_model_sharding.REMOTE_TIMEOUT,
+                        help="Seconds to wait for a remote shard to reply.")
+    parser.add_argument("--cache_size",
+                        dest="cache_size",
+                        metavar="ENTRIES",
+                        type=int,
+                        default=0,
+                        help="If greater than zero cache up to this many user IDs in memory, evicting the least recently used.")
+    parser.add_argument("--cache_ttl",
+                        dest="cache_ttl",
+                        metavar="SECONDS",
+                        type=float,
+                        default=None,
+                        help="Seconds a cached user lives for. By default they live until evicted.")
+    parser.add_argument("--cache_dump_filepath",
+                        dest="cache_dump_filepath",
+                        metavar="FILEPATH",
+                        default=None,
+                        help="Save which users are cached here when stopped by SIGTERM or SIGINT, and warm the cache from it when started. With --workers each worker uses its own file, suffixed with its number.")
+    parser.add_argument("--false_positive_rate",
+                        dest="false_positive_rate",
+                        metavar="RATE",
+                        type=float,
+                        default=None,
+                        help="If given keep a Bloom filter of identities with this false positive rate, e.g. 0.01, and answer lookups of users it rules out without touching the database.")
+    parser.add_argument("--index_filepath",
+                        dest="index_filepath",
+                        metavar="FILEPATH",
+                        default=None,
+                        help="Look identities up in this index, built by authauth_model_build_index.py, before trying the database. Every process on a host shares the index's pages. Not with --shard.")
+    parser.add_argument("--filter_refresh_interval",
+                        dest="filter_refresh_interval",
+                        metavar="SECONDS",
+                        type=float,
+                        default=FILTER_REFRESH_INTERVAL,
+                        help="Seconds between picking up users other processes have added to the database. Until we do, lookups of them here may wrongly find nothing.")
+    parser.add_argument("--role_cache_size",
+                        dest="role_cache_size",
+                        metavar="ENTRIES",
+                        type=int,
+                        default=ROLE_CACHE_SIZE,
+                        help="Remember the roles of up to this many users for 'authorize', evicting the least recently used. Zero disables.")
+    parser.add_argument("--role_refresh_interval",
+                        dest="role_refresh_interval",
+                        metavar="SECONDS",
+                        type=float,
+                        default=ROLE_REFRESH_INTERVAL,
+                        help="Seconds between picking up roles and list ACLs other processes have changed. Until we do, 'authorize' and 'check_access' here may go by the old ones.")
+    parser.add_argument("--acl_cache_size",
+                        dest="acl_cache_size",
+                        metavar="LISTS",
+                        type=int,
+                        default=ACL_CACHE_SIZE,
+                        help="Keep the ACLs of up to this many lists in memory for 'check_access', evicting the least recently used. Zero disables.")
+    parser.add_argument("--journal_mode",
+                        dest="journal_mode",
+                        choices=authauth_model_database.Database.JOURNAL_MODES,
+                        default=None,
+                        help="SQLite journal mode. WAL lets readers carry on while a write is in progress, and makes each commit an append to the log.")
+    parser.add_argument("--synchronous",
+                        dest="synchronous",
+                        choices=authauth_model_database.Database.SYNCHRONOUS_LEVELS,
+                        default=None,
+                        help="How often SQLite waits for data to reach the disk. With WAL, NORMAL is durable against crashes of this process but not of the machine.")
+    parser.add_argument("--mmap_size",
+                        dest="mmap_size",
+                        metavar="BYTES",
+                        type=int,
+                        default=None,
+                        help="Read up to this many bytes of the database through memory-mapped I/O.")
+    parser.add_argument("--page_cache_size",
+                        dest="page_cache_size",
+                        metavar="PAGES",
+                        type=int,
+                        default=None,
+                        help="SQLite page cache size, in pages if positive or KiB if negative.")
+    parser.add_argument("--busy_timeout",
+                        dest="busy_timeout",
+                        metavar="MILLISECONDS",
+                        type=int,
+                        default=None,
+                        help="How long to wait for another connection's lock before failing. Defaults to %s with --workers or --broker_binding, else not at all." % (WORKER_BUSY_TIMEOUT, ))
+    parser.add_argument("--checkpoint_interval",
+                        dest="checkpoint_interval",
+                        metavar="SECONDS",
+                        type=float,
+                        default=CHECKPOINT_INTERVAL,
+                        help="Seconds between checkpointing the write-ahead log in the background, so requests rarely have to. Zero disables.")
+    parser.add_argument("--optimize_interval",
+                        dest="optimize_interval",
+                        metavar="SECONDS",
+                        type=float,
+                        default=OPTIMIZE_INTERVAL,
+                        help="Seconds between running PRAGMA optimize in the background. Zero disables.")
+    parser.add_argument("--read_threads",
+                        dest="read_threads",
+                        metavar="THREADS",
+                        type=int,
+                        default=0,
+                        help="If greater than zero run SQL on native threads rather than in the gevent loop, so a slow disk doesn't stall unrelated requests: reads on this many threads, each with its own read-only connection, and writes on one more. Reads only run alongside a write with --journal_mode WAL; otherwise they wait for it, for up to --busy_timeout, or 5 seconds without it.")
+    parser.add_argument("--group_commit_window",
+                        dest="group_commit_window",
+                        metavar="SECONDS",
+                        type=float,
+                        default=None,
+                        help="If given, add_user requests arriving within this many seconds of each other are written in one transaction. Only useful with --pool_size, --workers or --broker_binding, where requests are handled concurrently.")
+    parser.add_argument("--group_commit_size",
+                        dest="group_commit_size",
+                        metavar="USERS",
+                        type=int,
+                        default=GROUP_COMMIT_SIZE,
+                        help="Most add_user requests written in one transaction with --group_commit_window.")
+    parser.add_argument("--compact_user_ids",
+                        dest="compact_user_ids",
+                        action='store_true',
+                        default=False,
+                        help="With --empty_database, store user IDs as 16-byte BLOBs in WITHOUT ROWID tables. An existing database keeps the layout it was created with.")
     parser.add_argument("--verbose",
                         dest="verbose",
                         action='store_true',
@@ -176,24 +836,286 @@ def get_args():
                         default=False,
                         help="Empty the persistent store on startup.")
     args = parser.parse_args()
+    if not args.zeromq_binding and not args.broker_binding:
+        parser.error("one of --zeromq_binding or --broker_binding is required")
+    if args.snapshot_filepath and (not args.database_filepath or args.workers > 0):
+        parser.error("--snapshot_filepath needs --database_filepath, and can't be used with --workers")
+    if args.changes_binding and (not args.database_filepath or args.workers > 0):
+        parser.error("--changes_binding needs --database_filepath, and can't be used with --workers")
+    if args.index_filepath and args.shards:
+        parser.error("--index_filepath can't be used with --shard")
+    if args.change_log_size < 1:
+        parser.error("--change_log_size must be at least 1")
     return args
 
-def main():
-    args = get_args()
-    if args.verbose:
-        logger.setLevel(logging.DEBUG)
-        ch.setLevel(logging.DEBUG)
-        logger.debug("Verbose mode enabled")
+def open_database(args, empty_database = False, busy_timeout = None, cache_dump_filepath = None):
+    """ Open and configure the database, or with --shard the sharded
+    database, as args asks for, and start the greenlets that look after
+    it. If cache_dump_filepath is given warm the cache from it, and save
+    the cache to it when we're told to stop. Each local shard gets its own
+    cache file, suffixed with the shard's name."""
+    global group_committer
+    global replica
+    global cache_dumps
+    if args.busy_timeout is not None:
+        busy_timeout = args.busy_timeout
+    if args.replica_of:
+        database = authauth_model_replica.Replica(args.replica_of,
+                                                  lambda filepath: open_snapshot_database(args, filepath, busy_timeout),
+                                                  args.max_staleness)
+        replica = database
+        gevent.spawn(watch_snapshot, database, args.snapshot_interval)
+        cache_dumps = [(database, cache_dump_filepath)]
+    elif not args.shards:
+        database = open_local_database(args, args.database_filepath, empty_database, busy_timeout)
+        if args.snapshot_filepath:
+            gevent.spawn(publish_snapshots, database, args.snapshot_filepath, args.snapshot_interval)
+        if args.changes_binding:
+            gevent.spawn(publish_changes, database, args.changes_binding, args.change_log_size)
+        if args.group_commit_window is not None:
+            group_committer = authauth_model_group_commit.GroupCommitter(database,
+                                                                         args.group_commit_window,
+                                                                         args.group_commit_size)
+        cache_dumps = [(database, cache_dump_filepath)]
+    else:
+        shards = {}
+        committers = {}
+        cache_dumps = []
+        for (name, location) in args.shards:
+            if authauth_model_sharding.is_remote(location):
+                shards[name] = authauth_model_sharding.RemoteDatabase(location,
+                                                                      EXTERNAL_ID_FIELDS,
+                                                                      timeout = args.shard_timeout)
+                continue
+            shards[name] = open_local_database(args, location, empty_database, busy_timeout)
+            if args.group_commit_window is not None:
+                committers[name] = authauth_model_group_commit.GroupCommitter(shards[name],
+                                                                              args.group_commit_window,
+                                                                              args.group_commit_size)
+            if cache_dump_filepath:
+                cache_dumps.append((shards[name], "%s.%s" % (cache_dump_filepath, name)))
+        database = authauth_model_sharding.ShardedDatabase(shards, committers)
+    cache_dumps = [(local_database, filepath) for (local_database, filepath) in cache_dumps
+                   if filepath and local_database.user_id_cache is not None]
+    if cache_dumps:
+        for (local_database, filepath) in cache_dumps:
+            local_database.load_user_id_cache(filepath)
+        def save_cache_and_exit(signum, frame):
+            save_caches()
+            os._exit(0)
+        signal.signal(signal.SIGTERM, save_cache_and_exit)
+        signal.signal(signal.SIGINT, save_cache_and_exit)
+    return database
+
+def save_caches():
+    for (local_database, filepath) in cache_dumps:
+        local_database.save_user_id_cache(filepath)
+
+def open_local_database(args, database_filepath, empty_database, busy_timeout):
+    database = authauth_model_database.Database(database_filepath,
+                                                empty_database = empty_database,
+                                                busy_timeout = busy_timeout,
+                                                cache_size = args.cache_size,
+                                                cache_ttl = args.cache_ttl,
+                                                false_positive_rate = args.false_positive_rate,
+                                                compact_user_ids = args.compact_user_ids,
+                                                change_log = bool(args.changes_binding),
+                                                role_cache_size = args.role_cache_size,
+                                                acl_cache_size = args.acl_cache_size)
+    database.configure(journal_mode = args.journal_mode,
+                       synchronous = args.synchronous,
+                       mmap_size = args.mmap_size,
+                       page_cache_size = args.page_cache_size)
+    if args.index_filepath:
+        database.identity_index = authauth_model_index.IdentityIndex(args.index_filepath)
+    if args.read_threads > 0:
+        database.executor = authauth_model_executor.DatabaseExecutor(database, args.read_threads)
+    if args.checkpoint_interval > 0 or args.optimize_interval > 0:
+        gevent.spawn(maintain_database, database, args.checkpoint_interval, args.optimize_interval)
+    if database.identity_filter is not None:
+        gevent.spawn(refresh_identity_filter, database, args.filter_refresh_interval)
+    gevent.spawn(refresh_roles, database, args.role_refresh_interval)
+    return database
+
+def open_snapshot_database(args, snapshot_filepath, busy_timeout):
+    """ A replica's snapshot is never written to, so it needs none of the
+    upkeep of open_local_database()."""
+    database = authauth_model_database.Database(snapshot_filepath,
+                                                busy_timeout = busy_timeout,
+                                                cache_size = args.cache_size,
+                                                cache_ttl = args.cache_ttl,
+                                                false_positive_rate = args.false_positive_rate,
+                                                read_only = True,
+                                                role_cache_size = args.role_cache_size,
+                                                acl_cache_size = args.acl_cache_size)
+    database.configure(mmap_size = args.mmap_size,
+                       page_cache_size = args.page_cache_size)
+    if args.index_filepath:
+        database.identity_index = authauth_model_index.IdentityIndex(args.index_filepath)
+    if args.read_threads > 0:
+        database.executor = authauth_model_executor.DatabaseExecutor(database, args.read_threads)
+    return database
+
+def get_local_database_filepaths(args):
+    if args.replica_of:
+        return []
+    if not args.shards:
+        return [args.database_filepath]
+    return [location for (name, location) in args.shards
+            if not authauth_model_sharding.is_remote(location)]
+
+def refresh_identity_filter(database, interval):
+    """ Keep the database's Bloom filter up to date with users added by
+    other processes sharing the database file."""
+    logger = logging.getLogger("%s.refresh_identity_filter" % (APP_NAME, ))
+    while True:
+        gevent.sleep(interval)
+        try:
+            database.refresh_identity_filter()
+        except apsw.BusyError:
+            logger.warning("database busy, will refresh the identity filter later")
+
+def refresh_roles(database, interval):
+    """ Keep the database's roles, and the users' roles and lists' ACLs
+    it remembers, up to date with changes made by other processes sharing
+    the database file."""
+    logger = logging.getLogger("%s.refresh_roles" % (APP_NAME, ))
+    while True:
+        gevent.sleep(interval)
+        try:
+            database.refresh_roles()
+        except apsw.BusyError:
+            logger.warning("database busy, will refresh the roles later")
+
+def publish_snapshots(database, snapshot_filepath, interval):
+    """ Copy the database to snapshot_filepath every interval seconds for
+    replicas to serve. The copy is made a step at a time, letting other
+    greenlets run in between."""
+    logger = logging.getLogger("%s.publish_snapshots" % (APP_NAME, ))
+    while True:
+        try:
+            start_time = time.time()
+            database.snapshot(snapshot_filepath, pause = gevent.sleep)
+            logger.debug("published snapshot in %.3fs" % (time.time() - start_time, ))
+        except (apsw.Error, IOError, OSError):
+            logger.exception("failed to publish snapshot, will try again later")
+        gevent.sleep(interval)
+
+def publish_changes(database, changes_binding, change_log_size, interval = CHANGE_POLL_INTERVAL):
+    """ Publish each change logged to the database, in order, as a 'change'
+    message on a PUB socket bound to changes_binding, and trim the log to
+    its last change_log_size changes as we go.
+
+    We start from the end of the log. Subscribers catch up on anything
+    before that, or anything they missed while disconnected, with
+    'get_changes' and the sequence number of the last change they saw."""
+    logger = logging.getLogger("%s.publish_changes" % (APP_NAME, ))
+    socket = zmq.Context.instance().socket(zmq.PUB)
+    socket.bind(changes_binding)
+    (first_sequence, last_sequence) = database.get_change_sequences()
+    last_sequence = last_sequence or 0
+    trim_at = time.time() + CHANGE_LOG_TRIM_INTERVAL
+    while True:
+        changes = []
+        try:
+            changes = database.get_changes(last_sequence, CHANGE_BATCH_SIZE)
+            for change in changes:
+                message = get_base_message()
+                message["message_type"] = "change"
+                message.update(format_change(change))
+                socket.send(authauth_model_codec.encode(message))
+            if changes:
+                last_sequence = changes[-1][0]
+            if time.time() >= trim_at:
+                database.trim_change_log(change_log_size)
+                trim_at = time.time() + CHANGE_LOG_TRIM_INTERVAL
+        except apsw.BusyError:
+            logger.warning("database busy, will publish changes later")
+        if len(changes) < CHANGE_BATCH_SIZE:
+            gevent.sleep(interval)
+
+def watch_snapshot(replica, interval):
+    """ Switch to each new snapshot within interval seconds of it
+    appearing."""
+    logger = logging.getLogger("%s.watch_snapshot" % (APP_NAME, ))
+    while True:
+        gevent.sleep(interval)
+        try:
+            replica.load()
+        except (apsw.Error, IOError, OSError):
+            logger.exception("failed to load snapshot, will try again later")
+
+def maintain_database(database, checkpoint_interval, optimize_interval):
+    """ Checkpoint the write-ahead log and refresh the query planner's
+    statistics between requests rather than in the middle of one."""
+    logger = logging.getLogger("%s.maintain_database" % (APP_NAME, ))
+    intervals = [interval for interval in (checkpoint_interval, optimize_interval) if interval > 0]
+    sleep_interval = min(intervals)
+    optimize_at = time.time() + optimize_interval
+    while True:
+        gevent.sleep(sleep_interval)
+        try:
+            if checkpoint_interval > 0 and database.journal_mode == "WAL":
+                (busy, log_pages, checkpointed_pages) = database.checkpoint()
+                logger.debug("checkpointed %s of %s pages, busy: %s" % (checkpointed_pages, log_pages, busy))
+            if optimize_interval > 0 and time.time() >= optimize_at:
+                database.optimize()
+                optimize_at = time.time() + optimize_interval
+        except apsw.BusyError:
+            logger.warning("database busy, will try again later")
+
+def watch_parent(parent_pid, interval = 1.0):
+    """ Exit the process once our parent process has gone away, so that
+    workers don't outlive the device that feeds them."""
+    logger = logging.getLogger("%s.watch_parent" % (APP_NAME, ))
+    while os.getppid() == parent_pid:
+        gevent.sleep(interval)
+    logger.info("parent process %s has exited, stopping." % (parent_pid, ))
+    save_caches()
+    os._exit(0)
+
+def run_server(zeromq_endpoint, database, pool_size, bind = True, parent_pid = None):
+    """ Serve requests on zeromq_endpoint until the process is killed.
 
-    database = authauth_model_database.Database(args.database_filepath,
-                                                empty_database = args.empty_database)
+    If bind is False we connect to zeromq_endpoint instead, which is how
+    workers attach to the queue device. If parent_pid is given we exit
+    once our parent process has gone away."""
+    if parent_pid is not None:
+        gevent.spawn(watch_parent, parent_pid)
 
     # ------------------------------------------------------------------------
-    #   Bind to the ZeroMQ REP binding for client requests.
+    #   Bind to the ZeroMQ binding for client requests. A ROUTER socket
+    #   lets us have many requests in flight at once; REQ clients can't
+    #   tell the difference.
     # ------------------------------------------------------------------------
+    stats.reset()
+    database.stats = stats
     context = zmq.Context(1)
-    server = context.socket(zmq.REP)
-    server.bind(args.zeromq_binding)
+    if pool_size > 0:
+        server = context.socket(zmq.ROUTER)
+        pool = gevent.pool.Pool(pool_size)
+        send_lock = gevent.lock.Semaphore()
+        stats.in_flight = pool.__len__
+    else:
+        server = context.socket(zmq.REP)
+        pool = None
+        send_lock = None
+    if bind:
+        server.bind(zeromq_endpoint)
+    else:
+        server.connect(zeromq_endpoint)
+    # ------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------
+    #   With a pool, greenlets send replies on the server socket while we
+    #   wait for the next request. ZeroMQ only signals a socket's file
+    #   descriptor on edges, and those sends can swallow the edge for a
+    #   newly arrived request, so a poller could sleep through it. A green
+    #   recv() checks the socket's state itself, so just block on that.
+    # ------------------------------------------------------------------------
+    if pool is not None:
+        while True:
+            handle_server_request(server, database, pool, send_lock)
     # ------------------------------------------------------------------------
 
     # ------------------------------------------------------------------------
@@ -210,8 +1132,181 @@ def main():
     while True:
         socks = dict(poller.poll(POLL_INTERVAL))
         if socks.get(server, None) == zmq.POLLIN:
-            handle_server_request(server, database)
+            handle_server_request(server, database, pool, send_lock)
     # ------------------------------------------------------------------------
 
+class BrokerConnection(object):
+    """ The DEALER socket a worker uses to talk to the broker. Reconnecting
+    replaces the socket, so ReplySockets send through this rather than
+    holding on to a socket that may since have been closed."""
+    def __init__(self, context, broker_binding, capacity, lock, in_flight):
+        self.context = context
+        self.broker_binding = broker_binding
+        self.capacity = capacity
+        self.lock = lock
+        # Counts the requests we're handling, for the broker; it can't tell
+        # for itself as we don't reply to some of them.
+        self.in_flight = in_flight
+        self.socket = None
+        self.connect()
+
+    def connect(self):
+        if self.socket is not None:
+            self.socket.close(linger = 0)
+        self.socket = self.context.socket(zmq.DEALER)
+        self.socket.setsockopt(zmq.LINGER, 0)
+        self.socket.connect(self.broker_binding)
+        with self.lock:
+            self.send_multipart([PPP_READY, str(self.capacity)])
+
+    def heartbeat(self):
+        with self.lock:
+            self.send_multipart([PPP_HEARTBEAT, str(self.capacity), str(self.in_flight())])
+
+    def send_multipart(self, frames):
+        self.socket.send_multipart(frames)
+
+def run_broker_worker(broker_binding, database, pool_size, heartbeat_interval, heartbeat_liveness):
+    """ Serve requests handed to us by an authauth_model_broker, heartbeating
+    to it and reconnecting, with backoff, if it goes quiet."""
+    logger = logging.getLogger("%s.run_broker_worker" % (APP_NAME, ))
+    stats.reset()
+    database.stats = stats
+    capacity = max(pool_size, 1)
+    pool = gevent.pool.Pool(capacity)
+    stats.in_flight = pool.__len__
+    send_lock = gevent.lock.Semaphore()
+    context = zmq.Context(1)
+    connection = BrokerConnection(context, broker_binding, capacity, send_lock, pool.__len__)
+    logger.info("connected to broker at %s with capacity %s" % (broker_binding, capacity))
+
+    liveness_timeout = heartbeat_interval * heartbeat_liveness
+    reconnect_interval = heartbeat_interval
+    expiry = time.time() + liveness_timeout
+    heartbeat_at = time.time() + heartbeat_interval
+    while True:
+        frames = None
+        with gevent.Timeout(heartbeat_interval, False):
+            frames = connection.socket.recv_multipart(copy = False)
+        now = time.time()
+        if frames is not None:
+            expiry = now + liveness_timeout
+            reconnect_interval = heartbeat_interval
+            if len(frames) > 1:
+                reply_socket = ReplySocket(connection, frames[:-1], send_lock)
+                pool.spawn(process_server_request, reply_socket, frames[-1], database)
+        elif now >= expiry:
+            logger.warning("broker silent, reconnecting in %s seconds" % (reconnect_interval, ))
+            gevent.sleep(reconnect_interval)
+            reconnect_interval = min(reconnect_interval * 2, MAX_RECONNECT_INTERVAL)
+            connection.connect()
+            now = time.time()
+            expiry = now + liveness_timeout
+        if now >= heartbeat_at:
+            connection.heartbeat()
+            heartbeat_at = now + heartbeat_interval
+
+def run_workers(args):
+    """ Fork args.workers worker processes, each with its own database
+    connection, and feed them client requests through a ROUTER/DEALER
+    queue device bound on args.zeromq_binding.
+
+    The database is emptied here, once, before any worker opens it."""
+    logger = logging.getLogger("%s.run_workers" % (APP_NAME, ))
+    if args.empty_database:
+        for database_filepath in get_local_database_filepaths(args):
+            database = authauth_model_database.Database(database_filepath,
+                                                        empty_database = True,
+                                                        compact_user_ids = args.compact_user_ids)
+            database.close()
+
+    workers_binding = args.workers_binding
+    if not workers_binding:
+        workers_binding = "ipc://%s" % (os.path.join(tempfile.gettempdir(),
+                                                     "%s.%s.ipc" % (APP_NAME, os.getpid())), )
+    logger.info("starting %s workers on %s" % (args.workers, workers_binding))
+
+    # ------------------------------------------------------------------------
+    #   Fork the workers before we create a ZeroMQ context, as neither
+    #   ZeroMQ contexts nor SQLite connections survive a fork.
+    # ------------------------------------------------------------------------
+    parent_pid = os.getpid()
+    worker_pids = []
+    for i in xrange(args.workers):
+        pid = gevent.fork()
+        if pid == 0:
+            cache_dump_filepath = None
+            if args.cache_dump_filepath:
+                cache_dump_filepath = "%s.%s" % (args.cache_dump_filepath, i)
+            database = open_database(args,
+                                     busy_timeout = WORKER_BUSY_TIMEOUT,
+                                     cache_dump_filepath = cache_dump_filepath)
+            run_server(workers_binding,
+                       database,
+                       args.pool_size,
+                       bind = False,
+                       parent_pid = parent_pid)
+            os._exit(0)
+        worker_pids.append(pid)
+    # ------------------------------------------------------------------------
+
+    # ------------------------------------------------------------------------
+    #   Run the queue device. This blocks for the life of the process, or
+    #   until we're told to stop, when we stop the workers too and wait for
+    #   them to save their caches.
+    # ------------------------------------------------------------------------
+    def stop(signum, frame):
+        raise SystemExit(0)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    try:
+        context = zmq.Context(1)
+        frontend = context.socket(zmq.ROUTER)
+        frontend.bind(args.zeromq_binding)
+        backend = context.socket(zmq.DEALER)
+        backend.bind(workers_binding)
+        zmq.device(zmq.QUEUE, frontend, backend)
+    finally:
+        for pid in worker_pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        for pid in worker_pids:
+            try:
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+    # ------------------------------------------------------------------------
+
+def main():
+    args = get_args()
+    if args.verbose:
+        logger.setLevel(logging.DEBUG)
+        ch.setLevel(logging.DEBUG)
+        logger.debug("Verbose mode enabled")
+
+    if args.workers > 0:
+        run_workers(args)
+        return
+
+    if args.broker_binding:
+        # Other workers for the same broker may share our database file.
+        database = open_database(args,
+                                 empty_database = args.empty_database,
+                                 busy_timeout = WORKER_BUSY_TIMEOUT,
+                                 cache_dump_filepath = args.cache_dump_filepath)
+        run_broker_worker(args.broker_binding,
+                          database,
+                          args.pool_size,
+                          args.heartbeat_interval,
+                          args.heartbeat_liveness)
+        return
+
+    database = open_database(args,
+                             empty_database = args.empty_database,
+                             cache_dump_filepath = args.cache_dump_filepath)
+    run_server(args.zeromq_binding, database, args.pool_size)
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python2.7
+
+# ---------------------------------------------------------------------------
+# Copyright (c) 2012 Asim Ihsan (asim dot ihsan at gmail dot com)
+# Distributed under the MIT/X11 software license, see the accompanying
+# file license.txt or http://www.opensource.org/licenses/mit-license.php.
+# ---------------------------------------------------------------------------
+
+# ---------------------------------------------------------------------------
+#   authauth_model_bloom.py: a Bloom filter, i.e. a set that can tell us a
+#   key is definitely absent without storing the keys themselves.
+#
+#   "key in bloom_filter" is never False for a key that was added, and is
+#   True for a key that wasn't with roughly the false positive rate the
+#   filter was sized for, as long as no more than capacity keys are added.
+#   The k bit positions for a key come from one MD5 digest split into two
+#   64-bit halves, h1 + i * h2 (Kirsch and Mitzenmacher).
+# ---------------------------------------------------------------------------
+
+import hashlib
+import math
+import struct
+
+class BloomFilter(object):
+    def __init__(self, capacity, false_positive_rate):
+        assert(capacity > 0)
+        assert(0.0 < false_positive_rate < 1.0)
+        self.capacity = capacity
+        self.false_positive_rate = false_positive_rate
+        self.number_of_bits = max(8, int(math.ceil(-capacity * math.log(false_positive_rate) / (math.log(2) ** 2))))
+        self.number_of_hashes = max(1, int(round(float(self.number_of_bits) / capacity * math.log(2))))
+        self.bits = bytearray((self.number_of_bits + 7) // 8)
+
+        # Distinct keys added, as near as we can tell: adding a key that
+        # sets no new bits isn't counted, so adding the same key twice is
+        # harmless.
+        self.count = 0
+
+    def _positions(self, key):
+        if isinstance(key, unicode):
+            key = key.encode("utf-8")
+        (h1, h2) = struct.unpack("<QQ", hashlib.md5(key).digest())
+        for i in xrange(self.number_of_hashes):
+            yield (h1 + i * h2) % self.number_of_bits
+
+    def add(self, key):
+        """ Add key. Returns True if it wasn't in the filter already."""
+        new = False
+        for position in self._positions(key):
+            mask = 1 << (position & 7)
+            if not self.bits[position >> 3] & mask:
+                self.bits[position >> 3] |= mask
+                new = True
+        if new:
+            self.count += 1
+        return new
+
+    def __contains__(self, key):
+        for position in self._positions(key):
+            if not self.bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def is_full(self):
+        return self.count > self.capacity
+
+    def estimated_false_positive_rate(self):
+        """ The false positive rate given how many keys we hold now."""
+        return (1.0 - math.exp(-float(self.number_of_hashes) * self.count / self.number_of_bits)) ** self.number_of_hashes
+
+    def as_dict(self):
+        return {"capacity": self.capacity,
+                "count": self.count,
+                "bits": self.number_of_bits,
+                "hashes": self.number_of_hashes,
+                "false_positive_rate": self.false_positive_rate,
+                "estimated_false_positive_rate": self.estimated_false_positive_rate()}
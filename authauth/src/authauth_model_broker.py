@@ -0,0 +1,225 @@
+#!/usr/bin/env python2.7
+
+# ---------------------------------------------------------------------------
+# Copyright (c) 2012 Asim Ihsan (asim dot ihsan at gmail dot com)
+# Distributed under the MIT/X11 software license, see the accompanying
+# file license.txt or http://www.opensource.org/licenses/mit-license.php.
+# ---------------------------------------------------------------------------
+
+# ---------------------------------------------------------------------------
+#   authauth_model_broker.py: load-balancing broker in front of any number
+#   of authauth_model workers, which may be on other machines.
+#
+#   Clients connect to the broker's frontend exactly as they would to
+#   authauth_model itself. Workers (authauth_model --broker_binding) connect
+#   a DEALER socket to the backend, announce how many requests they can
+#   handle at once, and heartbeat. This is the "Paranoid Pirate" pattern:
+#
+#   -   Worker to broker: [READY, capacity] once connected, then
+#       [HEARTBEAT, capacity, in flight] every heartbeat interval, and
+#       replies as [client envelope..., reply].
+#   -   Broker to worker: [HEARTBEAT] every heartbeat interval, and
+#       requests as [client envelope..., request].
+#
+#   Each request goes to the live worker with the lowest fraction of its
+#   capacity in use. A worker we haven't heard from for heartbeat_liveness
+#   intervals is dropped; a worker that hasn't heard from us for as long
+#   reconnects. Requests in flight on a worker that dies are lost, and it's
+#   up to clients to retry them (see authauth_view_model_client).
+#
+#   We count a worker's requests in flight down as its replies arrive, but
+#   a worker doesn't reply to every request, e.g. one it can't decode. So
+#   each heartbeat also says how many requests the worker is really
+#   handling, and we take its word for it.
+# ---------------------------------------------------------------------------
+
+import os
+import sys
+import argparse
+import time
+
+from gevent_zeromq import zmq
+
+# ----------------------------------------------------------------------
+#   Logging.
+# ----------------------------------------------------------------------
+import logging
+import logging.handlers
+
+APP_NAME = 'authauth_model_broker'
+logger = logging.getLogger(APP_NAME)
+logger.setLevel(logging.INFO)
+ch = logging.StreamHandler()
+ch.setLevel(logging.INFO)
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(message)s')
+ch.setFormatter(formatter)
+logger.addHandler(ch)
+logger = logging.getLogger(APP_NAME)
+# ----------------------------------------------------------------------
+
+# ----------------------------------------------------------------------
+#   Protocol between broker and workers.
+# ----------------------------------------------------------------------
+PPP_READY = "\x01"
+PPP_HEARTBEAT = "\x02"
+
+# Seconds between heartbeats, and how many we may miss before the other
+# side is presumed dead.
+HEARTBEAT_INTERVAL = 1.0
+HEARTBEAT_LIVENESS = 3
+# ----------------------------------------------------------------------
+
+class Worker(object):
+    def __init__(self, identity, capacity, expiry):
+        self.identity = identity
+        self.capacity = capacity
+        self.in_flight = 0
+        self.expiry = expiry
+
+    def load(self):
+        return float(self.in_flight) / self.capacity
+
+class WorkerQueue(object):
+    """ The live workers, keyed by their identity on the backend socket."""
+    def __init__(self, heartbeat_interval, heartbeat_liveness):
+        self.workers = {}
+        self.timeout = heartbeat_interval * heartbeat_liveness
+
+    def refresh(self, identity, capacity, in_flight = None):
+        """ A worker is ready, or has heartbeated. in_flight, if given, is
+        how many requests it says it's handling. Requests we've sent that
+        it hasn't received yet aren't among them, so for a moment we may
+        think it has more room than it does; it queues what it can't take
+        yet."""
+        logger = logging.getLogger("%s.WorkerQueue.refresh" % (APP_NAME, ))
+        worker = self.workers.get(identity, None)
+        if worker is None:
+            logger.info("worker %s ready with capacity %s" % (identity.encode("hex"), capacity))
+            worker = Worker(identity, capacity, 0)
+            self.workers[identity] = worker
+        worker.capacity = capacity
+        if in_flight is not None:
+            worker.in_flight = in_flight
+        worker.expiry = time.time() + self.timeout
+
+    def purge(self):
+        logger = logging.getLogger("%s.WorkerQueue.purge" % (APP_NAME, ))
+        now = time.time()
+        for (identity, worker) in self.workers.items():
+            if worker.expiry < now:
+                logger.info("worker %s expired with %s requests in flight" % (identity.encode("hex"), worker.in_flight))
+                del self.workers[identity]
+
+    def least_loaded(self):
+        """ Return the live worker with the lowest fraction of its capacity
+        in use, or None if every worker is busy."""
+        rv = None
+        for worker in self.workers.itervalues():
+            if worker.in_flight >= worker.capacity:
+                continue
+            if rv is None or worker.load() < rv.load():
+                rv = worker
+        return rv
+
+    def reply_received(self, identity):
+        worker = self.workers.get(identity, None)
+        if worker is not None and worker.in_flight > 0:
+            worker.in_flight -= 1
+            worker.expiry = time.time() + self.timeout
+
+def run_broker(frontend_binding, backend_binding, heartbeat_interval, heartbeat_liveness):
+    logger = logging.getLogger("%s.run_broker" % (APP_NAME, ))
+    context = zmq.Context(1)
+    frontend = context.socket(zmq.ROUTER)
+    frontend.bind(frontend_binding)
+    backend = context.socket(zmq.ROUTER)
+    backend.bind(backend_binding)
+    logger.info("clients on %s, workers on %s" % (frontend_binding, backend_binding))
+
+    # Only take requests from clients while some worker has room for
+    # them; otherwise they wait in ZeroMQ's queues.
+    poll_workers = zmq.Poller()
+    poll_workers.register(backend, zmq.POLLIN)
+    poll_both = zmq.Poller()
+    poll_both.register(frontend, zmq.POLLIN)
+    poll_both.register(backend, zmq.POLLIN)
+
+    workers = WorkerQueue(heartbeat_interval, heartbeat_liveness)
+    heartbeat_at = time.time() + heartbeat_interval
+    while True:
+        if workers.least_loaded() is not None:
+            poller = poll_both
+        else:
+            poller = poll_workers
+        socks = dict(poller.poll(heartbeat_interval * 1000))
+
+        if socks.get(backend, None) == zmq.POLLIN:
+            frames = backend.recv_multipart()
+            identity = frames[0]
+            rest = frames[1:]
+            if len(rest) == 2 and rest[0] in (PPP_READY, PPP_HEARTBEAT):
+                workers.refresh(identity, int(rest[1]))
+            elif len(rest) == 3 and rest[0] == PPP_HEARTBEAT:
+                workers.refresh(identity, int(rest[1]), int(rest[2]))
+            elif len(rest) > 1:
+                workers.reply_received(identity)
+                frontend.send_multipart(rest)
+            else:
+                logger.error("invalid message from worker %s: %s" % (identity.encode("hex"), rest))
+
+        if socks.get(frontend, None) == zmq.POLLIN:
+            worker = workers.least_loaded()
+            if worker is not None:
+                frames = frontend.recv_multipart()
+                worker.in_flight += 1
+                backend.send_multipart([worker.identity] + frames)
+
+        if time.time() >= heartbeat_at:
+            for worker in workers.workers.itervalues():
+                backend.send_multipart([worker.identity, PPP_HEARTBEAT])
+            heartbeat_at = time.time() + heartbeat_interval
+        workers.purge()
+
+def get_args():
+    parser = argparse.ArgumentParser("Load-balance clients across authauth_model workers.")
+    parser.add_argument("--frontend_binding",
+                        dest="frontend_binding",
+                        metavar="ZEROMQ_BINDING",
+                        required=True,
+                        help="ZeroMQ binding clients connect to.")
+    parser.add_argument("--backend_binding",
+                        dest="backend_binding",
+                        metavar="ZEROMQ_BINDING",
+                        required=True,
+                        help="ZeroMQ binding authauth_model workers connect to.")
+    parser.add_argument("--heartbeat_interval",
+                        dest="heartbeat_interval",
+                        type=float,
+                        default=HEARTBEAT_INTERVAL,
+                        help="Seconds between heartbeats to workers.")
+    parser.add_argument("--heartbeat_liveness",
+                        dest="heartbeat_liveness",
+                        type=int,
+                        default=HEARTBEAT_LIVENESS,
+                        help="Heartbeats a worker may miss before it is dropped.")
+    parser.add_argument("--verbose",
+                        dest="verbose",
+                        action='store_true',
+                        default=False,
+                        help="Enable verbose debug mode.")
+    args = parser.parse_args()
+    return args
+
+def main():
+    args = get_args()
+    if args.verbose:
+        logger.setLevel(logging.DEBUG)
+        ch.setLevel(logging.DEBUG)
+        logger.debug("Verbose mode enabled")
+    run_broker(args.frontend_binding,
+               args.backend_binding,
+               args.heartbeat_interval,
+               args.heartbeat_liveness)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python2.7
+
+# ---------------------------------------------------------------------------
+# Copyright (c) 2012 Asim Ihsan (asim dot ihsan at gmail dot com)
+# Distributed under the MIT/X11 software license, see the accompanying
+# file license.txt or http://www.opensource.org/licenses/mit-license.php.
+# ---------------------------------------------------------------------------
+
+# ---------------------------------------------------------------------------
+#   authauth_model_build_index.py: build the memory-mapped identity index
+#   that authauth_model answers lookups from with --index_filepath. See
+#   authauth_model_index.
+#
+#   It's safe to build an index while authauth_model is using the database,
+#   and to replace the index an authauth_model is using, though it only
+#   picks up the new one when restarted.
+#
+#   e.g. ./authauth_model_build_index.py --database_filepath /var/db/authauth.db --index_filepath /var/db/authauth.idx
+# ---------------------------------------------------------------------------
+
+import os
+import sys
+import argparse
+import time
+
+# ----------------------------------------------------------------------
+#   Logging.
+# ----------------------------------------------------------------------
+import logging
+import logging.handlers
+
+APP_NAME = 'authauth_model_build_index'
+logger = logging.getLogger(APP_NAME)
+logger.setLevel(logging.INFO)
+ch = logging.StreamHandler()
+ch.setLevel(logging.INFO)
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(message)s')
+ch.setFormatter(formatter)
+logger.addHandler(ch)
+logger = logging.getLogger(APP_NAME)
+# ----------------------------------------------------------------------
+
+import authauth_model_database
+import authauth_model_index
+
+def get_args():
+    parser = argparse.ArgumentParser("Build an identity index for authauth_model.")
+    parser.add_argument("--database_filepath",
+                        dest="database_filepath",
+                        metavar="FILEPATH",
+                        required=True,
+                        help="Full path to the database to index.")
+    parser.add_argument("--index_filepath",
+                        dest="index_filepath",
+                        metavar="FILEPATH",
+                        required=True,
+                        help="Where to write the index. Any index already there is replaced.")
+    parser.add_argument("--verbose",
+                        dest="verbose",
+                        action='store_true',
+                        default=False,
+                        help="Enable verbose debug mode.")
+    return parser.parse_args()
+
+def main():
+    args = get_args()
+    if args.verbose:
+        logger.setLevel(logging.DEBUG)
+        ch.setLevel(logging.DEBUG)
+        logger.debug("Verbose mode enabled")
+    if not os.path.isfile(args.database_filepath):
+        logger.error("no database at %s" % (args.database_filepath, ))
+        sys.exit(1)
+    database = authauth_model_database.Database(args.database_filepath, busy_timeout = 5000)
+    try:
+        start_time = time.time()
+        (records, skipped) = authauth_model_index.build_index(database, args.index_filepath)
+        logger.info("indexed %s identities in %.1fs" % (records, time.time() - start_time))
+        if skipped:
+            logger.warning("skipped %s identities whose user_id isn't a UUID; they'll be looked up in the database" % (skipped, ))
+    finally:
+        database.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,226 @@
+#!/usr/bin/env python2.7
+
+# ---------------------------------------------------------------------------
+# Copyright (c) 2012 Asim Ihsan (asim dot ihsan at gmail dot com)
+# Distributed under the MIT/X11 software license, see the accompanying
+# file license.txt or http://www.opensource.org/licenses/mit-license.php.
+# ---------------------------------------------------------------------------
+
+# ---------------------------------------------------------------------------
+#   authauth_model_bulk.py: stream Google users into and out of an
+#   authauth_model database as CSV or JSON lines.
+#
+#   Both directions hold at most one chunk of rows in memory. Imports write
+#   each chunk in its own transaction, and with --checkpoint record how
+#   far through the input they've got in that same transaction, so running
+#   the same import again after it's interrupted skips what's already in.
+#
+#   Each record has the fields email, user_id, first_name, last_name, name
+#   and locale. Only email is required; a missing user_id is generated. CSV
+#   files have a header row naming their columns.
+#
+#   e.g.
+#
+#   ./authauth_model_bulk.py --database_filepath authauth.db import users.csv --checkpoint users-2012-06
+#   ./authauth_model_bulk.py --database_filepath authauth.db export users.jsonl
+# ---------------------------------------------------------------------------
+
+import os
+import sys
+import argparse
+import csv
+import json
+import time
+from itertools import islice
+
+# ----------------------------------------------------------------------
+#   Logging.
+# ----------------------------------------------------------------------
+import logging
+import logging.handlers
+
+APP_NAME = 'authauth_model_bulk'
+logger = logging.getLogger(APP_NAME)
+logger.setLevel(logging.INFO)
+ch = logging.StreamHandler()
+ch.setLevel(logging.INFO)
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(message)s')
+ch.setFormatter(formatter)
+logger.addHandler(ch)
+logger = logging.getLogger(APP_NAME)
+# ----------------------------------------------------------------------
+
+import authauth_model_database
+import authauth_view_utilities
+from authauth_model_database import GOOGLE_USER_FIELDS
+
+FORMATS = ["csv", "jsonl"]
+CHUNK_SIZE = 10000
+
+def guess_format(filepath):
+    if filepath.endswith(".jsonl") or filepath.endswith(".json"):
+        return "jsonl"
+    return "csv"
+
+def open_input(filepath):
+    if filepath == "-":
+        return sys.stdin
+    return open(filepath, "rb")
+
+def open_output(filepath):
+    if filepath == "-":
+        return sys.stdout
+    return open(filepath, "wb")
+
+# ----------------------------------------------------------------------
+#   Reading and writing records. Records are dicts keyed by
+#   GOOGLE_USER_FIELDS, with unicode values or None.
+# ----------------------------------------------------------------------
+def read_csv(f):
+    for record in csv.DictReader(f):
+        yield dict((key, value.decode("utf-8") if value else None)
+                   for (key, value) in record.iteritems())
+
+def read_jsonl(f):
+    for line in f:
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+
+def write_csv(f, records):
+    writer = csv.writer(f)
+    writer.writerow(GOOGLE_USER_FIELDS)
+    for record in records:
+        writer.writerow([record[key].encode("utf-8") if record[key] is not None else ""
+                         for key in GOOGLE_USER_FIELDS])
+
+def write_jsonl(f, records):
+    for record in records:
+        f.write(json.dumps(record, sort_keys = True))
+        f.write("\n")
+
+READERS = {"csv": read_csv, "jsonl": read_jsonl}
+WRITERS = {"csv": write_csv, "jsonl": write_jsonl}
+# ----------------------------------------------------------------------
+
+def record_to_row(database, record):
+    """ User IDs in files are hex, whether or not the database stores
+    them as 16-byte BLOBs."""
+    if not record.get("email", None):
+        raise ValueError("record without an email: %s" % (record, ))
+    if not record.get("user_id", None):
+        record["user_id"] = database.new_user_id()
+    elif database.compact_user_ids:
+        record["user_id"] = buffer(authauth_view_utilities.convert_uuid_string_to_bytes(record["user_id"]))
+    return tuple(record.get(key, None) for key in GOOGLE_USER_FIELDS)
+
+def import_google_users(database, records, chunk_size = CHUNK_SIZE, on_conflict = "ABORT", checkpoint_name = None):
+    """ Import records in chunks of chunk_size, each in its own
+    transaction. Returns how many records were imported this time."""
+    logger = logging.getLogger("%s.import_google_users" % (APP_NAME, ))
+    done = 0
+    if checkpoint_name is not None:
+        done = database.get_import_checkpoint(checkpoint_name)
+        if done:
+            logger.info("resuming import '%s' after %s records" % (checkpoint_name, done))
+            records = islice(records, done, None)
+    imported = 0
+    start_time = time.time()
+    while True:
+        rows = [record_to_row(database, record) for record in islice(records, chunk_size)]
+        if not rows:
+            break
+        done += len(rows)
+        database.import_google_users(rows,
+                                     on_conflict = on_conflict,
+                                     checkpoint_name = checkpoint_name,
+                                     checkpoint_rows = done)
+        imported += len(rows)
+        logger.info("imported %s records, %.0f/s" % (imported, imported / max(time.time() - start_time, 1e-6)))
+    return imported
+
+def export_google_users(database):
+    for row in database.export_google_users():
+        record = dict(zip(GOOGLE_USER_FIELDS, row))
+        if isinstance(record["user_id"], buffer):
+            record["user_id"] = authauth_view_utilities.convert_uuid_bytes_to_string(record["user_id"])
+        yield record
+
+def get_args():
+    parser = argparse.ArgumentParser("Import Google users into, or export them from, an authauth_model database.")
+    parser.add_argument("--database_filepath",
+                        dest="database_filepath",
+                        metavar="FILEPATH",
+                        required=True,
+                        help="Full path to the database filepath to use.")
+    parser.add_argument("--format",
+                        dest="format",
+                        choices=FORMATS,
+                        default=None,
+                        help="Format of the file. By default guessed from its extension, and CSV if it has none we know.")
+    parser.add_argument("--verbose",
+                        dest="verbose",
+                        action='store_true',
+                        default=False,
+                        help="Enable verbose debug mode.")
+    subparsers = parser.add_subparsers(dest="command")
+
+    import_parser = subparsers.add_parser("import", help="Import Google users from a file.")
+    import_parser.add_argument("filepath",
+                               metavar="FILEPATH",
+                               help="File to read, or - for standard input.")
+    import_parser.add_argument("--chunk_size",
+                               dest="chunk_size",
+                               type=int,
+                               default=CHUNK_SIZE,
+                               help="Records written per transaction.")
+    import_parser.add_argument("--on_conflict",
+                               dest="on_conflict",
+                               choices=authauth_model_database.Database.CONFLICT_POLICIES,
+                               default="ABORT",
+                               help="What to do with a record whose email is already taken: stop, skip it, or overwrite the existing user.")
+    import_parser.add_argument("--checkpoint",
+                               dest="checkpoint",
+                               metavar="NAME",
+                               default=None,
+                               help="Record progress under this name, and skip records already imported under it.")
+    import_parser.add_argument("--synchronous",
+                               dest="synchronous",
+                               choices=authauth_model_database.Database.SYNCHRONOUS_LEVELS,
+                               default=None,
+                               help="SQLite synchronous level for the import.")
+
+    export_parser = subparsers.add_parser("export", help="Export every Google user to a file.")
+    export_parser.add_argument("filepath",
+                               metavar="FILEPATH",
+                               help="File to write, or - for standard output.")
+    args = parser.parse_args()
+    return args
+
+def main():
+    args = get_args()
+    if args.verbose:
+        logger.setLevel(logging.DEBUG)
+        ch.setLevel(logging.DEBUG)
+        logger.debug("Verbose mode enabled")
+    file_format = args.format or guess_format(args.filepath)
+    database = authauth_model_database.Database(args.database_filepath,
+                                                busy_timeout = 5000)
+    try:
+        if args.command == "import":
+            database.configure(synchronous = args.synchronous)
+            with open_input(args.filepath) as f:
+                imported = import_google_users(database,
+                                               READERS[file_format](f),
+                                               chunk_size = args.chunk_size,
+                                               on_conflict = args.on_conflict,
+                                               checkpoint_name = args.checkpoint)
+            logger.info("imported %s records from %s" % (imported, args.filepath))
+        else:
+            with open_output(args.filepath) as f:
+                WRITERS[file_format](f, export_google_users(database))
+    finally:
+        database.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python2.7
+
+# ---------------------------------------------------------------------------
+# Copyright (c) 2012 Asim Ihsan (asim dot ihsan at gmail dot com)
+# Distributed under the MIT/X11 software license, see the accompanying
+# file license.txt or http://www.opensource.org/licenses/mit-license.php.
+# ---------------------------------------------------------------------------
+
+# ---------------------------------------------------------------------------
+#   authauth_model_cache.py: a bounded in-process cache with least recently
+#   used eviction and an optional time to live per entry.
+# ---------------------------------------------------------------------------
+
+import time
+from collections import OrderedDict
+
+# Returned by LRUCache.get() when a key isn't cached, as None is a
+# perfectly good value to cache.
+MISSING = object()
+
+class LRUCache(object):
+    def __init__(self, max_size, ttl = None):
+        """ max_size is the most entries we hold before evicting the least
+        recently used. ttl, if not None, is how many seconds an entry
+        lives for before we treat it as missing."""
+        assert(max_size > 0)
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        """ Return the value cached for key, or MISSING."""
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            self.misses += 1
+            return MISSING
+        (expires_at, value) = entry
+        if expires_at is not None and expires_at < time.time():
+            self.misses += 1
+            return MISSING
+        self.entries[key] = entry
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        if self.ttl is None:
+            expires_at = None
+        else:
+            expires_at = time.time() + self.ttl
+        self.entries.pop(key, None)
+        self.entries[key] = (expires_at, value)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last = False)
+
+    def invalidate(self, key):
+        self.entries.pop(key, None)
+
+    def clear(self):
+        self.entries.clear()
+
+    def keys(self):
+        """ Cached keys, least recently used first."""
+        return self.entries.keys()
+
+    def as_dict(self):
+        return {"size": len(self.entries),
+                "max_size": self.max_size,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses}
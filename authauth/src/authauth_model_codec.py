@@ -0,0 +1,75 @@
+#!/usr/bin/env python2.7
+
+# ---------------------------------------------------------------------------
+# Copyright (c) 2012 Asim Ihsan (asim dot ihsan at gmail dot com)
+# Distributed under the MIT/X11 software license, see the accompanying
+# file license.txt or http://www.opensource.org/licenses/mit-license.php.
+# ---------------------------------------------------------------------------
+
+# ---------------------------------------------------------------------------
+#   authauth_model_codec.py: encoding and decoding of authauth_model wire
+#   messages.
+#
+#   Every message is a map carrying a "version" field. Version 1.0 messages
+#   are JSON. Version 1.1 messages are msgpack, which is both smaller and
+#   cheaper to encode and decode, and is only available if the msgpack
+#   module is installed.
+#
+#   We can tell the two encodings apart from the first byte of a message
+#   (a JSON object starts with '{', a msgpack map never does), so a client
+#   may send either. The version a client puts in its request is the
+#   version it wants back; if we don't support that version we reply with
+#   1.0 and the client can tell from the reply's own "version" field.
+# ---------------------------------------------------------------------------
+
+import json
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+VERSION_JSON = "1.0"
+VERSION_MSGPACK = "1.1"
+DEFAULT_VERSION = VERSION_JSON
+
+SUPPORTED_VERSIONS = [VERSION_JSON]
+if msgpack is not None:
+    SUPPORTED_VERSIONS.append(VERSION_MSGPACK)
+
+# Bytes a JSON-encoded message may start with.
+JSON_LEADING_BYTES = set("{ \t\r\n")
+
+def decode(data):
+    """ Decode a message. data may be a string or a memoryview onto a
+    received frame; msgpack decodes straight out of the frame, JSON needs
+    a copy. Raises ValueError if the message can't be decoded."""
+    if isinstance(data, memoryview):
+        first_byte = data[0] if len(data) else ""
+    else:
+        first_byte = data[:1]
+    if first_byte in JSON_LEADING_BYTES:
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        return json.loads(data)
+    if msgpack is None:
+        raise ValueError("message is not JSON and msgpack is not available")
+    try:
+        return msgpack.unpackb(data, raw = False)
+    except Exception as e:
+        raise ValueError("message could not be decoded: %s" % (e, ))
+
+def negotiate_version(message):
+    """ Return the version we should reply to this message with."""
+    version = message.get("version", DEFAULT_VERSION)
+    if version not in SUPPORTED_VERSIONS:
+        version = DEFAULT_VERSION
+    return version
+
+def encode(message, version = DEFAULT_VERSION):
+    if version == VERSION_MSGPACK:
+        # Strings go as msgpack raw, whichever msgpack we have: newer ones
+        # default to sending our byte strings as bin, which clients
+        # decoding raw as UTF-8 would hand back as bytes.
+        return msgpack.packb(message, use_bin_type = False)
+    return json.dumps(message)
@@ -10,40 +10,43 @@ import os
 import sys
 import apsw
 import uuid
+import time
+import json
+
+from authauth_model_cache import LRUCache, MISSING
+from authauth_model_bloom import BloomFilter
+from authauth_model_roles import RoleTable, parse_privileges, format_privileges
+from authauth_view_utilities import convert_uuid_bytes_to_string, convert_uuid_string_to_bytes
 
 import logging
 APP_NAME = "authauth_model.db"
 logger = logging.getLogger(APP_NAME)
 
-class GoogleUser(object):
-    keys = ["email",
-            "user_id",
-            "first_name",
-            "last_name",
-            "name",
-            "locale"]
-    def __init__(self,
-                 email,
-                 user_id,
-                 first_name = None,
-                 last_name = None,
-                 name = None,
-                 locale = None):
-        self.email = email
-        self.user_id = user_id
-        self.first_name = first_name
-        self.last_name = last_name
-        self.name = name
-        self.locale = locale
-
-    def __str__(self):
-        items = [(key, getattr(self, key)) for key in self.keys]
-        item_repr = ", ".join(["%s=%s" % (key, value) for (key, value) in items])
-        return "{GoogleUser: %s}" % (item_repr)
+# The fields of a Google user as the bulk import and export tool sees them.
+GOOGLE_USER_FIELDS = ["email",
+                      "user_id",
+                      "first_name",
+                      "last_name",
+                      "name",
+                      "locale"]
+
+# What a user is given when they first log in.
+DEFAULT_ROLE_ID = "regular"
 
 class Database(object):
     # ----------------------------------------------------------------------
     # Tables.
+    #
+    # Every way of logging in, whatever the provider, is a row in identity
+    # keyed by (provider, external_id), e.g. ("google", email) or
+    # ("twitter", username). identity is clustered on that key, so finding
+    # the user_id for a login is one B-tree search in one index, which
+    # stays hot in the page cache however many providers we support.
+    # Whatever else a provider tells us about a user lives in a side table
+    # keyed by the same external_id.
+    #
+    # Table definitions are templates over how user IDs are stored; see
+    # create_tables().
     # ----------------------------------------------------------------------
     # Role
     DROP_ROLE_TABLE = """DROP TABLE IF EXISTS role;"""
@@ -55,47 +58,113 @@ class Database(object):
     # User
     DROP_USER_TABLE = """DROP TABLE IF EXISTS user;"""
     CREATE_USER_TABLE = """CREATE TABLE user (
-        user_id TEXT PRIMARY KEY,
-        role_id TEXT NOT NULL);"""
+        user_id %(user_id_type)s PRIMARY KEY,
+        role_id TEXT NOT NULL)%(table_options)s;"""
+
+    # Identity
+    DROP_IDENTITY_TABLE = """DROP TABLE IF EXISTS identity;"""
+    CREATE_IDENTITY_TABLE = """CREATE TABLE identity (
+        provider TEXT NOT NULL,
+        external_id TEXT NOT NULL,
+        user_id %(user_id_type)s NOT NULL,
+        PRIMARY KEY (provider, external_id)) WITHOUT ROWID;"""
 
     # Google authentication details
     DROP_AUTH_GOOGLE_TABLE = """DROP TABLE IF EXISTS auth_google;"""
     CREATE_AUTH_GOOGLE_TABLE = """CREATE TABLE auth_google (
         email TEXT PRIMARY KEY,
-        user_id TEXT UNIQUE NOT NULL,
         first_name TEXT,
         last_name TEXT,
         name TEXT,
-        locale TEXT);"""
+        locale TEXT)%(table_options)s;"""
+
+    # Twitter authentication details
+    DROP_AUTH_TWITTER_TABLE = """DROP TABLE IF EXISTS auth_twitter;"""
+    CREATE_AUTH_TWITTER_TABLE = """CREATE TABLE auth_twitter (
+        username TEXT PRIMARY KEY,
+        profile_image_url TEXT)%(table_options)s;"""
+
+    # Facebook authentication details
+    DROP_AUTH_FACEBOOK_TABLE = """DROP TABLE IF EXISTS auth_facebook;"""
+    CREATE_AUTH_FACEBOOK_TABLE = """CREATE TABLE auth_facebook (
+        facebook_id TEXT PRIMARY KEY,
+        link TEXT,
+        access_token TEXT,
+        locale TEXT,
+        first_name TEXT,
+        last_name TEXT,
+        name TEXT,
+        picture TEXT)%(table_options)s;"""
+
+    # List access control: each row grants one user some actions on one
+    # list, stored as a role's privileges are. Clustered on (list_id,
+    # user_id), so reading a list's whole ACL is one range scan.
+    DROP_LIST_ACL_TABLE = """DROP TABLE IF EXISTS list_acl;"""
+    CREATE_LIST_ACL_TABLE = """CREATE TABLE IF NOT EXISTS list_acl (
+        list_id TEXT NOT NULL,
+        user_id %(user_id_type)s NOT NULL,
+        actions TEXT NOT NULL,
+        PRIMARY KEY (list_id, user_id))%(table_options)s;"""
+
+    # Access versions: a counter for the roles, bumped by a trigger
+    # whenever a role or a user's role changes or a user goes, and one for
+    # the lists' ACLs, bumped whenever an ACL changes. Triggers, so that
+    # every connection's writes count, not just ours.
+    CREATE_ACCESS_VERSION_TABLE = """CREATE TABLE IF NOT EXISTS access_version (
+        name TEXT PRIMARY KEY,
+        version INTEGER NOT NULL);"""
+    INITIALIZE_ACCESS_VERSIONS = """INSERT OR IGNORE INTO access_version (name, version) VALUES ('role', 0), ('list_acl', 0);"""
+    CREATE_ACCESS_VERSION_TRIGGER = """CREATE TRIGGER IF NOT EXISTS %s_version AFTER %s BEGIN
+        UPDATE access_version SET version = version + 1 WHERE name = '%s';
+        END;"""
+    ACCESS_VERSION_STATEMENTS = [CREATE_ACCESS_VERSION_TABLE, INITIALIZE_ACCESS_VERSIONS] + \
+                                [CREATE_ACCESS_VERSION_TRIGGER % trigger for trigger in [
+                                    ("role_insert", "INSERT ON role", "role"),
+                                    ("role_update", "UPDATE ON role", "role"),
+                                    ("role_delete", "DELETE ON role", "role"),
+                                    ("user_role_update", "UPDATE OF role_id ON user", "role"),
+                                    ("user_delete", "DELETE ON user", "role"),
+                                    ("list_acl_insert", "INSERT ON list_acl", "list_acl"),
+                                    ("list_acl_update", "UPDATE ON list_acl", "list_acl"),
+                                    ("list_acl_delete", "DELETE ON list_acl", "list_acl")]]
+
+    # Identity sequence: every identity inserted, by any connection, in
+    # the order they went in, so that a Bloom filter of them can be kept
+    # up to date by reading just the rows after the last one it saw.
+    # identity is WITHOUT ROWID, so it can't tell us that itself. Only the
+    # last IDENTITY_SEQUENCES_KEPT or so are kept; whoever falls further
+    # behind than that starts again from identity.
+    IDENTITY_SEQUENCES_KEPT = 100000
+    CREATE_IDENTITY_SEQUENCE_TABLE = """CREATE TABLE IF NOT EXISTS identity_sequence (
+        sequence INTEGER PRIMARY KEY AUTOINCREMENT,
+        provider TEXT NOT NULL,
+        external_id TEXT NOT NULL);"""
+    CREATE_IDENTITY_SEQUENCE_TRIGGER = """CREATE TRIGGER IF NOT EXISTS identity_insert_sequence AFTER INSERT ON identity BEGIN
+        INSERT INTO identity_sequence (provider, external_id) VALUES (NEW.provider, NEW.external_id);
+        END;"""
+    IDENTITY_SEQUENCE_STATEMENTS = [CREATE_IDENTITY_SEQUENCE_TABLE, CREATE_IDENTITY_SEQUENCE_TRIGGER]
 
     INSERT_STATEMENTS = [ \
                          DROP_ROLE_TABLE,
                          CREATE_ROLE_TABLE,
                          DROP_USER_TABLE,
                          CREATE_USER_TABLE,
+                         DROP_IDENTITY_TABLE,
+                         CREATE_IDENTITY_TABLE,
                          DROP_AUTH_GOOGLE_TABLE,
                          CREATE_AUTH_GOOGLE_TABLE,
-                         #DROP_AUTH_FACEBOOK_TABLE,
-                         #CREATE_AUTH_FACEBOOK_TABLE,
-                         #DROP_AUTH_TWITTER_TABLE,
-                         #CREATE_AUTH_TWITTER_TABLE,
-                         #DROP_AUTH_BROWSERID_TABLE,
-                         #CREATE_AUTH_BROWSERID_TABLE,
-                         #DROP_AUTH_API_TABLE,
-                         #CREATE_AUTH_API_TABLE,
-                         #DROP_LIST_TABLE,
-                         #CREATE_LIST_TABLE,
+                         DROP_AUTH_TWITTER_TABLE,
+                         CREATE_AUTH_TWITTER_TABLE,
+                         DROP_AUTH_FACEBOOK_TABLE,
+                         CREATE_AUTH_FACEBOOK_TABLE,
+                         DROP_LIST_ACL_TABLE,
+                         CREATE_LIST_ACL_TABLE,
                         ]
 
     # ----------------------------------------------------------------------
     # Indexes.
     # ----------------------------------------------------------------------
-    INDEX_USER_ID_ON_AUTH_GOOGLE = """CREATE INDEX user_id_on_auth_google on auth_google(user_id);"""
-    #INDEX_LIST_ID_ON_LIST = """CREATE INDEX list_id_on_list on list(list_id);"""
-    INDEX_STATEMENTS = [ \
-                        INDEX_USER_ID_ON_AUTH_GOOGLE,
-                        #INDEX_LIST_ID_ON_LIST,
-                       ]
+    INDEX_STATEMENTS = []
     # ----------------------------------------------------------------------
 
     # ----------------------------------------------------------------------
@@ -104,74 +173,1165 @@ class Database(object):
     FOREIGN_KEY_STATEMENTS = []
     # ----------------------------------------------------------------------
 
-    ALL_STATEMENTS = INSERT_STATEMENTS + INDEX_STATEMENTS + FOREIGN_KEY_STATEMENTS
+    ALL_STATEMENTS = INSERT_STATEMENTS + INDEX_STATEMENTS + FOREIGN_KEY_STATEMENTS + ACCESS_VERSION_STATEMENTS + IDENTITY_SEQUENCE_STATEMENTS
+
+    # ----------------------------------------------------------------------
+    # How user IDs are stored. Normally as 32 hex characters. Compact
+    # tables store the 16 bytes of the UUID instead, and every table is
+    # clustered on its natural key rather than on a hidden rowid.
+    # ----------------------------------------------------------------------
+    TABLE_FORMAT = {"user_id_type": "TEXT",
+                    "table_options": ""}
+    TABLE_FORMAT_COMPACT = {"user_id_type": "BLOB",
+                            "table_options": " WITHOUT ROWID"}
+    GET_TABLE_SQL = """SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?;"""
+    # ----------------------------------------------------------------------
+
+    # ----------------------------------------------------------------------
+    # Databases from before the identity table kept each Google user's
+    # user_id in auth_google, and had nothing in user. Move them over.
+    # ----------------------------------------------------------------------
+    MIGRATE_TO_IDENTITY_STATEMENTS = [ \
+        """INSERT OR IGNORE INTO user (user_id, role_id) SELECT user_id, '%s' FROM auth_google;""" % (DEFAULT_ROLE_ID, ),
+        """INSERT INTO identity (provider, external_id, user_id) SELECT 'google', email, user_id FROM auth_google;""",
+        """ALTER TABLE auth_google RENAME TO auth_google_unmigrated;""",
+        CREATE_AUTH_GOOGLE_TABLE,
+        """INSERT INTO auth_google (email, first_name, last_name, name, locale) SELECT email, first_name, last_name, name, locale FROM auth_google_unmigrated;""",
+        """DROP TABLE auth_google_unmigrated;""",
+        DROP_AUTH_TWITTER_TABLE,
+        CREATE_AUTH_TWITTER_TABLE,
+        DROP_AUTH_FACEBOOK_TABLE,
+        CREATE_AUTH_FACEBOOK_TABLE,
+    ]
+    # ----------------------------------------------------------------------
 
     # ------------------------------------------------------------------------
     #   Database statements related to user authentication and CRUD.
     # ------------------------------------------------------------------------
-    GET_USER_ID_FROM_GOOGLE_EMAIL = """SELECT user_id FROM auth_google WHERE email = ?;"""
-    CREATE_AUTH_GOOGLE = """INSERT INTO auth_google (email, user_id, first_name, last_name, name, locale) VALUES (?, ?, ?, ?, ?, ?);"""
+    PROVIDERS = ["google", "browserid", "twitter", "facebook", "api"]
+    GET_USER_ID = """SELECT user_id FROM identity WHERE provider = ? AND external_id = ?;"""
+    CREATE_USER = """INSERT INTO user (user_id, role_id) VALUES (?, ?);"""
+    CREATE_IDENTITY = """INSERT INTO identity (provider, external_id, user_id) VALUES (?, ?, ?);"""
+    CREATE_IDENTITY_IF_MISSING = """INSERT OR IGNORE INTO identity (provider, external_id, user_id) VALUES (?, ?, ?);"""
+
+    # Providers with a side table, the profile fields it holds after the
+    # external_id, and how to fill it in.
+    PROFILE_FIELDS = {"google": ["first_name", "last_name", "name", "locale"],
+                      "twitter": ["profile_image_url"],
+                      "facebook": ["link", "access_token", "locale", "first_name", "last_name", "name", "picture"]}
+    CREATE_PROFILE = {"google": """INSERT INTO auth_google (email, first_name, last_name, name, locale) VALUES (?, ?, ?, ?, ?);""",
+                      "twitter": """INSERT INTO auth_twitter (username, profile_image_url) VALUES (?, ?);""",
+                      "facebook": """INSERT INTO auth_facebook (facebook_id, link, access_token, locale, first_name, last_name, name, picture) VALUES (?, ?, ?, ?, ?, ?, ?, ?);"""}
+
+    # Moving users between shards. A user record is an identity with its
+    # user's role and the values of its provider's PROFILE_FIELDS, if any.
+    GET_FIRST_IDENTITIES = """SELECT provider, external_id FROM identity ORDER BY provider, external_id LIMIT ?;"""
+    GET_IDENTITIES_AFTER = """SELECT provider, external_id FROM identity WHERE provider > ? OR (provider = ? AND external_id > ?) ORDER BY provider, external_id LIMIT ?;"""
+    GET_USER_RECORD = """SELECT identity.user_id, user.role_id FROM identity LEFT JOIN user ON user.user_id = identity.user_id WHERE identity.provider = ? AND identity.external_id = ?;"""
+    GET_PROFILE = {"google": """SELECT first_name, last_name, name, locale FROM auth_google WHERE email = ?;""",
+                   "twitter": """SELECT profile_image_url FROM auth_twitter WHERE username = ?;""",
+                   "facebook": """SELECT link, access_token, locale, first_name, last_name, name, picture FROM auth_facebook WHERE facebook_id = ?;"""}
+    REPLACE_USER = """INSERT OR REPLACE INTO user (user_id, role_id) VALUES (?, ?);"""
+    REPLACE_IDENTITY = """INSERT OR REPLACE INTO identity (provider, external_id, user_id) VALUES (?, ?, ?);"""
+    REPLACE_PROFILE = dict((provider, statement.replace("INSERT INTO", "INSERT OR REPLACE INTO"))
+                           for (provider, statement) in CREATE_PROFILE.iteritems())
+
+    # Moving lists' ACLs between shards, a whole list at a time.
+    GET_FIRST_LIST_IDS = """SELECT DISTINCT list_id FROM list_acl ORDER BY list_id LIMIT ?;"""
+    GET_LIST_IDS_AFTER = """SELECT DISTINCT list_id FROM list_acl WHERE list_id > ? ORDER BY list_id LIMIT ?;"""
+    DELETE_LIST_ACL = """DELETE FROM list_acl WHERE list_id = ?;"""
+    DELETE_USER = """DELETE FROM user WHERE user_id = ?;"""
+    DELETE_IDENTITY = """DELETE FROM identity WHERE provider = ? AND external_id = ?;"""
+    DELETE_PROFILE = {"google": """DELETE FROM auth_google WHERE email = ?;""",
+                      "twitter": """DELETE FROM auth_twitter WHERE username = ?;""",
+                      "facebook": """DELETE FROM auth_facebook WHERE facebook_id = ?;"""}
+
+    # Bulk lookups load the identities into a temporary table and join it
+    # against identity, so any number of them costs one query.
+    CREATE_IDENTITY_LOOKUP_TABLE = """CREATE TEMP TABLE IF NOT EXISTS identity_lookup (
+        position INTEGER PRIMARY KEY,
+        provider TEXT NOT NULL,
+        external_id TEXT NOT NULL);"""
+    INSERT_IDENTITY_LOOKUP = """INSERT INTO identity_lookup (position, provider, external_id) VALUES (?, ?, ?);"""
+    GET_USER_IDS_FROM_IDENTITY_LOOKUP = """SELECT identity_lookup.position, identity.user_id FROM identity_lookup JOIN identity ON identity.provider = identity_lookup.provider AND identity.external_id = identity_lookup.external_id;"""
+    EMPTY_IDENTITY_LOOKUP_TABLE = """DELETE FROM identity_lookup;"""
+
+    # Feeding the Bloom filter: all of identity when we build one, then
+    # whatever identity_sequence says has been inserted since.
+    COUNT_IDENTITIES = """SELECT COUNT(*) FROM identity;"""
+    GET_IDENTITIES = """SELECT provider, external_id FROM identity;"""
+    GET_IDENTITY_SEQUENCES = """SELECT MIN(sequence), MAX(sequence) FROM identity_sequence;"""
+    GET_IDENTITY_SEQUENCES_AFTER = """SELECT sequence, provider, external_id FROM identity_sequence WHERE sequence > ? ORDER BY sequence;"""
+    TRIM_IDENTITY_SEQUENCES = """DELETE FROM identity_sequence WHERE sequence <= (SELECT MAX(sequence) FROM identity_sequence) - ?;"""
+
+    # Bulk import and export. Imports record how many rows of their input
+    # they've committed in the same transaction as the rows themselves, so
+    # an interrupted import can carry on where it left off.
+    CONFLICT_POLICIES = ["ABORT", "IGNORE", "REPLACE"]
+    IMPORT_GOOGLE_IDENTITY = """INSERT OR %s INTO identity (provider, external_id, user_id) VALUES ('google', ?, ?);"""
+    IMPORT_GOOGLE_USER = """INSERT OR IGNORE INTO user (user_id, role_id) SELECT user_id, ? FROM identity WHERE provider = 'google' AND external_id = ?;"""
+    IMPORT_AUTH_GOOGLE = """INSERT OR %s INTO auth_google (email, first_name, last_name, name, locale) VALUES (?, ?, ?, ?, ?);"""
+    EXPORT_GOOGLE_USERS = """SELECT identity.external_id, identity.user_id, auth_google.first_name, auth_google.last_name, auth_google.name, auth_google.locale FROM identity LEFT JOIN auth_google ON auth_google.email = identity.external_id WHERE identity.provider = 'google' ORDER BY identity.external_id;"""
+    CREATE_IMPORT_CHECKPOINT_TABLE = """CREATE TABLE IF NOT EXISTS import_checkpoint (
+        name TEXT PRIMARY KEY,
+        rows INTEGER NOT NULL);"""
+    GET_IMPORT_CHECKPOINT = """SELECT rows FROM import_checkpoint WHERE name = ?;"""
+    SET_IMPORT_CHECKPOINT = """INSERT OR REPLACE INTO import_checkpoint (name, rows) VALUES (?, ?);"""
+
+    # ------------------------------------------------------------------------
+    #   Connection settings. Values are validated by the caller, as PRAGMAs
+    #   don't take bound parameters.
+    # ------------------------------------------------------------------------
+    JOURNAL_MODES = ["DELETE", "TRUNCATE", "PERSIST", "MEMORY", "WAL", "OFF"]
+    SYNCHRONOUS_LEVELS = ["OFF", "NORMAL", "FULL", "EXTRA"]
+    SET_JOURNAL_MODE = """PRAGMA journal_mode = %s;"""
+    SET_SYNCHRONOUS = """PRAGMA synchronous = %s;"""
+    SET_MMAP_SIZE = """PRAGMA mmap_size = %d;"""
+    SET_CACHE_SIZE = """PRAGMA cache_size = %d;"""
+    WAL_CHECKPOINT = """PRAGMA wal_checkpoint(PASSIVE);"""
+    OPTIMIZE = """PRAGMA optimize;"""
+
+    # ------------------------------------------------------------------------
+    #   The change log. With change_log on, every write to the users also
+    #   appends a row here per identity it touched, in the same
+    #   transaction, so that caches elsewhere can find out what to forget.
+    #   AUTOINCREMENT means a sequence number is never reused, even once
+    #   the rows before it have been trimmed away. change_type is one of
+    #   CHANGE_TYPES. "role" and "user_role" changes have "role" as their
+    #   provider and the role_id as their external_id; a "user_role" change
+    #   has the user_id of the user given the role.
+    # ------------------------------------------------------------------------
+    CHANGE_TYPES = ["add", "replace", "delete", "role", "user_role"]
+    CREATE_CHANGE_LOG_TABLE = """CREATE TABLE IF NOT EXISTS change_log (
+        sequence INTEGER PRIMARY KEY AUTOINCREMENT,
+        change_type TEXT NOT NULL,
+        provider TEXT NOT NULL,
+        external_id TEXT NOT NULL,
+        user_id %(user_id_type)s,
+        changed_at REAL NOT NULL);"""
+    LOG_CHANGE = """INSERT INTO change_log (change_type, provider, external_id, user_id, changed_at) VALUES (?, ?, ?, ?, ?);"""
+    GET_CHANGES_AFTER = """SELECT sequence, change_type, provider, external_id, user_id, changed_at FROM change_log WHERE sequence > ? ORDER BY sequence LIMIT ?;"""
+    GET_CHANGE_SEQUENCES = """SELECT MIN(sequence), MAX(sequence) FROM change_log;"""
+    TRIM_CHANGE_LOG = """DELETE FROM change_log WHERE sequence <= (SELECT MAX(sequence) FROM change_log) - ?;"""
+
+    # ------------------------------------------------------------------------
+    #   Snapshots for read replicas. Each records when it was taken, so a
+    #   replica serving it can tell how stale it is.
+    # ------------------------------------------------------------------------
+    SNAPSHOT_PAGES_PER_STEP = 256
+    DROP_SNAPSHOT_TABLE = """DROP TABLE IF EXISTS snapshot;"""
+    CREATE_SNAPSHOT_TABLE = """CREATE TABLE snapshot (taken_at REAL NOT NULL);"""
+    SET_SNAPSHOT_TIME = """INSERT INTO snapshot (taken_at) VALUES (?);"""
+    GET_SNAPSHOT_TIME = """SELECT taken_at FROM snapshot;"""
+
+    # ------------------------------------------------------------------------
+    #   Roles and authorization. See authauth_model_roles for how a role's
+    #   privileges are stored and checked.
+    # ------------------------------------------------------------------------
+    GET_ROLES = """SELECT role_id, privileges FROM role;"""
+    SET_ROLE = """INSERT OR REPLACE INTO role (role_id, role_name, privileges) VALUES (?, ?, ?);"""
+    GET_USER_ROLE = """SELECT role_id FROM user WHERE user_id = ?;"""
+    SET_USER_ROLE = """UPDATE user SET role_id = ? WHERE user_id = ?;"""
+    GET_LIST_ACL = """SELECT user_id, actions FROM list_acl WHERE list_id = ?;"""
+    SET_LIST_ACCESS = """INSERT OR REPLACE INTO list_acl (list_id, user_id, actions) VALUES (?, ?, ?);"""
+    DELETE_LIST_ACCESS = """DELETE FROM list_acl WHERE list_id = ? AND user_id = ?;"""
+    GET_ACCESS_VERSIONS = """SELECT name, version FROM access_version;"""
+    GET_DATA_VERSION = """PRAGMA data_version;"""
+
+    # The smallest Bloom filter we build, so an empty database doesn't get
+    # a filter that's full after its first few signups.
+    MINIMUM_IDENTITY_FILTER_CAPACITY = 1024
 
-    def __init__(self, filepath, empty_database = False):
+    def __init__(self, filepath, empty_database = False, busy_timeout = None, cache_size = 0, cache_ttl = None, false_positive_rate = None, compact_user_ids = False, read_only = False, change_log = False, role_cache_size = 0, acl_cache_size = 0):
         self.filepath = filepath
+
+        # An authauth_model_stats.Stats to record statement latencies in,
+        # if anyone is interested.
+        self.stats = None
+
+        # (provider, external_id) to user_id. We only cache users that
+        # exist: another process sharing the database may add a user at
+        # any time, and a cached miss would hide them until it expired. A
+        # user_id never changes once assigned, so a cached hit is only ever
+        # stale in that the TTL lets us drop it eventually.
+        if cache_size > 0:
+            self.user_id_cache = LRUCache(cache_size, cache_ttl)
+        else:
+            self.user_id_cache = None
+
+        # A read-only database, e.g. a replica's snapshot, must already
+        # have its tables.
+        self.read_only = read_only
         if empty_database:
+            assert(not read_only)
             self.empty_database()
-        self.connection = apsw.Connection(self.filepath)
-        if empty_database:
+        if read_only:
+            self.connection = apsw.Connection(self.filepath, flags = apsw.SQLITE_OPEN_READONLY)
+        else:
+            self.connection = apsw.Connection(self.filepath)
+        self.journal_mode = None
+        self.busy_timeout = busy_timeout
+        self.mmap_size = None
+        self.page_cache_size = None
+        if busy_timeout is not None:
+            self.connection.setbusytimeout(busy_timeout)
+
+        # An authauth_model_executor.DatabaseExecutor to run our SQL on
+        # native threads, or None to run it in the calling thread. See
+        # run_read() and run_write().
+        self.executor = None
+        # Whether user IDs are stored as 16-byte BLOBs in WITHOUT ROWID
+        # tables. We only get to choose when creating the tables; an
+        # existing database keeps the layout it was created with.
+        self.compact_user_ids = compact_user_ids
+        rows = []
+        if not empty_database:
+            rows = self.execute_statement(self.GET_TABLE_SQL, ("user", )).fetchall()
+        if len(rows) == 0:
+            # Empty, or a new file, e.g. a new shard.
             self.create_tables()
+        else:
+            self.compact_user_ids = "WITHOUT ROWID" in rows[0][0].upper()
+            if len(self.execute_statement(self.GET_TABLE_SQL, ("identity", )).fetchall()) == 0:
+                self.migrate_to_identity_table()
+            if not read_only:
+                self.execute_statement(self.CREATE_LIST_ACL_TABLE % self.get_table_format(), ())
+                for statement in self.ACCESS_VERSION_STATEMENTS + self.IDENTITY_SEQUENCE_STATEMENTS:
+                    self.execute_statement(statement, ())
+
+        # An authauth_model_index.IdentityIndex to look identities up in
+        # before trying SQLite, or None.
+        self.identity_index = None
+
+        # Whether we log changes; see CREATE_CHANGE_LOG_TABLE. The table is
+        # only created once someone asks for it.
+        self.change_log = change_log
+        if change_log and not read_only:
+            self.execute_statement(self.CREATE_CHANGE_LOG_TABLE % self.get_table_format(), ())
+
+        # A Bloom filter of every (provider, external_id) in the database,
+        # so that looking up one that isn't there needn't touch SQLite.
+        self.false_positive_rate = false_positive_rate
+        # identity_filter_sequence is the last identity_sequence it has seen.
+        self.identity_filter = None
+        self.identity_filter_sequence = None
+        self.identity_filter_rejections = 0
+        self.identity_filter_additions = None
+        if false_positive_rate:
+            self.refresh_identity_filter()
+
+        # Every role's privileges, compiled, and user_id to role_id for
+        # the users we've authorized lately, keyed by user_id as it goes
+        # over the wire. Another connection may change a role or a user's
+        # role at any time, so both start again from scratch whenever
+        # data_version says it has written and the roles' access version
+        # says that was to them; see refresh_roles(). access_versions are
+        # the versions we last saw. user_role_writes counts our writes to
+        # users' roles, as list_acl_writes below does for ACLs.
+        self.roles = None
+        self.roles_data_version = None
+        self.access_versions = {}
+        if role_cache_size > 0:
+            self.user_role_cache = LRUCache(role_cache_size)
+        else:
+            self.user_role_cache = None
+        self.user_role_writes = 0
+
+        # list_id to the ACL of each list we've checked lately, as a dict
+        # of user_id, as it goes over the wire, to the frozenset of
+        # actions they may take. A list's ACL is forgotten whenever we
+        # write to it; list_acl_writes counts those writes, so that a
+        # check that read an ACL while one happened doesn't cache what it
+        # read.
+        if acl_cache_size > 0:
+            self.list_acl_cache = LRUCache(acl_cache_size)
+        else:
+            self.list_acl_cache = None
+        self.list_acl_writes = 0
+        self.refresh_roles()
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.close()
+        if self.identity_index is not None:
+            self.identity_index.close()
+        self.connection.close()
 
     def empty_database(self):
         with open(self.filepath, "wb") as f:
             pass
+        # A write-ahead log left over from the old database would be
+        # replayed into the new one.
+        for suffix in ["-wal", "-shm"]:
+            if os.path.isfile(self.filepath + suffix):
+                os.remove(self.filepath + suffix)
+
+    def configure(self, journal_mode = None, synchronous = None, mmap_size = None, page_cache_size = None):
+        """ Set up the connection. Anything left as None keeps SQLite's
+        default. page_cache_size is in pages if positive and in KiB if
+        negative, as for PRAGMA cache_size."""
+        logger = logging.getLogger("%s.configure" % (APP_NAME, ))
+        if journal_mode is not None:
+            assert(journal_mode in self.JOURNAL_MODES)
+            rows = self.execute_statement(self.SET_JOURNAL_MODE % (journal_mode, ), ()).fetchall()
+            self.journal_mode = rows[0][0].upper()
+            if self.journal_mode != journal_mode:
+                logger.warning("asked for journal_mode %s but got %s" % (journal_mode, self.journal_mode))
+        if synchronous is not None:
+            assert(synchronous in self.SYNCHRONOUS_LEVELS)
+            self.execute_statement(self.SET_SYNCHRONOUS % (synchronous, ), ())
+        if mmap_size is not None:
+            self.execute_statement(self.SET_MMAP_SIZE % (mmap_size, ), ())
+            self.mmap_size = mmap_size
+        if page_cache_size is not None:
+            self.execute_statement(self.SET_CACHE_SIZE % (page_cache_size, ), ())
+            self.page_cache_size = page_cache_size
+
+    def open_read_connection(self, busy_timeout = None):
+        """ Another, read-only, connection to the database, set up like
+        ours, for an executor's read threads. busy_timeout is how long it
+        waits on a lock if we weren't given one."""
+        connection = apsw.Connection(self.filepath, flags = apsw.SQLITE_OPEN_READONLY)
+        if self.busy_timeout is not None:
+            busy_timeout = self.busy_timeout
+        if busy_timeout is not None:
+            connection.setbusytimeout(busy_timeout)
+        if self.mmap_size is not None:
+            self.execute_statement(self.SET_MMAP_SIZE % (self.mmap_size, ), (), connection)
+        if self.page_cache_size is not None:
+            self.execute_statement(self.SET_CACHE_SIZE % (self.page_cache_size, ), (), connection)
+        return connection
+
+    # ------------------------------------------------------------------------
+    #   Where SQL runs. Without an executor, function(connection, *args) is
+    #   simply called with our connection. With one, reads run on one of its
+    #   read threads, with that thread's own read-only connection, and
+    #   writes run on its one write thread with our connection; the calling
+    #   greenlet waits without blocking any other. Writes, and anything
+    #   that changes the Bloom filter, only ever happen on the write thread,
+    #   so they never race each other. The cache is only touched by the
+    #   caller.
+    # ------------------------------------------------------------------------
+    def run_read(self, function, *args):
+        if self.executor is None:
+            return function(self.connection, *args)
+        return self.executor.read(function, *args)
+
+    def run_write(self, function, *args):
+        if self.executor is None:
+            return function(self.connection, *args)
+        return self.executor.write(function, *args)
+
+    def checkpoint(self):
+        """ Copy as much of the write-ahead log into the database as we
+        can without waiting on readers or writers. Returns (busy, pages in
+        the log, pages checkpointed)."""
+        return self.run_write(self._checkpoint)
+
+    def _checkpoint(self, connection):
+        return tuple(self.execute_statement(self.WAL_CHECKPOINT, (), connection).fetchall()[0])
+
+    def optimize(self):
+        """ Let SQLite refresh the statistics its query planner relies on.
+        A no-op on SQLite older than 3.18."""
+        self.run_write(self._optimize)
+
+    def _optimize(self, connection):
+        self.execute_statement(self.OPTIMIZE, (), connection).fetchall()
+
+    def snapshot(self, filepath, pages_per_step = SNAPSHOT_PAGES_PER_STEP, pause = None):
+        """ Copy the database to filepath with SQLite's online backup API,
+        pages_per_step pages at a time, calling pause(), if given, between
+        steps so that requests aren't held up for the whole copy. Writes
+        made through our connection meanwhile are copied too. The copy is
+        built beside filepath and renamed over it once complete, so readers
+        of filepath only ever see a whole snapshot. Returns the time the
+        snapshot is up to date as of."""
+        logger = logging.getLogger("%s.snapshot" % (APP_NAME, ))
+        temporary_filepath = "%s.%s.tmp" % (filepath, os.getpid())
+        destination = apsw.Connection(temporary_filepath)
+        try:
+            backup = self.run_write(self._start_snapshot, destination)
+            try:
+                while not self.run_write(self._step_snapshot, backup, pages_per_step):
+                    if pause is not None:
+                        pause()
+            finally:
+                self.run_write(self._finish_snapshot, backup)
+            taken_at = time.time()
+
+            # Replicas open snapshots read-only, which they can't do with a
+            # write-ahead log.
+            self.execute_statement(self.SET_JOURNAL_MODE % ("DELETE", ), (), destination).fetchall()
+            with destination:
+                self.execute_statement(self.DROP_SNAPSHOT_TABLE, (), destination)
+                self.execute_statement(self.CREATE_SNAPSHOT_TABLE, (), destination)
+                self.execute_statement(self.SET_SNAPSHOT_TIME, (taken_at, ), destination)
+        except:
+            destination.close()
+            if os.path.isfile(temporary_filepath):
+                os.remove(temporary_filepath)
+            raise
+        destination.close()
+        os.rename(temporary_filepath, filepath)
+        logger.debug("wrote snapshot to %s" % (filepath, ))
+        return taken_at
+
+    def _start_snapshot(self, connection, destination):
+        return destination.backup("main", connection, "main")
+
+    def _step_snapshot(self, connection, backup, pages):
+        return backup.step(pages)
+
+    def _finish_snapshot(self, connection, backup):
+        backup.finish()
+
+    def get_snapshot_time(self):
+        """ When the snapshot we've opened was taken, or None if the
+        database isn't a snapshot."""
+        if len(self.execute_statement(self.GET_TABLE_SQL, ("snapshot", )).fetchall()) == 0:
+            return None
+        rows = self.execute_statement(self.GET_SNAPSHOT_TIME, ()).fetchall()
+        if len(rows) == 0:
+            return None
+        return rows[0][0]
+
+    def get_table_format(self):
+        if self.compact_user_ids:
+            return self.TABLE_FORMAT_COMPACT
+        return self.TABLE_FORMAT
 
     def create_tables(self):
+        table_format = self.get_table_format()
         for statement in self.ALL_STATEMENTS:
-            self.execute_statement(statement, ())
-
-    def execute_statement(self, statement, args):
-        logger = logging.getLogger("%s.execute_statement" % (APP_NAME, ))
-        logger.debug("entry. statement: %s, args: %s" % (statement, args))
-        cursor = self.connection.cursor()
-        return cursor.execute(statement, args)
-
-    def get_google_user(self, email):
-        logger = logging.getLogger("%s.get_google_user" % (APP_NAME, ))
-        cursor = self.execute_statement(self.GET_USER_ID_FROM_GOOGLE_EMAIL,
-                                        (email, ))
-        rows = cursor.fetchall()
+            self.execute_statement(statement % table_format, ())
+
+    def migrate_to_identity_table(self):
+        logger = logging.getLogger("%s.migrate_to_identity_table" % (APP_NAME, ))
+        table_format = self.get_table_format()
+        with self.connection:
+            self.execute_statement(self.CREATE_IDENTITY_TABLE % table_format, ())
+            for statement in self.MIGRATE_TO_IDENTITY_STATEMENTS:
+                self.execute_statement(statement % table_format, ())
+        logger.info("moved Google users into the identity table")
+
+    def user_id_from_bytes(self, user_id_bytes):
+        """ A user ID given as the 16 bytes of its UUID, in whichever form
+        we store them."""
+        if self.compact_user_ids:
+            return buffer(user_id_bytes)
+        return convert_uuid_bytes_to_string(user_id_bytes)
+
+    def user_id_from_string(self, user_id):
+        """ A user ID as it goes over the wire, in whichever form we store
+        them. Raises ValueError if we store them as bytes and it isn't a
+        UUID."""
+        if self.compact_user_ids:
+            return buffer(convert_uuid_string_to_bytes(user_id))
+        return user_id
+
+    def user_id_to_string(self, user_id):
+        """ A user ID as we store it, as it goes over the wire."""
+        if isinstance(user_id, buffer):
+            return convert_uuid_bytes_to_string(user_id)
+        return user_id
+
+    def new_user_id(self):
+        """ A new random user ID, in whichever form we store them."""
+        if self.compact_user_ids:
+            return buffer(uuid.uuid4().bytes)
+        return uuid.uuid4().hex
+
+    def _on_executor_thread(self, connection):
+        # With an executor, run_read and run_write hand their functions a
+        # connection on one of its threads. Logging's locks are gevent's
+        # once we're patched, and taking one off the hub's thread can hang
+        # the hub, so statements there go unlogged.
+        return connection is not None and self.executor is not None
+
+    def execute_statement(self, statement, args, connection = None):
+        if not self._on_executor_thread(connection):
+            logger = logging.getLogger("%s.execute_statement" % (APP_NAME, ))
+            logger.debug("entry. statement: %s, args: %s" % (statement, args))
+        start_time = time.time()
+        cursor = (connection or self.connection).cursor()
+        rv = cursor.execute(statement, args)
+        if self.stats is not None:
+            self.stats.record_statement(statement, time.time() - start_time)
+        return rv
+
+    def execute_many(self, statement, args_sequence, connection = None):
+        if not self._on_executor_thread(connection):
+            logger = logging.getLogger("%s.execute_many" % (APP_NAME, ))
+            logger.debug("entry. statement: %s" % (statement, ))
+        start_time = time.time()
+        cursor = (connection or self.connection).cursor()
+        rv = cursor.executemany(statement, args_sequence)
+        if self.stats is not None:
+            self.stats.record_statement(statement, time.time() - start_time)
+        return rv
+
+    def identity_filter_key(self, provider, external_id):
+        return u"%s:%s" % (provider, external_id)
+
+    def add_to_identity_filter(self, identities):
+        """ Add (provider, external_id) pairs to the Bloom filter, if we
+        have one, and to the one being built, if we're building one."""
+        keys = [self.identity_filter_key(provider, external_id) for (provider, external_id) in identities]
+        # Recorded before they're added, so that refresh_identity_filter()
+        # replaying them after swapping in a new filter can't miss any.
+        if self.identity_filter_additions is not None:
+            self.identity_filter_additions.extend(keys)
+        identity_filter = self.identity_filter
+        if identity_filter is not None:
+            for key in keys:
+                identity_filter.add(key)
+
+    def get_user_id(self, provider, external_id):
+        """ The user_id that logs in as external_id with provider, or None
+        if there isn't one."""
+        logger = logging.getLogger("%s.get_user_id" % (APP_NAME, ))
+        if self.user_id_cache is not None:
+            user_id = self.user_id_cache.get((provider, external_id))
+            if user_id is not MISSING:
+                return user_id
+        if self.identity_index is not None:
+            user_id_bytes = self.identity_index.get(provider, external_id)
+            if user_id_bytes is not None:
+                return self.user_id_from_bytes(user_id_bytes)
+        if self.identity_filter is not None and self.identity_filter_key(provider, external_id) not in self.identity_filter:
+            self.identity_filter_rejections += 1
+            return None
+        rows = self.run_read(self._select_user_id, provider, external_id)
         if len(rows) == 0:
-            user = None
+            return None
+        assert(len(rows) == 1)
+        user_id = rows[0][0]
+        if self.user_id_cache is not None:
+            self.user_id_cache.set((provider, external_id), user_id)
+        return user_id
+
+    def _select_user_id(self, connection, provider, external_id):
+        return self.execute_statement(self.GET_USER_ID, (provider, external_id), connection).fetchall()
+
+    def get_user_ids(self, identities):
+        """ Look up many (provider, external_id) pairs at once. Returns a
+        list the same length as identities, holding the user_id for each
+        that exists and None for each one that doesn't."""
+        logger = logging.getLogger("%s.get_user_ids" % (APP_NAME, ))
+        user_ids = [None] * len(identities)
+        lookups = []
+        for (position, (provider, external_id)) in enumerate(identities):
+            user_id = MISSING
+            if self.user_id_cache is not None:
+                user_id = self.user_id_cache.get((provider, external_id))
+            if user_id is MISSING and self.identity_index is not None:
+                user_id_bytes = self.identity_index.get(provider, external_id)
+                if user_id_bytes is not None:
+                    user_id = self.user_id_from_bytes(user_id_bytes)
+            if user_id is not MISSING:
+                user_ids[position] = user_id
+            elif self.identity_filter is not None and self.identity_filter_key(provider, external_id) not in self.identity_filter:
+                self.identity_filter_rejections += 1
+            else:
+                lookups.append((position, provider, external_id))
+        if lookups:
+            for (position, user_id) in self.run_read(self._select_user_ids, lookups):
+                user_ids[position] = user_id
+                if self.user_id_cache is not None:
+                    self.user_id_cache.set(tuple(identities[position]), user_id)
+        logger.debug("found %s of %s users" % (len(user_ids) - user_ids.count(None), len(user_ids)))
+        return user_ids
+
+    def _select_user_ids(self, connection, lookups):
+        """ (position, user_id) for each (position, provider, external_id)
+        in lookups that exists."""
+        with connection:
+            self.execute_statement(self.CREATE_IDENTITY_LOOKUP_TABLE, (), connection)
+            self.execute_many(self.INSERT_IDENTITY_LOOKUP,
+                              lookups,
+                              connection)
+            rows = self.execute_statement(self.GET_USER_IDS_FROM_IDENTITY_LOOKUP, (), connection).fetchall()
+            self.execute_statement(self.EMPTY_IDENTITY_LOOKUP_TABLE, (), connection)
+        return rows
+
+    def add_user(self, provider, external_id, role_id = DEFAULT_ROLE_ID, **profile):
+        """ Create a user who logs in as external_id with provider, and
+        return their new user_id. profile holds whichever of the provider's
+        PROFILE_FIELDS we know."""
+        return self.add_users([(provider, external_id)], [profile], role_id)[0]
+
+    def add_users(self, identities, profiles = None, role_id = DEFAULT_ROLE_ID):
+        """ Create a user for each (provider, external_id) in identities in
+        a single transaction. Either all of them are added or, if an
+        exception is raised, none are.
+
+        profiles, if given, is a list the same length as identities of
+        dicts of profile fields."""
+        logger = logging.getLogger("%s.add_users" % (APP_NAME, ))
+        assert(all(provider in self.PROVIDERS for (provider, external_id) in identities))
+        if profiles is None:
+            profiles = [{}] * len(identities)
+        user_ids = [self.new_user_id() for identity in identities]
+        if self.user_id_cache is not None:
+            for (provider, external_id) in identities:
+                self.user_id_cache.invalidate((provider, external_id))
+        profile_rows = dict((provider, []) for provider in self.PROFILE_FIELDS)
+        for ((provider, external_id), profile) in zip(identities, profiles):
+            if provider in self.PROFILE_FIELDS:
+                profile_rows[provider].append([external_id] + [profile.get(field, None) for field in self.PROFILE_FIELDS[provider]])
+        self.run_write(self._insert_users, identities, user_ids, role_id, profile_rows)
+        logger.debug("added %s users" % (len(user_ids), ))
+        return user_ids
+
+    def _insert_users(self, connection, identities, user_ids, role_id, profile_rows):
+        try:
+            with connection:
+                self.execute_many(self.CREATE_USER,
+                                  [(user_id, role_id) for user_id in user_ids],
+                                  connection)
+                self.execute_many(self.CREATE_IDENTITY,
+                                  [(provider, external_id, user_id)
+                                   for ((provider, external_id), user_id) in zip(identities, user_ids)],
+                                  connection)
+                for (provider, rows) in profile_rows.iteritems():
+                    if rows:
+                        self.execute_many(self.CREATE_PROFILE[provider], rows, connection)
+                self.log_changes("add",
+                                 [(provider, external_id, user_id)
+                                  for ((provider, external_id), user_id) in zip(identities, user_ids)],
+                                 connection)
+        finally:
+            # Whether we added them or, as some are already there, failed
+            # to, the identities are in the database now.
+            self.add_to_identity_filter(identities)
+
+    def log_changes(self, change_type, changes, connection = None):
+        """ Append a change_type row to the change log, if we keep one,
+        for each (provider, external_id, user_id) in changes. Call it
+        inside the transaction making the changes."""
+        if not self.change_log or not changes:
+            return
+        assert(change_type in self.CHANGE_TYPES)
+        changed_at = time.time()
+        self.execute_many(self.LOG_CHANGE,
+                          [(change_type, provider, external_id, user_id, changed_at)
+                           for (provider, external_id, user_id) in changes],
+                          connection)
+
+    def get_changes(self, after, limit):
+        """ Up to limit change log rows, (sequence, change_type, provider,
+        external_id, user_id, changed_at), with sequence numbers after
+        after, in order."""
+        return self.run_read(self._select_changes, after, limit)
+
+    def _select_changes(self, connection, after, limit):
+        return self.execute_statement(self.GET_CHANGES_AFTER, (after, limit), connection).fetchall()
+
+    def get_change_sequences(self):
+        """ The (first, last) sequence numbers still in the change log,
+        each None if it's empty."""
+        return self.run_read(self._select_change_sequences)
+
+    def _select_change_sequences(self, connection):
+        return tuple(self.execute_statement(self.GET_CHANGE_SEQUENCES, (), connection).fetchall()[0])
+
+    def trim_change_log(self, keep):
+        """ Forget all but the last keep changes."""
+        self.run_write(self._trim_change_log, keep)
+
+    def _trim_change_log(self, connection, keep):
+        self.execute_statement(self.TRIM_CHANGE_LOG, (keep, ), connection)
+
+    def get_or_create_user(self, provider, external_id, role_id = DEFAULT_ROLE_ID, **profile):
+        """ The user_id of whoever logs in as external_id with provider,
+        creating them first, as add_user() would, if there's no such user.
+        Returns (user_id, created).
+
+        Creating and finding happen in one transaction, so of two logins
+        racing to create the same user, one creates them and the other
+        gets the same user_id back."""
+        assert(provider in self.PROVIDERS)
+        user_id = self.get_user_id(provider, external_id)
+        if user_id is not None:
+            return (user_id, False)
+        profile_row = None
+        if provider in self.PROFILE_FIELDS:
+            profile_row = [external_id] + [profile.get(field, None) for field in self.PROFILE_FIELDS[provider]]
+        (user_id, created) = self.run_write(self._get_or_create_user, provider, external_id, self.new_user_id(), role_id, profile_row)
+        if self.user_id_cache is not None:
+            self.user_id_cache.set((provider, external_id), user_id)
+        return (user_id, created)
+
+    def _get_or_create_user(self, connection, provider, external_id, user_id, role_id, profile_row):
+        with connection:
+            self.execute_statement(self.CREATE_IDENTITY_IF_MISSING, (provider, external_id, user_id), connection)
+            created = connection.changes() == 1
+            if created:
+                self.execute_statement(self.CREATE_USER, (user_id, role_id), connection)
+                if profile_row is not None:
+                    self.execute_statement(self.CREATE_PROFILE[provider], profile_row, connection)
+                self.log_changes("add", [(provider, external_id, user_id)], connection)
+            else:
+                user_id = self.execute_statement(self.GET_USER_ID, (provider, external_id), connection).fetchall()[0][0]
+        if created:
+            self.add_to_identity_filter([(provider, external_id)])
+        return (user_id, created)
+
+    def get_identities_after(self, after, limit):
+        """ Up to limit (provider, external_id) pairs in key order, starting
+        after the pair after, or from the first if after is None. Walking
+        identity this way, one page at a time, holds no cursor open between
+        pages, so the caller is free to write in between."""
+        if after is None:
+            cursor = self.execute_statement(self.GET_FIRST_IDENTITIES, (limit, ))
         else:
-            assert(len(rows) == 1)
-            row = rows[0]
-            user_id = row[0]
-            logger.debug("user_id: %s" % (user_id, ))
-            user = GoogleUser(user_id = user_id,
-                              email = email)
-        logger.debug("get_google_user returning: %s" % (user, ))
-        return user
-
-    def add_google_user(self,
-                        email,
-                        **kwds):
-        logger = logging.getLogger("%s.add_google_user" % (APP_NAME, ))
-        user_id = uuid.uuid4().hex
-        first_name = kwds.get("first_name", None)
-        last_name = kwds.get("last_name", None)
-        name = kwds.get("name", None)
-        locale = kwds.get("locale", None)
-        cursor = self.execute_statement(self.CREATE_AUTH_GOOGLE,
-                                        (email,
-                                         user_id,
-                                         first_name,
-                                         last_name,
-                                         name,
-                                         locale))
-        user = GoogleUser(email = email,
-                          user_id = user_id,
-                          first_name = first_name,
-                          last_name = last_name,
-                          name = name,
-                          locale = locale)
-        return user
+            (provider, external_id) = after
+            cursor = self.execute_statement(self.GET_IDENTITIES_AFTER, (provider, provider, external_id, limit))
+        return [(provider, external_id) for (provider, external_id) in cursor]
+
+    def get_user_records(self, identities):
+        """ A user record, (provider, external_id, user_id, role_id,
+        profile), for each of identities that exists. profile is a tuple
+        of the provider's PROFILE_FIELDS values, or None if we have no
+        profile for them."""
+        records = []
+        with self.connection:
+            for (provider, external_id) in identities:
+                rows = self.execute_statement(self.GET_USER_RECORD, (provider, external_id)).fetchall()
+                if len(rows) == 0:
+                    continue
+                (user_id, role_id) = rows[0]
+                profile = None
+                if provider in self.GET_PROFILE:
+                    profile_rows = self.execute_statement(self.GET_PROFILE[provider], (external_id, )).fetchall()
+                    if len(profile_rows) == 1:
+                        profile = tuple(profile_rows[0])
+                records.append((provider, external_id, user_id, role_id or DEFAULT_ROLE_ID, profile))
+        return records
+
+    def put_user_records(self, records):
+        """ Write user records as got from get_user_records(), replacing
+        any that are already here, in one transaction."""
+        self.user_role_writes += 1
+        with self.connection:
+            for (provider, external_id, user_id, role_id, profile) in records:
+                self.execute_statement(self.REPLACE_USER, (user_id, role_id))
+                self.execute_statement(self.REPLACE_IDENTITY, (provider, external_id, user_id))
+                if profile is not None:
+                    self.execute_statement(self.REPLACE_PROFILE[provider], (external_id, ) + tuple(profile))
+            self.log_changes("replace",
+                             [(provider, external_id, user_id)
+                              for (provider, external_id, user_id, role_id, profile) in records])
+        for (provider, external_id, user_id, role_id, profile) in records:
+            if self.user_id_cache is not None:
+                self.user_id_cache.invalidate((provider, external_id))
+            if self.user_role_cache is not None:
+                self.user_role_cache.invalidate(self.user_id_to_string(user_id))
+        self.add_to_identity_filter([(provider, external_id)
+                                     for (provider, external_id, user_id, role_id, profile) in records])
+
+    def delete_user_records(self, identities):
+        """ Delete identities, with their users and profiles, in one
+        transaction."""
+        self.user_role_writes += 1
+        with self.connection:
+            deleted = []
+            for (provider, external_id) in identities:
+                rows = self.execute_statement(self.GET_USER_ID, (provider, external_id)).fetchall()
+                if len(rows) == 0:
+                    continue
+                self.execute_statement(self.DELETE_IDENTITY, (provider, external_id))
+                self.execute_statement(self.DELETE_USER, (rows[0][0], ))
+                if provider in self.DELETE_PROFILE:
+                    self.execute_statement(self.DELETE_PROFILE[provider], (external_id, ))
+                deleted.append((provider, external_id, rows[0][0]))
+            self.log_changes("delete", deleted)
+        if self.user_id_cache is not None:
+            for (provider, external_id) in identities:
+                self.user_id_cache.invalidate((provider, external_id))
+        if self.user_role_cache is not None:
+            for (provider, external_id, user_id) in deleted:
+                self.user_role_cache.invalidate(self.user_id_to_string(user_id))
+
+    def get_list_ids_after(self, after, limit):
+        """ Up to limit list_ids with ACLs in order, starting after after,
+        or from the first if after is None. As get_identities_after()."""
+        if after is None:
+            cursor = self.execute_statement(self.GET_FIRST_LIST_IDS, (limit, ))
+        else:
+            cursor = self.execute_statement(self.GET_LIST_IDS_AFTER, (after, limit))
+        return [list_id for (list_id, ) in cursor]
+
+    def get_list_acl_records(self, list_ids):
+        """ A list ACL record, (list_id, user_id, actions), for each entry
+        in the ACLs of list_ids, actions as they're stored."""
+        records = []
+        with self.connection:
+            for list_id in list_ids:
+                for (user_id, actions) in self.execute_statement(self.GET_LIST_ACL, (list_id, )).fetchall():
+                    records.append((list_id, user_id, actions))
+        return records
+
+    def put_list_acl_records(self, records):
+        """ Write list ACL records as got from get_list_acl_records(),
+        replacing any that are already here, in one transaction."""
+        self.list_acl_writes += 1
+        with self.connection:
+            self.execute_many(self.SET_LIST_ACCESS, records)
+        if self.list_acl_cache is not None:
+            for list_id in set(list_id for (list_id, user_id, actions) in records):
+                self.list_acl_cache.invalidate(list_id)
+
+    def delete_list_acls(self, list_ids):
+        """ Delete the whole ACLs of list_ids in one transaction."""
+        self.list_acl_writes += 1
+        with self.connection:
+            self.execute_many(self.DELETE_LIST_ACL, [(list_id, ) for list_id in list_ids])
+        if self.list_acl_cache is not None:
+            for list_id in list_ids:
+                self.list_acl_cache.invalidate(list_id)
+
+    def get_import_checkpoint(self, name):
+        """ How many rows of the import called name have been committed."""
+        self.execute_statement(self.CREATE_IMPORT_CHECKPOINT_TABLE, ())
+        rows = self.execute_statement(self.GET_IMPORT_CHECKPOINT, (name, )).fetchall()
+        if len(rows) == 0:
+            return 0
+        return rows[0][0]
+
+    def import_google_users(self, rows, on_conflict = "ABORT", checkpoint_name = None, checkpoint_rows = None, role_id = DEFAULT_ROLE_ID):
+        """ Insert rows, each a tuple of the GOOGLE_USER_FIELDS values, as
+        Google users in one transaction. on_conflict says what to do about
+        an email that's already there; with REPLACE its user is replaced by
+        the imported one, who takes over their role. If checkpoint_name is given record
+        that checkpoint_rows rows of that import are done in the same
+        transaction."""
+        assert(on_conflict in self.CONFLICT_POLICIES)
+        self.user_role_writes += 1
+        with self.connection:
+            # Only the emails we actually wrote are changes; with IGNORE
+            # those already there aren't.
+            written = []
+            # (old user_id, new user_id) for each email REPLACE gave to
+            # another user.
+            replaced = []
+            if not self.change_log and on_conflict != "REPLACE":
+                # Nobody needs to know which rows went in, so they can all
+                # go in one statement.
+                self.execute_many(self.IMPORT_GOOGLE_IDENTITY % (on_conflict, ),
+                                  [(row[0], row[1]) for row in rows])
+            else:
+                for row in rows:
+                    old_user_id = None
+                    if on_conflict == "REPLACE":
+                        existing_rows = self.execute_statement(self.GET_USER_ID, ("google", row[0])).fetchall()
+                        if len(existing_rows) == 1:
+                            old_user_id = existing_rows[0][0]
+                    self.execute_statement(self.IMPORT_GOOGLE_IDENTITY % (on_conflict, ), (row[0], row[1]))
+                    if self.connection.changes() == 1:
+                        written.append(row[0])
+                    if old_user_id is not None and old_user_id != row[1]:
+                        replaced.append((old_user_id, row[1]))
+            self.execute_many(self.IMPORT_GOOGLE_USER,
+                              [(role_id, row[0]) for row in rows])
+            # The new user takes the place of the old, role and all.
+            for (old_user_id, new_user_id) in replaced:
+                role_rows = self.execute_statement(self.GET_USER_ROLE, (old_user_id, )).fetchall()
+                self.execute_statement(self.DELETE_USER, (old_user_id, ))
+                if len(role_rows) == 1 and role_rows[0][0] is not None:
+                    self.execute_statement(self.REPLACE_USER, (new_user_id, role_rows[0][0]))
+            self.execute_many(self.IMPORT_AUTH_GOOGLE % (on_conflict, ),
+                              [(row[0], ) + tuple(row[2:]) for row in rows])
+            if self.change_log:
+                change_type = "add"
+                if on_conflict == "REPLACE":
+                    change_type = "replace"
+                # The user_id stored, not the file's, in case the database
+                # kept another.
+                changes = []
+                for email in written:
+                    user_id = self.execute_statement(self.GET_USER_ID, ("google", email)).fetchall()[0][0]
+                    changes.append(("google", email, user_id))
+                self.log_changes(change_type, changes)
+            if checkpoint_name is not None:
+                self.execute_statement(self.CREATE_IMPORT_CHECKPOINT_TABLE, ())
+                self.execute_statement(self.SET_IMPORT_CHECKPOINT, (checkpoint_name, checkpoint_rows))
+        if self.user_id_cache is not None:
+            self.user_id_cache.clear()
+        if self.user_role_cache is not None:
+            for (old_user_id, new_user_id) in replaced:
+                self.user_role_cache.invalidate(self.user_id_to_string(old_user_id))
+        self.add_to_identity_filter([("google", row[0]) for row in rows])
+
+    def export_google_users(self):
+        """ Iterate over every Google user, as tuples of the
+        GOOGLE_USER_FIELDS values ordered by email, without reading them
+        all into memory."""
+        return self.execute_statement(self.EXPORT_GOOGLE_USERS, ())
+
+    def refresh_identity_filter(self):
+        """ Add the identities other connections have inserted since we
+        last looked to the Bloom filter. Rebuild it, with room to spare,
+        if it's grown past its capacity, if we've fallen so far behind
+        that identity_sequence has forgotten what we missed, or if there
+        isn't one yet.
+
+        The new filter is built by run_read(), so with an executor the
+        scan of identity doesn't hold up the hub, and lookups use the old
+        one until it's done. Whatever is added to the database meanwhile
+        is added to both, then the new one is swapped in."""
+        logger = logging.getLogger("%s.refresh_identity_filter" % (APP_NAME, ))
+        if self.identity_filter is not None and not self.identity_filter.is_full():
+            identity_sequences = self.run_read(self._get_identity_sequences_after, self.identity_filter_sequence)
+            if identity_sequences is not None:
+                (rows, (first_sequence, last_sequence)) = identity_sequences
+                for (sequence, provider, external_id) in rows:
+                    self.identity_filter.add(self.identity_filter_key(provider, external_id))
+                    self.identity_filter_sequence = sequence
+                if first_sequence is not None and \
+                   last_sequence - first_sequence >= self.IDENTITY_SEQUENCES_KEPT * 2:
+                    self.run_write(self._trim_identity_sequences)
+                if not self.identity_filter.is_full():
+                    return
+        self.identity_filter_additions = []
+        try:
+            (identity_filter, sequence) = self.run_read(self._build_identity_filter)
+            logger.debug("built identity filter with capacity %s" % (identity_filter.capacity, ))
+            for key in list(self.identity_filter_additions):
+                identity_filter.add(key)
+            self.identity_filter = identity_filter
+            self.identity_filter_sequence = sequence
+            # Again, for any added while we were swapping.
+            for key in list(self.identity_filter_additions):
+                identity_filter.add(key)
+        finally:
+            self.identity_filter_additions = None
+
+    def _get_identity_sequences(self, connection):
+        if len(self.execute_statement(self.GET_TABLE_SQL, ("identity_sequence", ), connection).fetchall()) == 0:
+            # A database nobody has opened for writing since we started
+            # keeping them, so nobody has inserted any.
+            return (None, None)
+        return self.execute_statement(self.GET_IDENTITY_SEQUENCES, (), connection).fetchall()[0]
+
+    def _get_identity_sequences_after(self, connection, sequence):
+        """ The identity_sequence rows after sequence, and the first and
+        last sequences there are, or None if rows we haven't seen have
+        been trimmed away."""
+        (first_sequence, last_sequence) = self._get_identity_sequences(connection)
+        if first_sequence is None:
+            return ([], (None, None))
+        if first_sequence > (sequence or 0) + 1:
+            return None
+        rows = self.execute_statement(self.GET_IDENTITY_SEQUENCES_AFTER, (sequence or 0, ), connection).fetchall()
+        return (rows, (first_sequence, last_sequence))
+
+    def _trim_identity_sequences(self, connection):
+        self.execute_statement(self.TRIM_IDENTITY_SEQUENCES, (self.IDENTITY_SEQUENCES_KEPT, ), connection)
+
+    def _build_identity_filter(self, connection):
+        # The last sequence is read first, so every identity inserted up
+        # to it is in the scan, and anything after it is read next time.
+        # An identity inserted in between may be in both, which is harmless.
+        sequence = self._get_identity_sequences(connection)[1]
+        count = self.execute_statement(self.COUNT_IDENTITIES, (), connection).fetchall()[0][0]
+        capacity = max(count * 2, self.MINIMUM_IDENTITY_FILTER_CAPACITY)
+        identity_filter = BloomFilter(capacity, self.false_positive_rate)
+        for (provider, external_id) in self.execute_statement(self.GET_IDENTITIES, (), connection):
+            identity_filter.add(self.identity_filter_key(provider, external_id))
+        return (identity_filter, sequence)
+
+    def refresh_roles(self):
+        """ If another connection has written to the roles since we last
+        looked, reload them and forget which users have which. If it's
+        written to the lists' ACLs, forget every list's ACL."""
+        self.run_write(self._refresh_roles)
+
+    def _refresh_roles(self, connection):
+        data_version = self.execute_statement(self.GET_DATA_VERSION, (), connection).fetchall()[0][0]
+        if data_version == self.roles_data_version and self.roles is not None:
+            return
+        self.roles_data_version = data_version
+        access_versions = self._get_access_versions(connection)
+        if self.roles is None or access_versions.get("role") != self.access_versions.get("role"):
+            self._load_roles(connection)
+            self.user_role_writes += 1
+            if self.user_role_cache is not None:
+                # A new cache rather than clear(), so that an authorize()
+                # whose query was under way can't put what it read back
+                # afterwards.
+                self.user_role_cache = LRUCache(self.user_role_cache.max_size)
+        if access_versions.get("list_acl") != self.access_versions.get("list_acl"):
+            self.list_acl_writes += 1
+            if self.list_acl_cache is not None:
+                self.list_acl_cache = LRUCache(self.list_acl_cache.max_size)
+        self.access_versions = access_versions
+
+    def _get_access_versions(self, connection):
+        """ name to version, or empty for a read-only database from before
+        we kept them."""
+        if len(self.execute_statement(self.GET_TABLE_SQL, ("access_version", ), connection).fetchall()) == 0:
+            return {}
+        return dict(self.execute_statement(self.GET_ACCESS_VERSIONS, (), connection).fetchall())
+
+    def _write_access(self, connection, name, statement, args):
+        """ Run statement, which bumps name's access version, in our
+        transaction. If nobody else had bumped it since we last looked,
+        note that we've seen this bump, so that refresh_roles() doesn't
+        forget what we know on account of our own write."""
+        versions_before = self._get_access_versions(connection)
+        self.execute_statement(statement, args, connection)
+        changes = connection.changes()
+        if versions_before.get(name) == self.access_versions.get(name):
+            self.access_versions[name] = self._get_access_versions(connection).get(name)
+        return changes
+
+    def _load_roles(self, connection):
+        self.roles = RoleTable(self.execute_statement(self.GET_ROLES, (), connection).fetchall())
+
+    def authorize(self, user_id, privilege):
+        """ Whether the user with user_id, as it goes over the wire, holds
+        privilege through their role. Users that don't exist hold
+        nothing."""
+        try:
+            stored_user_id = self.user_id_from_string(user_id)
+        except ValueError:
+            return False
+        key = self.user_id_to_string(stored_user_id)
+        user_role_cache = self.user_role_cache
+        role_id = MISSING
+        if user_role_cache is not None:
+            role_id = user_role_cache.get(key)
+        if role_id is MISSING:
+            user_role_writes = self.user_role_writes
+            rows = self.run_read(self._select_user_role, stored_user_id)
+            if len(rows) == 0:
+                return False
+            role_id = rows[0][0]
+            if user_role_cache is not None and user_role_writes == self.user_role_writes:
+                user_role_cache.set(key, role_id)
+        return self.roles.has_privilege(role_id, privilege)
+
+    def _select_user_role(self, connection, user_id):
+        return self.execute_statement(self.GET_USER_ROLE, (user_id, ), connection).fetchall()
+
+    def set_role(self, role_id, privileges, role_name = None):
+        """ Create role_id, or replace it, with privileges, a list of
+        privilege names. Users who have the role hold the new privileges
+        from now on."""
+        self.run_write(self._set_role, role_id, role_name or role_id, format_privileges(privileges))
+
+    def _set_role(self, connection, role_id, role_name, privileges):
+        with connection:
+            self._write_access(connection, "role", self.SET_ROLE, (role_id, role_name, privileges))
+            self.log_changes("role", [("role", role_id, None)], connection)
+            self._load_roles(connection)
+
+    def set_user_role(self, user_id, role_id):
+        """ Give the user with user_id, as it goes over the wire, role_id.
+        Returns whether there's such a user."""
+        try:
+            stored_user_id = self.user_id_from_string(user_id)
+        except ValueError:
+            return False
+        self.user_role_writes += 1
+        changed = self.run_write(self._set_user_role, stored_user_id, role_id)
+        if self.user_role_cache is not None:
+            self.user_role_cache.invalidate(self.user_id_to_string(stored_user_id))
+        return changed
+
+    def _set_user_role(self, connection, user_id, role_id):
+        with connection:
+            changed = self._write_access(connection, "role", self.SET_USER_ROLE, (role_id, user_id)) == 1
+            if changed:
+                self.log_changes("user_role", [("role", role_id, user_id)], connection)
+        return changed
+
+    def user_id_key(self, user_id):
+        """ user_id, as it goes over the wire, as we key users in memory,
+        or None if we store user IDs as bytes and it isn't a UUID."""
+        try:
+            return self.user_id_to_string(self.user_id_from_string(user_id))
+        except ValueError:
+            return None
+
+    def check_access(self, checks):
+        """ Whether each of checks, a (user_id, list_id, action) with
+        user_id as it goes over the wire, is allowed by the list's ACL.
+        Returns a list of booleans in the same order. However many checks
+        there are, each list's ACL is read from memory, or failing that
+        from the database, once, and all the lists we don't have in
+        memory are read in one go."""
+        acls = {}
+        for (user_id, list_id, action) in checks:
+            if list_id in acls:
+                continue
+            acls[list_id] = MISSING
+            if self.list_acl_cache is not None:
+                acls[list_id] = self.list_acl_cache.get(list_id)
+        missing = [list_id for (list_id, acl) in acls.iteritems() if acl is MISSING]
+        if missing:
+            list_acl_writes = self.list_acl_writes
+            list_acl_cache = self.list_acl_cache
+            for (list_id, acl) in self.run_read(self._select_list_acls, missing):
+                acls[list_id] = acl
+                if list_acl_cache is not None and list_acl_writes == self.list_acl_writes:
+                    list_acl_cache.set(list_id, acl)
+        no_actions = frozenset()
+        return [action in acls[list_id].get(self.user_id_key(user_id), no_actions)
+                for (user_id, list_id, action) in checks]
+
+    def _select_list_acls(self, connection, list_ids):
+        return [(list_id, dict((self.user_id_to_string(user_id), frozenset(parse_privileges(actions)))
+                               for (user_id, actions) in self.execute_statement(self.GET_LIST_ACL, (list_id, ), connection)))
+                for list_id in list_ids]
+
+    def set_list_access(self, list_id, user_id, actions):
+        """ Let the user with user_id, as it goes over the wire, take
+        actions, a list of action names, on list_id, and no others. No
+        actions removes the user from the list's ACL. Raises ValueError
+        if we store user IDs as bytes and user_id isn't a UUID."""
+        stored_user_id = self.user_id_from_string(user_id)
+        self.list_acl_writes += 1
+        self.run_write(self._set_list_access, list_id, stored_user_id, format_privileges(actions))
+        if self.list_acl_cache is not None:
+            self.list_acl_cache.invalidate(list_id)
+
+    def _set_list_access(self, connection, list_id, user_id, actions):
+        with connection:
+            if actions:
+                self._write_access(connection, "list_acl", self.SET_LIST_ACCESS, (list_id, user_id, actions))
+            else:
+                self._write_access(connection, "list_acl", self.DELETE_LIST_ACCESS, (list_id, user_id))
+
+    # ------------------------------------------------------------------------
+    #   Warm restarts. On shutdown we write out which identities are cached,
+    #   most recently used last, and on startup look them all up again in
+    #   one bulk query. Only the keys are saved, so nothing stale survives a
+    #   restart.
+    # ------------------------------------------------------------------------
+    def save_user_id_cache(self, filepath):
+        logger = logging.getLogger("%s.save_user_id_cache" % (APP_NAME, ))
+        if self.user_id_cache is None:
+            return
+        identities = self.user_id_cache.keys()
+        temporary_filepath = "%s.tmp" % (filepath, )
+        with open(temporary_filepath, "w") as f:
+            json.dump(identities, f)
+        os.rename(temporary_filepath, filepath)
+        logger.info("saved %s cached identities to %s" % (len(identities), filepath))
 
+    def load_user_id_cache(self, filepath):
+        logger = logging.getLogger("%s.load_user_id_cache" % (APP_NAME, ))
+        if self.user_id_cache is None or not os.path.isfile(filepath):
+            return
+        try:
+            with open(filepath) as f:
+                identities = [(provider, external_id) for (provider, external_id) in json.load(f)]
+        except ValueError:
+            logger.exception("ignoring unreadable cache file %s" % (filepath, ))
+            return
+        identities = identities[-self.user_id_cache.max_size:]
+        user_ids = self.get_user_ids(identities)
+        logger.info("warmed cache with %s of %s identities from %s" % (len(user_ids) - user_ids.count(None), len(identities), filepath))
@@ -0,0 +1,90 @@
+#!/usr/bin/env python2.7
+
+# ---------------------------------------------------------------------------
+# Copyright (c) 2012 Asim Ihsan (asim dot ihsan at gmail dot com)
+# Distributed under the MIT/X11 software license, see the accompanying
+# file license.txt or http://www.opensource.org/licenses/mit-license.php.
+# ---------------------------------------------------------------------------
+
+# ---------------------------------------------------------------------------
+#   authauth_model_executor.py: run a Database's SQL on native threads, so
+#   that a slow disk stalls the requests waiting on it rather than every
+#   greenlet in the process.
+#
+#   gevent can't switch greenlets while a greenlet is inside a blocking
+#   SQLite call, even though apsw releases the GIL. Here the calling
+#   greenlet instead hands the call to a thread pool and waits for the
+#   result, and the hub carries on serving other requests, pings included.
+#
+#   Reads and writes queue separately. Reads go to a pool of threads, each
+#   call borrowing one of as many read-only connections, so with the WAL
+#   journal they run alongside a write rather than behind it. Writes go to
+#   one thread on the Database's own connection, as SQLite only ever lets
+#   one connection write at a time anyway.
+#
+#   With any other journal a read and a write on different connections
+#   lock each other out, so unless the Database has a busy timeout of its
+#   own every connection here waits up to BUSY_TIMEOUT for the other
+#   rather than failing at once with BusyError.
+# ---------------------------------------------------------------------------
+
+import gevent.queue
+import gevent.threadpool
+
+import logging
+APP_NAME = "authauth_model.executor"
+logger = logging.getLogger(APP_NAME)
+
+# Milliseconds a connection waits on a lock if the Database doesn't say.
+BUSY_TIMEOUT = 5000
+
+class DatabaseExecutor(object):
+    def __init__(self, database, read_threads):
+        assert(read_threads > 0)
+        self.read_threads = read_threads
+        self.read_pool = gevent.threadpool.ThreadPool(read_threads)
+        self.write_pool = gevent.threadpool.ThreadPool(1)
+        self.read_connections = gevent.queue.Queue()
+        for i in xrange(read_threads):
+            self.read_connections.put(database.open_read_connection(BUSY_TIMEOUT))
+        if database.busy_timeout is None:
+            database.connection.setbusytimeout(BUSY_TIMEOUT)
+        self.database = database
+
+        # Calls waiting for or running on each pool.
+        self.reads_in_flight = 0
+        self.writes_in_flight = 0
+
+    def read(self, function, *args):
+        """ function(connection, *args) on a read thread, with a read-only
+        connection no other thread is using."""
+        self.reads_in_flight += 1
+        try:
+            connection = self.read_connections.get()
+            try:
+                return self.read_pool.apply(function, (connection, ) + args)
+            finally:
+                self.read_connections.put(connection)
+        finally:
+            self.reads_in_flight -= 1
+
+    def write(self, function, *args):
+        """ function(connection, *args) on the write thread, with the
+        Database's connection."""
+        self.writes_in_flight += 1
+        try:
+            return self.write_pool.apply(function, (self.database.connection, ) + args)
+        finally:
+            self.writes_in_flight -= 1
+
+    def close(self):
+        self.read_pool.kill()
+        self.write_pool.kill()
+        while not self.read_connections.empty():
+            self.read_connections.get().close()
+
+    def as_dict(self):
+        return {"read_threads": self.read_threads,
+                "write_threads": 1,
+                "reads_in_flight": self.reads_in_flight,
+                "writes_in_flight": self.writes_in_flight}
@@ -0,0 +1,76 @@
+#!/usr/bin/env python2.7
+
+# ---------------------------------------------------------------------------
+# Copyright (c) 2012 Asim Ihsan (asim dot ihsan at gmail dot com)
+# Distributed under the MIT/X11 software license, see the accompanying
+# file license.txt or http://www.opensource.org/licenses/mit-license.php.
+# ---------------------------------------------------------------------------
+
+# ---------------------------------------------------------------------------
+#   authauth_model_group_commit.py: coalesce add_user calls made by
+#   concurrent greenlets into one transaction, i.e. one fsync, per batch.
+#
+#   The first caller to arrive opens a batch and schedules it to be written
+#   window seconds later; callers arriving meanwhile join it, and a caller
+#   that fills it to max_batch_size writes it at once. Every caller blocks
+#   until the transaction holding their user commits, so a reply is never
+#   sent for a user that isn't yet durable.
+#
+#   If the batch's transaction fails, e.g. because one identity in it
+#   is already taken, nothing in it was written and we fall back to adding
+#   each user on its own, so that only the callers at fault see an error.
+# ---------------------------------------------------------------------------
+
+import gevent
+import gevent.event
+
+import logging
+APP_NAME = "authauth_model.group_commit"
+logger = logging.getLogger(APP_NAME)
+
+class GroupCommitter(object):
+    def __init__(self, database, window, max_batch_size):
+        assert(window >= 0)
+        assert(max_batch_size > 0)
+        self.database = database
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self.pending = []
+        self.timer = None
+
+    def add_user(self, provider, external_id, **profile):
+        """ As Database.add_user, but sharing a transaction with whichever
+        other greenlets are adding users at the same time."""
+        result = gevent.event.AsyncResult()
+        self.pending.append(((provider, external_id), profile, result))
+        if len(self.pending) >= self.max_batch_size:
+            self.flush()
+        elif self.timer is None:
+            self.timer = gevent.spawn_later(self.window, self.flush)
+        return result.get()
+
+    def flush(self):
+        logger = logging.getLogger("%s.flush" % (APP_NAME, ))
+        if self.timer is not None:
+            if self.timer is not gevent.getcurrent():
+                self.timer.kill(block = False)
+            self.timer = None
+        batch = self.pending
+        self.pending = []
+        if not batch:
+            return
+        identities = [identity for (identity, profile, result) in batch]
+        profiles = [profile for (identity, profile, result) in batch]
+        try:
+            user_ids = self.database.add_users(identities, profiles)
+        except Exception as e:
+            logger.debug("batch of %s failed, adding one at a time: %s" % (len(batch), e))
+            for ((provider, external_id), profile, result) in batch:
+                try:
+                    result.set(self.database.add_user(provider, external_id, **profile))
+                except Exception as e:
+                    result.set_exception(e)
+        else:
+            logger.debug("committed batch of %s" % (len(batch), ))
+            for ((identity, profile, result), user_id) in zip(batch, user_ids):
+                result.set(user_id)
@@ -0,0 +1,74 @@
+#!/usr/bin/env python2.7
+
+# ---------------------------------------------------------------------------
+# Copyright (c) 2012 Asim Ihsan (asim dot ihsan at gmail dot com)
+# Distributed under the MIT/X11 software license, see the accompanying
+# file license.txt or http://www.opensource.org/licenses/mit-license.php.
+# ---------------------------------------------------------------------------
+
+# ---------------------------------------------------------------------------
+#   authauth_model_hash_ring.py: consistent hashing of identities, and of
+#   lists for their ACLs, onto named shards.
+#
+#   Each shard is placed at virtual_nodes points on a ring of 64-bit hashes,
+#   and a key belongs to the first shard point at or after its own hash.
+#   Adding a shard only takes keys from the shards either side of its
+#   points, so about 1/N of the keys move rather than nearly all of them.
+#
+#   authauth_model and the view both route with this module, by shard name
+#   rather than by where a shard lives, so the two agree as long as they're
+#   given the same names.
+# ---------------------------------------------------------------------------
+
+import bisect
+import hashlib
+import struct
+
+# Points each shard has on the ring. More evens out how many keys each
+# shard gets, at the cost of a bigger ring to search. Everything routing
+# to the same shards must use the same number.
+VIRTUAL_NODES = 100
+
+def hash_key(key):
+    if isinstance(key, unicode):
+        key = key.encode("utf-8")
+    return struct.unpack("<Q", hashlib.md5(key).digest()[:8])[0]
+
+def identity_key(provider, external_id):
+    return u"%s:%s" % (provider, external_id)
+
+def list_key(list_id):
+    return u"list:%s" % (list_id, )
+
+def parse_shard(shard):
+    """ Split a NAME=LOCATION shard specification, e.g.
+    "a=/var/db/authauth_a.db" or "b=tcp://10.0.0.2:5556"."""
+    (name, separator, location) = shard.partition("=")
+    if not name or not separator or not location:
+        raise ValueError("shard '%s' is not NAME=LOCATION" % (shard, ))
+    return (name, location)
+
+class HashRing(object):
+    def __init__(self, names, virtual_nodes = VIRTUAL_NODES):
+        assert(len(names) > 0)
+        assert(len(set(names)) == len(names))
+        assert(virtual_nodes > 0)
+        self.names = sorted(names)
+        points = sorted((hash_key("%s#%s" % (name, i)), name)
+                        for name in self.names
+                        for i in xrange(virtual_nodes))
+        self.hashes = [point_hash for (point_hash, name) in points]
+        self.owners = [name for (point_hash, name) in points]
+
+    def get_name(self, key):
+        """ The name of the shard key belongs to."""
+        position = bisect.bisect_left(self.hashes, hash_key(key))
+        if position == len(self.hashes):
+            position = 0
+        return self.owners[position]
+
+    def get_identity_name(self, provider, external_id):
+        return self.get_name(identity_key(provider, external_id))
+
+    def get_list_name(self, list_id):
+        return self.get_name(list_key(list_id))
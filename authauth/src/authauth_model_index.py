@@ -0,0 +1,146 @@
+#!/usr/bin/env python2.7
+
+# ---------------------------------------------------------------------------
+# Copyright (c) 2012 Asim Ihsan (asim dot ihsan at gmail dot com)
+# Distributed under the MIT/X11 software license, see the accompanying
+# file license.txt or http://www.opensource.org/licenses/mit-license.php.
+# ---------------------------------------------------------------------------
+
+# ---------------------------------------------------------------------------
+#   authauth_model_index.py: an immutable, memory-mapped index of every
+#   identity's user_id, for read-mostly nodes.
+#
+#   The index is a header followed by fixed-width records, each the MD5 of
+#   an identity's key (see authauth_model_hash_ring.identity_key) and the
+#   16 bytes of its user's UUID, sorted by hash. Looking up an identity is
+#   a binary search of the mapped file: no SQLite, no apsw, and no copy of
+#   the data per process, as every process mapping the file shares the
+#   same pages of the OS page cache.
+#
+#   An index is only as new as the database it was built from; build one
+#   with authauth_model_build_index.py. Identities it doesn't have, e.g.
+#   users added since, are looked up in SQLite as usual. It knows nothing
+#   of users deleted since it was built, so rebuild it after moving users
+#   between shards.
+# ---------------------------------------------------------------------------
+
+import os
+import mmap
+import struct
+import hashlib
+
+from authauth_model_hash_ring import identity_key
+from authauth_view_utilities import convert_uuid_string_to_bytes
+
+import logging
+APP_NAME = "authauth_model.index"
+logger = logging.getLogger(APP_NAME)
+
+INDEX_MAGIC = "AAIDX001"
+# Magic, then the number of records.
+HEADER = struct.Struct("<8sQ")
+KEY_SIZE = 16
+USER_ID_SIZE = 16
+RECORD = struct.Struct("<%ss%ss" % (KEY_SIZE, USER_ID_SIZE))
+
+# SQLite sorts the records for us, spilling to temporary files rather than
+# memory for a big database, given a function to hash identities with.
+INDEX_KEY_FUNCTION = "identity_index_key"
+GET_INDEX_ROWS = """SELECT %s(provider, external_id) AS index_key, user_id FROM identity ORDER BY index_key;""" % (INDEX_KEY_FUNCTION, )
+
+class IndexFormatException(Exception):
+    def __init__(self, reason):
+        self.reason = reason
+    def __str__(self):
+        return self.reason
+
+def index_key(provider, external_id):
+    return hashlib.md5(identity_key(provider, external_id).encode("utf-8")).digest()
+
+def get_user_id_bytes(user_id):
+    """ The 16 bytes of user_id, whether it's stored as hex or as bytes,
+    or None if it isn't a UUID, e.g. one imported from elsewhere."""
+    if isinstance(user_id, buffer):
+        user_id = str(user_id)
+        if len(user_id) != USER_ID_SIZE:
+            return None
+        return user_id
+    try:
+        return convert_uuid_string_to_bytes(user_id)
+    except (ValueError, TypeError):
+        return None
+
+def build_index(database, filepath):
+    """ Write an index of every identity in database to filepath, replacing
+    any index there in one rename. Returns (records written, identities
+    skipped as their user_id isn't a UUID)."""
+    logger = logging.getLogger("%s.build_index" % (APP_NAME, ))
+    database.connection.createscalarfunction(INDEX_KEY_FUNCTION,
+                                             lambda provider, external_id: buffer(index_key(provider, external_id)),
+                                             2)
+    temporary_filepath = "%s.%s.tmp" % (filepath, os.getpid())
+    records = 0
+    skipped = 0
+    try:
+        with open(temporary_filepath, "wb") as f:
+            f.write(HEADER.pack(INDEX_MAGIC, 0))
+            for (key, user_id) in database.execute_statement(GET_INDEX_ROWS, ()):
+                user_id_bytes = get_user_id_bytes(user_id)
+                if user_id_bytes is None:
+                    skipped += 1
+                    continue
+                f.write(RECORD.pack(str(key), user_id_bytes))
+                records += 1
+            f.seek(0)
+            f.write(HEADER.pack(INDEX_MAGIC, records))
+    except:
+        if os.path.isfile(temporary_filepath):
+            os.remove(temporary_filepath)
+        raise
+    os.rename(temporary_filepath, filepath)
+    logger.info("indexed %s identities in %s, skipped %s" % (records, filepath, skipped))
+    return (records, skipped)
+
+class IdentityIndex(object):
+    def __init__(self, filepath):
+        self.filepath = filepath
+        size = os.path.getsize(filepath)
+        if size < HEADER.size:
+            raise IndexFormatException("%s is too short to be an index" % (filepath, ))
+        with open(filepath, "rb") as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        (magic, self.records) = HEADER.unpack_from(self.mmap, 0)
+        if magic != INDEX_MAGIC or size != HEADER.size + self.records * RECORD.size:
+            self.mmap.close()
+            raise IndexFormatException("%s is not an index, or is truncated" % (filepath, ))
+        self.hits = 0
+        self.misses = 0
+
+    def close(self):
+        self.mmap.close()
+
+    def get(self, provider, external_id):
+        """ The 16 bytes of the user_id of (provider, external_id), or None
+        if it isn't in the index."""
+        key = index_key(provider, external_id)
+        data = self.mmap
+        low = 0
+        high = self.records
+        while low < high:
+            middle = (low + high) // 2
+            offset = HEADER.size + middle * RECORD.size
+            middle_key = data[offset:offset + KEY_SIZE]
+            if middle_key < key:
+                low = middle + 1
+            elif middle_key > key:
+                high = middle
+            else:
+                self.hits += 1
+                return data[offset + KEY_SIZE:offset + RECORD.size]
+        self.misses += 1
+        return None
+
+    def as_dict(self):
+        return {"records": self.records,
+                "hits": self.hits,
+                "misses": self.misses}
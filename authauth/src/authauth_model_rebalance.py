@@ -0,0 +1,175 @@
+#!/usr/bin/env python2.7
+
+# ---------------------------------------------------------------------------
+# Copyright (c) 2012 Asim Ihsan (asim dot ihsan at gmail dot com)
+# Distributed under the MIT/X11 software license, see the accompanying
+# file license.txt or http://www.opensource.org/licenses/mit-license.php.
+# ---------------------------------------------------------------------------
+
+# ---------------------------------------------------------------------------
+#   authauth_model_rebalance.py: move users between the shard files of a
+#   sharded authauth_model so that each is on the shard that now owns it.
+#
+#   Give every shard, old and new, exactly as authauth_model will be given
+#   them afterwards. We walk each shard's identities in key order, one chunk
+#   at a time, and copy any that another shard owns to that shard before
+#   deleting them here. Then the same for the lists' ACLs, which live on
+#   the shard that owns the list rather than any of its users. Copies
+#   replace whatever is there, so an interrupted run is finished off by
+#   running it again.
+#
+#   Stop the authauth_model processes using the shards first. Anything
+#   routing by the new shards before its users have moved would find
+#   nothing, and add them again.
+#
+#   Remote shards aren't supported; run this on the machine whose files
+#   they are.
+#
+#   e.g. adding shard c to shards a and b:
+#
+#   ./authauth_model_rebalance.py --shard a=/var/db/a.db --shard b=/var/db/b.db --shard c=/var/db/c.db
+# ---------------------------------------------------------------------------
+
+import os
+import sys
+import argparse
+import time
+
+# ----------------------------------------------------------------------
+#   Logging.
+# ----------------------------------------------------------------------
+import logging
+import logging.handlers
+
+APP_NAME = 'authauth_model_rebalance'
+logger = logging.getLogger(APP_NAME)
+logger.setLevel(logging.INFO)
+ch = logging.StreamHandler()
+ch.setLevel(logging.INFO)
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(message)s')
+ch.setFormatter(formatter)
+logger.addHandler(ch)
+logger = logging.getLogger(APP_NAME)
+# ----------------------------------------------------------------------
+
+import authauth_model_database
+import authauth_model_hash_ring
+import authauth_view_utilities
+
+CHUNK_SIZE = 1000
+
+def convert_user_id(user_id, compact_user_ids):
+    """ Shards may store user IDs differently; see --compact_user_ids."""
+    if compact_user_ids and not isinstance(user_id, buffer):
+        return buffer(authauth_view_utilities.convert_uuid_string_to_bytes(user_id))
+    if not compact_user_ids and isinstance(user_id, buffer):
+        return authauth_view_utilities.convert_uuid_bytes_to_string(user_id)
+    return user_id
+
+def rebalance_shard(name, databases, ring, chunk_size = CHUNK_SIZE):
+    """ Move every identity on the shard called name that ring says
+    belongs elsewhere to its owner. Returns how many were moved."""
+    logger = logging.getLogger("%s.rebalance_shard" % (APP_NAME, ))
+    database = databases[name]
+    moved = 0
+    after = None
+    while True:
+        identities = database.get_identities_after(after, chunk_size)
+        if not identities:
+            break
+        after = identities[-1]
+        owners = {}
+        for (provider, external_id) in identities:
+            owner = ring.get_identity_name(provider, external_id)
+            if owner != name:
+                owners.setdefault(owner, []).append((provider, external_id))
+        for (owner, owned_identities) in sorted(owners.iteritems()):
+            target = databases[owner]
+            records = [(provider, external_id, convert_user_id(user_id, target.compact_user_ids), role_id, profile)
+                       for (provider, external_id, user_id, role_id, profile) in database.get_user_records(owned_identities)]
+            target.put_user_records(records)
+            database.delete_user_records(owned_identities)
+            moved += len(owned_identities)
+            logger.debug("moved %s identities from %s to %s" % (len(owned_identities), name, owner))
+    logger.info("moved %s identities off %s" % (moved, name))
+    return moved
+
+def rebalance_shard_lists(name, databases, ring, chunk_size = CHUNK_SIZE):
+    """ Move the ACL of every list on the shard called name that ring says
+    belongs elsewhere to its owner. Returns how many lists were moved."""
+    logger = logging.getLogger("%s.rebalance_shard_lists" % (APP_NAME, ))
+    database = databases[name]
+    moved = 0
+    after = None
+    while True:
+        list_ids = database.get_list_ids_after(after, chunk_size)
+        if not list_ids:
+            break
+        after = list_ids[-1]
+        owners = {}
+        for list_id in list_ids:
+            owner = ring.get_list_name(list_id)
+            if owner != name:
+                owners.setdefault(owner, []).append(list_id)
+        for (owner, owned_list_ids) in sorted(owners.iteritems()):
+            target = databases[owner]
+            records = [(list_id, convert_user_id(user_id, target.compact_user_ids), actions)
+                       for (list_id, user_id, actions) in database.get_list_acl_records(owned_list_ids)]
+            target.put_list_acl_records(records)
+            database.delete_list_acls(owned_list_ids)
+            moved += len(owned_list_ids)
+            logger.debug("moved %s lists from %s to %s" % (len(owned_list_ids), name, owner))
+    logger.info("moved %s lists off %s" % (moved, name))
+    return moved
+
+def rebalance(databases, chunk_size = CHUNK_SIZE):
+    ring = authauth_model_hash_ring.HashRing(databases.keys())
+    moved = sum(rebalance_shard(name, databases, ring, chunk_size)
+                for name in sorted(databases))
+    for name in sorted(databases):
+        rebalance_shard_lists(name, databases, ring, chunk_size)
+    return moved
+
+def get_args():
+    parser = argparse.ArgumentParser("Move users between the shards of a sharded authauth_model.")
+    parser.add_argument("--shard",
+                        dest="shards",
+                        metavar="NAME=FILEPATH",
+                        type=authauth_model_hash_ring.parse_shard,
+                        action="append",
+                        required=True,
+                        help="Give once per shard, exactly as authauth_model will be given them.")
+    parser.add_argument("--chunk_size",
+                        dest="chunk_size",
+                        type=int,
+                        default=CHUNK_SIZE,
+                        help="Identities, or lists, read per query, and most moved per transaction.")
+    parser.add_argument("--verbose",
+                        dest="verbose",
+                        action='store_true',
+                        default=False,
+                        help="Enable verbose debug mode.")
+    args = parser.parse_args()
+    for (name, location) in args.shards:
+        if "://" in location:
+            parser.error("shard '%s' is remote; run this where its database file is" % (name, ))
+    return args
+
+def main():
+    args = get_args()
+    if args.verbose:
+        logger.setLevel(logging.DEBUG)
+        ch.setLevel(logging.DEBUG)
+        logger.debug("Verbose mode enabled")
+    databases = dict((name, authauth_model_database.Database(filepath, busy_timeout = 5000))
+                     for (name, filepath) in args.shards)
+    try:
+        start_time = time.time()
+        moved = rebalance(databases, args.chunk_size)
+        logger.info("moved %s identities in %.1fs" % (moved, time.time() - start_time))
+    finally:
+        for database in databases.itervalues():
+            database.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,200 @@
+#!/usr/bin/env python2.7
+
+# ---------------------------------------------------------------------------
+# Copyright (c) 2012 Asim Ihsan (asim dot ihsan at gmail dot com)
+# Distributed under the MIT/X11 software license, see the accompanying
+# file license.txt or http://www.opensource.org/licenses/mit-license.php.
+# ---------------------------------------------------------------------------
+
+# ---------------------------------------------------------------------------
+#   authauth_model_replica.py: serve lookups read-only from snapshots of
+#   another authauth_model's database, so that reads can be spread over as
+#   many nodes as we like while one primary takes every write.
+#
+#   The primary, run with --snapshot_filepath, copies its database to a
+#   file every so often with SQLite's online backup API; see
+#   Database.snapshot(). A Replica opens that file read-only and, whenever
+#   a new snapshot has replaced it, opens the new one and switches over. A
+#   Replica looks to authauth_model like a Database, except that adding
+#   users is refused.
+#
+#   Roles and list ACLs come with each snapshot, so authorizing and
+#   checking access work as on the primary, and changing either is refused
+#   like adding users.
+#
+#   A replica is only ever as fresh as its snapshot. How stale that is,
+#   i.e. how long ago the snapshot was taken, is reported with every lookup
+#   and in 'stats'. Given max_staleness, lookups are refused rather than
+#   answered from a snapshot older than that, so that clients fall back to
+#   the primary when snapshots stop arriving. Staleness is measured
+#   against our clock and taken from the primary's, so keep the two in
+#   step.
+# ---------------------------------------------------------------------------
+
+import os
+import time
+
+import logging
+APP_NAME = "authauth_model.replica"
+logger = logging.getLogger(APP_NAME)
+
+class ReplicaException(Exception):
+    def __init__(self, reason):
+        self.reason = reason
+    def __str__(self):
+        return self.reason
+
+class ReadOnlyReplicaException(ReplicaException):
+    pass
+
+class StaleReplicaException(ReplicaException):
+    pass
+
+class Replica(object):
+    """ open_snapshot(filepath) opens the snapshot at filepath as a
+    read-only Database, configured as we want it."""
+
+    # Subscribe to the primary's change feed instead.
+    change_log = False
+
+    def __init__(self, snapshot_filepath, open_snapshot, max_staleness = None):
+        self.snapshot_filepath = snapshot_filepath
+        self.open_snapshot = open_snapshot
+        self.max_staleness = max_staleness
+        self.database = None
+        self.retired_database = None
+        self.snapshot_key = None
+        self.taken_at = None
+        self.loads = 0
+        self._stats = None
+        self.load()
+
+    # The current snapshot's caches, filter, index and executor.
+    @property
+    def user_id_cache(self):
+        return self.database.user_id_cache
+
+    @property
+    def user_role_cache(self):
+        return self.database.user_role_cache
+
+    @property
+    def list_acl_cache(self):
+        return self.database.list_acl_cache
+
+    @property
+    def identity_index(self):
+        return self.database.identity_index
+
+    @property
+    def identity_filter(self):
+        return self.database.identity_filter
+
+    @property
+    def identity_filter_rejections(self):
+        return self.database.identity_filter_rejections
+
+    @property
+    def executor(self):
+        return self.database.executor
+
+    @property
+    def stats(self):
+        return self._stats
+
+    @stats.setter
+    def stats(self, stats):
+        self._stats = stats
+        self.database.stats = stats
+
+    def load(self):
+        """ Switch to the snapshot at snapshot_filepath if a new one has
+        replaced the one we're serving. Returns whether we did."""
+        logger = logging.getLogger("%s.Replica.load" % (APP_NAME, ))
+        stat = os.stat(self.snapshot_filepath)
+        snapshot_key = (stat.st_ino, stat.st_mtime, stat.st_size)
+        if snapshot_key == self.snapshot_key:
+            return False
+        database = self.open_snapshot(self.snapshot_filepath)
+        database.stats = self._stats
+        taken_at = database.get_snapshot_time()
+        if taken_at is None:
+            taken_at = stat.st_mtime
+
+        # A user_id never changes once assigned, so whatever we've cached
+        # is as good for the new snapshot as it was for the old. Users'
+        # roles and lists' ACLs can change, so we don't carry those over.
+        if self.database is not None and self.database.user_id_cache is not None:
+            database.user_id_cache = self.database.user_id_cache
+
+        # Requests may still be waiting on the old snapshot's executor, so
+        # we only close it once we're done with the one after it.
+        if self.retired_database is not None:
+            self.retired_database.close()
+        self.retired_database = self.database
+        self.database = database
+        self.snapshot_key = snapshot_key
+        self.taken_at = taken_at
+        self.loads += 1
+        logger.info("serving snapshot %s, %.1f seconds old" % (self.snapshot_filepath, self.staleness()))
+        return True
+
+    def close(self):
+        for database in [self.retired_database, self.database]:
+            if database is not None:
+                database.close()
+
+    def staleness(self):
+        """ Seconds since the snapshot we're serving was taken."""
+        return max(time.time() - self.taken_at, 0.0)
+
+    def check_staleness(self):
+        staleness = self.staleness()
+        if self.max_staleness is not None and staleness > self.max_staleness:
+            raise StaleReplicaException("snapshot is %.1f seconds old, more than the %s allowed" % (staleness, self.max_staleness))
+
+    def get_user_id(self, provider, external_id):
+        self.check_staleness()
+        return self.database.get_user_id(provider, external_id)
+
+    def get_user_ids(self, identities):
+        self.check_staleness()
+        return self.database.get_user_ids(identities)
+
+    def add_user(self, provider, external_id, **profile):
+        raise ReadOnlyReplicaException("read-only replica; add users on the primary")
+
+    def get_or_create_user(self, provider, external_id, **profile):
+        raise ReadOnlyReplicaException("read-only replica; add users on the primary")
+
+    def add_users(self, identities, profiles = None):
+        raise ReadOnlyReplicaException("read-only replica; add users on the primary")
+
+    def authorize(self, user_id, privilege):
+        self.check_staleness()
+        return self.database.authorize(user_id, privilege)
+
+    def set_role(self, role_id, privileges, role_name = None):
+        raise ReadOnlyReplicaException("read-only replica; change roles on the primary")
+
+    def set_user_role(self, user_id, role_id):
+        raise ReadOnlyReplicaException("read-only replica; change roles on the primary")
+
+    def check_access(self, checks):
+        self.check_staleness()
+        return self.database.check_access(checks)
+
+    def set_list_access(self, list_id, user_id, actions):
+        raise ReadOnlyReplicaException("read-only replica; change access on the primary")
+
+    def save_user_id_cache(self, filepath):
+        self.database.save_user_id_cache(filepath)
+
+    def load_user_id_cache(self, filepath):
+        self.database.load_user_id_cache(filepath)
+
+    def as_dict(self):
+        return {"taken_at": self.taken_at,
+                "staleness": self.staleness(),
+                "max_staleness": self.max_staleness,
+                "loads": self.loads}
@@ -0,0 +1,70 @@
+#!/usr/bin/env python2.7
+
+# ---------------------------------------------------------------------------
+# Copyright (c) 2012 Asim Ihsan (asim dot ihsan at gmail dot com)
+# Distributed under the MIT/X11 software license, see the accompanying
+# file license.txt or http://www.opensource.org/licenses/mit-license.php.
+# ---------------------------------------------------------------------------
+
+# ---------------------------------------------------------------------------
+#   authauth_model_roles.py: what each role may do, compiled for checking
+#   on every request.
+#
+#   A role's privileges are stored in the role table as the names of the
+#   privileges separated by whitespace, e.g. "read write". A RoleTable
+#   parses every role once, gives each privilege name that any role holds
+#   a bit, and keeps each role's privileges as the OR of their bits, so
+#   that asking whether a role holds a privilege is two dict lookups and a
+#   bitwise AND. Bits are only meaningful within the RoleTable that
+#   assigned them; a new one is built whenever the roles change.
+# ---------------------------------------------------------------------------
+
+import re
+
+import logging
+APP_NAME = "authauth_model.roles"
+logger = logging.getLogger(APP_NAME)
+
+# A privilege name is one word, so that the stored list splits cleanly.
+PRIVILEGE_NAME_REGEXP = re.compile(r"^[A-Za-z0-9_.:\-]+\Z")
+
+def is_privilege_name(name):
+    return isinstance(name, basestring) and PRIVILEGE_NAME_REGEXP.match(name) is not None
+
+def parse_privileges(text):
+    """ The privilege names in a role's stored privileges, which may be
+    NULL."""
+    if not text:
+        return []
+    return text.split()
+
+def format_privileges(privileges):
+    """ Privilege names as we store them."""
+    return u" ".join(sorted(set(privileges)))
+
+class RoleTable(object):
+    """ roles is an iterable of (role_id, stored privileges) pairs, e.g.
+    the rows of the role table."""
+    def __init__(self, roles = ()):
+        parsed_roles = [(role_id, parse_privileges(text)) for (role_id, text) in roles]
+        names = sorted(set(name for (role_id, privileges) in parsed_roles for name in privileges))
+        self.privilege_bits = dict((name, 1 << position) for (position, name) in enumerate(names))
+        self.role_masks = dict((role_id, self.get_mask(privileges)) for (role_id, privileges) in parsed_roles)
+
+    def get_mask(self, privileges):
+        """ The OR of the bits of privileges, or 0 if no role holds any of
+        them."""
+        mask = 0
+        for name in privileges:
+            mask |= self.privilege_bits.get(name, 0)
+        return mask
+
+    def has_privilege(self, role_id, privilege):
+        """ Whether role_id holds privilege. Roles we don't know hold
+        nothing."""
+        bit = self.privilege_bits.get(privilege, 0)
+        return (self.role_masks.get(role_id, 0) & bit) != 0
+
+    def as_dict(self):
+        return {"roles": len(self.role_masks),
+                "privileges": len(self.privilege_bits)}
@@ -0,0 +1,312 @@
+#!/usr/bin/env python2.7
+
+# ---------------------------------------------------------------------------
+# Copyright (c) 2012 Asim Ihsan (asim dot ihsan at gmail dot com)
+# Distributed under the MIT/X11 software license, see the accompanying
+# file license.txt or http://www.opensource.org/licenses/mit-license.php.
+# ---------------------------------------------------------------------------
+
+# ---------------------------------------------------------------------------
+#   authauth_model_sharding.py: spread users over several databases, each
+#   with its own writer, by consistent hashing of their identities.
+#
+#   A ShardedDatabase looks to authauth_model like a Database. Each shard
+#   is either a local Database, i.e. another SQLite file, or a
+#   RemoteDatabase, i.e. another authauth_model node that we pass requests
+#   on to. Lookups and adds for one identity go to the one shard that owns
+#   it. Bulk lookups and adds are split up by shard and sent to all of them
+#   at once.
+#
+#   add_users is all or nothing within each shard, but not across shards:
+#   if one shard fails the users bound for the others may have been added.
+#
+#   A user_id says nothing of which shard its user is on, so authorizing a
+#   user asks every shard, and roles are set on every shard alike. A
+#   list's ACL lives on the shard that owns the list's ID, wherever its
+#   users are.
+#
+#   Adding a shard moves some identities to it; see authauth_model_rebalance.
+# ---------------------------------------------------------------------------
+
+import itertools
+
+import gevent
+import gevent.event
+from gevent_zeromq import zmq
+
+import apsw
+import authauth_model_codec
+from authauth_model_hash_ring import HashRing, VIRTUAL_NODES
+
+import logging
+APP_NAME = "authauth_model.sharding"
+logger = logging.getLogger(APP_NAME)
+
+# Seconds we wait for a remote shard to reply.
+REMOTE_TIMEOUT = 5.0
+
+class RemoteShardException(Exception):
+    def __init__(self, reason):
+        self.reason = reason
+    def __str__(self):
+        return self.reason
+
+def is_remote(location):
+    """ Whether a shard location is a ZeroMQ endpoint rather than a
+    database filepath."""
+    return "://" in location
+
+class RemoteDatabase(object):
+    """ A shard served by another authauth_model node. Requests from all
+    greenlets share one DEALER socket; each carries a request_id so we can
+    hand its reply back to whoever is waiting for it.
+
+    external_id_fields maps each user type to the field of a 'get_user' or
+    'add_user' message that identifies the user."""
+    def __init__(self, endpoint, external_id_fields, timeout = REMOTE_TIMEOUT, context = None):
+        self.endpoint = endpoint
+        self.external_id_fields = external_id_fields
+        self.timeout = timeout
+        self.context = context or zmq.Context.instance()
+        self.socket = None
+        self.receiver = None
+        self.request_ids = itertools.count()
+        self.waiting = {}
+        self.stats = None
+
+    def connect(self):
+        self.socket = self.context.socket(zmq.DEALER)
+        self.socket.setsockopt(zmq.LINGER, 0)
+        self.socket.connect(self.endpoint)
+        self.receiver = gevent.spawn(self._receive)
+
+    def close(self):
+        if self.receiver is not None:
+            self.receiver.kill(block = False)
+            self.receiver = None
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+
+    def _receive(self):
+        logger = logging.getLogger("%s.RemoteDatabase._receive" % (APP_NAME, ))
+        while True:
+            frames = self.socket.recv_multipart()
+            try:
+                reply = authauth_model_codec.decode(frames[-1])
+            except ValueError:
+                logger.exception("undecodable reply from %s" % (self.endpoint, ))
+                continue
+            result = self.waiting.pop(reply.get("request_id", None), None)
+            if result is not None:
+                result.set(reply)
+
+    def request(self, message_type, message_args):
+        if self.socket is None:
+            self.connect()
+        request_id = "%s" % (self.request_ids.next(), )
+        message = {"version": authauth_model_codec.VERSION_JSON,
+                   "message_type": message_type,
+                   "request_id": request_id}
+        for (key, value) in message_args.iteritems():
+            message[key] = value
+        result = gevent.event.AsyncResult()
+        self.waiting[request_id] = result
+        # The empty delimiter frame lets a REP socket, i.e. a node with
+        # --pool_size 0, answer us as well as a ROUTER socket.
+        self.socket.send_multipart(["", authauth_model_codec.encode(message)])
+        try:
+            return result.get(timeout = self.timeout)
+        except gevent.Timeout:
+            raise RemoteShardException("no '%s' reply from %s in %s seconds" % (message_type, self.endpoint, self.timeout))
+        finally:
+            self.waiting.pop(request_id, None)
+
+    def request_ok(self, message_type, message_args):
+        """ As request(), but raise RemoteShardException unless the reply's
+        status is "ok"."""
+        reply = self.request(message_type, message_args)
+        if reply.get("status") != "ok":
+            raise RemoteShardException("'%s' failed on %s: %s" % (message_type, self.endpoint, reply.get("reason", "no reason given")))
+        return reply
+
+    def get_user_id(self, provider, external_id):
+        reply = self.request_ok("get_user", {"user_type": provider,
+                                             self.external_id_fields[provider]: external_id})
+        return reply["user_id"]
+
+    def get_user_ids(self, identities):
+        reply = self.request_ok("get_users", {"users": [[provider, external_id] for (provider, external_id) in identities]})
+        return reply["user_ids"]
+
+    def add_user(self, provider, external_id, **profile):
+        message_args = {"user_type": provider,
+                        self.external_id_fields[provider]: external_id}
+        message_args.update(profile)
+        reply = self.request_ok("add_user", message_args)
+        return reply["user_id"]
+
+    def get_or_create_user(self, provider, external_id, **profile):
+        message_args = {"user_type": provider,
+                        self.external_id_fields[provider]: external_id}
+        message_args.update(profile)
+        reply = self.request_ok("get_or_create_user", message_args)
+        return (reply["user_id"], reply["created"])
+
+    def authorize(self, user_id, privilege):
+        reply = self.request_ok("authorize", {"user_id": user_id,
+                                              "privilege": privilege})
+        return reply["authorized"]
+
+    def set_role(self, role_id, privileges, role_name = None):
+        message_args = {"role_id": role_id,
+                        "privileges": list(privileges)}
+        if role_name is not None:
+            message_args["role_name"] = role_name
+        self.request_ok("set_role", message_args)
+
+    def set_user_role(self, user_id, role_id):
+        reply = self.request("set_user_role", {"user_id": user_id,
+                                               "role_id": role_id})
+        return reply["status"] == "ok"
+
+    def check_access(self, checks):
+        reply = self.request_ok("check_access", {"checks": [[user_id, list_id, action] for (user_id, list_id, action) in checks]})
+        return reply["allowed"]
+
+    def set_list_access(self, list_id, user_id, actions):
+        reply = self.request("set_list_access", {"list_id": list_id,
+                                                 "user_id": user_id,
+                                                 "actions": list(actions)})
+        if reply["status"] != "ok":
+            raise ValueError(reply.get("reason", "set_list_access failed on %s" % (self.endpoint, )))
+
+    def add_users(self, identities, profiles = None):
+        message_args = {"users": [[provider, external_id] for (provider, external_id) in identities]}
+        if profiles is not None and any(profiles):
+            message_args["profiles"] = profiles
+        reply = self.request("add_users", message_args)
+        if reply["status"] != "ok":
+            raise apsw.ConstraintError(reply.get("reason", "add_users failed on %s" % (self.endpoint, )))
+        return reply["user_ids"]
+
+class ShardedDatabase(object):
+    """ shards maps each shard's name to its Database or RemoteDatabase.
+    committers, if given, maps the names of local shards to the
+    authauth_model_group_commit.GroupCommitter that add_user should go
+    through for them."""
+
+    # The shards keep their own caches, filters and executors, and there's
+    # no one change log or index to speak of.
+    user_id_cache = None
+    user_role_cache = None
+    list_acl_cache = None
+    identity_filter = None
+    identity_index = None
+    executor = None
+    change_log = False
+
+    def __init__(self, shards, committers = None, virtual_nodes = VIRTUAL_NODES):
+        self.shards = shards
+        self.committers = committers or {}
+        self.ring = HashRing(shards.keys(), virtual_nodes)
+        self._stats = None
+
+    @property
+    def stats(self):
+        return self._stats
+
+    @stats.setter
+    def stats(self, stats):
+        self._stats = stats
+        for shard in self.shards.itervalues():
+            shard.stats = stats
+
+    def close(self):
+        for shard in self.shards.itervalues():
+            shard.close()
+
+    def get_shard_name(self, provider, external_id):
+        return self.ring.get_identity_name(provider, external_id)
+
+    def _split(self, identities):
+        """ Group the positions of identities by the shard that owns
+        them."""
+        positions = {}
+        for (position, (provider, external_id)) in enumerate(identities):
+            positions.setdefault(self.get_shard_name(provider, external_id), []).append(position)
+        return positions
+
+    def get_user_id(self, provider, external_id):
+        name = self.get_shard_name(provider, external_id)
+        return self.shards[name].get_user_id(provider, external_id)
+
+    def get_user_ids(self, identities):
+        positions = self._split(identities)
+        jobs = dict((name, gevent.spawn(self.shards[name].get_user_ids,
+                                        [identities[position] for position in shard_positions]))
+                    for (name, shard_positions) in positions.iteritems())
+        gevent.joinall(jobs.values(), raise_error = True)
+        user_ids = [None] * len(identities)
+        for (name, shard_positions) in positions.iteritems():
+            for (position, user_id) in zip(shard_positions, jobs[name].value):
+                user_ids[position] = user_id
+        return user_ids
+
+    def add_user(self, provider, external_id, **profile):
+        name = self.get_shard_name(provider, external_id)
+        writer = self.committers.get(name, self.shards[name])
+        return writer.add_user(provider, external_id, **profile)
+
+    def get_or_create_user(self, provider, external_id, **profile):
+        name = self.get_shard_name(provider, external_id)
+        return self.shards[name].get_or_create_user(provider, external_id, **profile)
+
+    def add_users(self, identities, profiles = None):
+        if profiles is None:
+            profiles = [{}] * len(identities)
+        positions = self._split(identities)
+        jobs = dict((name, gevent.spawn(self.shards[name].add_users,
+                                        [identities[position] for position in shard_positions],
+                                        [profiles[position] for position in shard_positions]))
+                    for (name, shard_positions) in positions.iteritems())
+        gevent.joinall(jobs.values())
+        for job in jobs.itervalues():
+            if job.exception is not None:
+                raise job.exception
+        user_ids = [None] * len(identities)
+        for (name, shard_positions) in positions.iteritems():
+            for (position, user_id) in zip(shard_positions, jobs[name].value):
+                user_ids[position] = user_id
+        return user_ids
+
+    def _ask_every_shard(self, method, *args):
+        jobs = [gevent.spawn(getattr(shard, method), *args) for shard in self.shards.itervalues()]
+        gevent.joinall(jobs, raise_error = True)
+        return [job.value for job in jobs]
+
+    def authorize(self, user_id, privilege):
+        return any(self._ask_every_shard("authorize", user_id, privilege))
+
+    def set_role(self, role_id, privileges, role_name = None):
+        self._ask_every_shard("set_role", role_id, privileges, role_name)
+
+    def set_user_role(self, user_id, role_id):
+        return any(self._ask_every_shard("set_user_role", user_id, role_id))
+
+    def check_access(self, checks):
+        positions = {}
+        for (position, (user_id, list_id, action)) in enumerate(checks):
+            positions.setdefault(self.ring.get_list_name(list_id), []).append(position)
+        jobs = dict((name, gevent.spawn(self.shards[name].check_access,
+                                        [checks[position] for position in shard_positions]))
+                    for (name, shard_positions) in positions.iteritems())
+        gevent.joinall(jobs.values(), raise_error = True)
+        allowed = [False] * len(checks)
+        for (name, shard_positions) in positions.iteritems():
+            for (position, shard_allowed) in zip(shard_positions, jobs[name].value):
+                allowed[position] = shard_allowed
+        return allowed
+
+    def set_list_access(self, list_id, user_id, actions):
+        self.shards[self.ring.get_list_name(list_id)].set_list_access(list_id, user_id, actions)
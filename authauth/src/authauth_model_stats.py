@@ -0,0 +1,93 @@
+#!/usr/bin/env python2.7
+
+# ---------------------------------------------------------------------------
+# Copyright (c) 2012 Asim Ihsan (asim dot ihsan at gmail dot com)
+# Distributed under the MIT/X11 software license, see the accompanying
+# file license.txt or http://www.opensource.org/licenses/mit-license.php.
+# ---------------------------------------------------------------------------
+
+# ---------------------------------------------------------------------------
+#   authauth_model_stats.py: counters and latency histograms for
+#   authauth_model, cheap enough to leave on all the time.
+#
+#   Histograms have fixed bucket boundaries, so recording a value is a
+#   bisect over a short list and an increment; nothing is allocated and
+#   nothing grows with traffic.
+# ---------------------------------------------------------------------------
+
+import bisect
+import time
+from collections import defaultdict
+
+# Upper bounds of the latency histogram buckets, in seconds. Anything
+# slower than the last bound goes into one final overflow bucket.
+LATENCY_BUCKETS = [0.0001, 0.00025, 0.0005,
+                   0.001, 0.0025, 0.005,
+                   0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0]
+
+class Histogram(object):
+    def __init__(self, buckets = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def record(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+
+    def as_dict(self):
+        return {"count": self.count,
+                "sum": self.total,
+                "counts": list(self.counts)}
+
+class Stats(object):
+    """ Everything authauth_model counts about itself: requests and
+    errors per message type, latency per message type and per SQL
+    statement, and how many requests are in flight."""
+    def __init__(self):
+        self.start_time = time.time()
+        self.message_counts = defaultdict(int)
+        self.error_counts = defaultdict(int)
+        self.message_latencies = defaultdict(Histogram)
+        self.statement_latencies = defaultdict(Histogram)
+
+        # Set to a function returning the number of requests currently
+        # being handled, if the server can tell.
+        self.in_flight = None
+
+    def reset(self):
+        self.__init__()
+
+    def record_message(self, message_type, elapsed):
+        self.message_counts[message_type] += 1
+        self.message_latencies[message_type].record(elapsed)
+
+    def record_error(self, message_type):
+        self.error_counts[message_type] += 1
+
+    def record_statement(self, statement, elapsed):
+        self.statement_latencies[statement].record(elapsed)
+
+    def as_dict(self):
+        message_types = set(self.message_counts).union(self.error_counts)
+        messages = {}
+        for message_type in message_types:
+            messages[message_type] = {"count": self.message_counts.get(message_type, 0),
+                                      "errors": self.error_counts.get(message_type, 0)}
+            if message_type in self.message_latencies:
+                messages[message_type]["latency"] = self.message_latencies[message_type].as_dict()
+        # Statements may be recorded from an executor's threads as we go,
+        # so take a copy of the table rather than iterating over it.
+        statements = dict((statement, histogram.as_dict())
+                          for (statement, histogram) in self.statement_latencies.items())
+        rv = {"uptime": time.time() - self.start_time,
+              "latency_buckets": LATENCY_BUCKETS,
+              "messages": messages,
+              "statements": statements}
+        if self.in_flight is not None:
+            rv["in_flight"] = self.in_flight()
+        return rv
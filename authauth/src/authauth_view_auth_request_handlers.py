@@ -133,23 +133,13 @@ class LoginBrowserIDHandler(BaseLoginHandler):
         if struct['status'] != 'okay':
             raise tornado.web.HTTPError(400, "BrowserID status not okay")
 
-        # Does a user already exist for these BrowserID credentials?
-        # BrowserID credentials are uniquely identified by the email
-        # address.
+        # Find the user for these BrowserID credentials, creating them if
+        # they don't exist yet. BrowserID credentials are uniquely
+        # identified by the email address.
         email = struct['email']
-        user_id = yield tornado.gen.Task(self.db.get_user_id_from_browserid_email,
-                                 email)
+        user_id = yield tornado.gen.Task(self.db.get_or_create_browserid_user,
+                                         email)
         logger.debug("user_id: %s" % (user_id, ))
-        if not user_id:
-            # User does not exist.
-            logger.debug("User does not exist.")
-            user_id = yield tornado.gen.Task(self.db.create_user, "regular")
-            logger.debug("user_id: %s" % (user_id, ))
-            rc = yield tornado.gen.Task(self.db.create_auth_browserid,
-                                        email,
-                                        user_id)
-            logger.debug("create_auth_browserid rc: %s" % (rc, ))
-            assert(rc == True)
 
         self.set_secure_cookie_and_authorization(user_id, "browserid")
 
@@ -190,24 +180,13 @@ class LoginTwitterHandler(BaseLoginHandler, tornado.auth.TwitterMixin):
             raise tornado.web.HTTPError(500, "Twitter authentication failed")
         assert("username" in user)
 
-        # Does a user already exist for these Twitter credentials?
-        # Twitter credentials are uniquely identified by the username
-        user_id = yield tornado.gen.Task(self.db.get_user_id_from_twitter_username,
-                                         user["username"])
+        # Find the user for these Twitter credentials, creating them if
+        # they don't exist yet. Twitter credentials are uniquely
+        # identified by the username.
+        user_id = yield tornado.gen.Task(self.db.get_or_create_twitter_user,
+                                         user["username"],
+                                         profile_image_url = user.get("profile_image_url", None))
         logger.debug("user_id: %s" % (user_id, ))
-        if not user_id:
-            # User does not exist.
-            logger.debug("User does not exist.")
-            assert("profile_image_url" in user)
-
-            user_id = yield tornado.gen.Task(self.db.create_user, "regular")
-            logger.debug("user_id: %s" % (user_id, ))
-            rc = yield tornado.gen.Task(self.db.create_auth_twitter,
-                                        user["username"],
-                                        user_id,
-                                        user["profile_image_url"])
-            logger.debug("create_auth_twitter rc: %s" % (rc, ))
-            assert(rc == True)
 
         self.set_secure_cookie_and_authorization(user_id, "twitter")
         self.redirect("/")
@@ -257,36 +236,19 @@ class LoginFacebookHandler(BaseLoginHandler, tornado.auth.FacebookGraphMixin):
             raise tornado.web.HTTPError(500, "Facebook authentication failed")
         assert("id" in user)
 
-        # Does a user already exist for these Facebook credentials?
-        # Facebook credentials are uniquely identified by the id
-        user_id = yield tornado.gen.Task(self.db.get_user_id_from_facebook_id,
-                                         user["id"])
+        # Find the user for these Facebook credentials, creating them if
+        # they don't exist yet. Facebook credentials are uniquely
+        # identified by the id.
+        user_id = yield tornado.gen.Task(self.db.get_or_create_facebook_user,
+                                         user["id"],
+                                         link = user.get("link", None),
+                                         access_token = user.get("access_token", None),
+                                         locale = user.get("locale", None),
+                                         first_name = user.get("first_name", None),
+                                         last_name = user.get("last_name", None),
+                                         name = user.get("name", None),
+                                         picture = user.get("picture", None))
         logger.debug("user_id: %s" % (user_id, ))
-        if not user_id:
-            # User does not exist.
-            logger.debug("User does not exist.")
-            assert("link" in user)
-            assert("access_token" in user)
-            assert("locale" in user)
-            assert("first_name" in user)
-            assert("last_name" in user)
-            assert("name" in user)
-            assert("picture" in user)
-
-            user_id = yield tornado.gen.Task(self.db.create_user, "regular")
-            logger.debug("user_id: %s" % (user_id, ))
-            rc = yield tornado.gen.Task(self.db.create_auth_facebook,
-                                        user["id"],
-                                        user_id,
-                                        user["link"],
-                                        user["access_token"],
-                                        user["locale"],
-                                        user["first_name"],
-                                        user["last_name"],
-                                        user["name"],
-                                        user["picture"])
-            logger.debug("create_auth_facebook rc: %s" % (rc, ))
-            assert(rc == True)
 
         self.set_secure_cookie_and_authorization(user_id, "facebook")
         self.redirect("/")
@@ -353,32 +315,16 @@ class LoginGoogleHandler(BaseLoginHandler, tornado.auth.GoogleMixin):
             raise tornado.web.HTTPError(500, "Google authentication failed")
         assert("email" in user)
 
-        # Does a user already exist for these Google credentials?
-        # Google credentials are uniquely identified by the email address.
-        # !!AI TODO
-        #user_id = yield tornado.gen.Task(self.db.get_user_id_from_google_email,
-        #                                 user["email"])
-        user_id = "userid"
+        # Find the user for these Google credentials, creating them if
+        # they don't exist yet. Google credentials are uniquely identified
+        # by the email address.
+        user_id = yield tornado.gen.Task(self.db.get_or_create_google_user,
+                                         user["email"],
+                                         first_name = user.get("first_name", None),
+                                         last_name = user.get("last_name", None),
+                                         name = user.get("name", None),
+                                         locale = user.get("locale", None))
         logger.debug("user_id: %s" % (user_id, ))
-        if not user_id:
-            # User does not exist.
-            logger.debug("User does not exist.")
-            assert("first_name" in user)
-            assert("last_name" in user)
-            assert("name" in user)
-            assert("locale" in user)
-
-            user_id = yield tornado.gen.Task(self.db.create_user, "regular")
-            logger.debug("user_id: %s" % (user_id, ))
-            rc = yield tornado.gen.Task(self.db.create_auth_google,
-                                        user["email"],
-                                        user_id,
-                                        user["first_name"],
-                                        user["last_name"],
-                                        user["name"],
-                                        user["locale"])
-            logger.debug("create_auth_twitter rc: %s" % (rc, ))
-            assert(rc == True)
 
         self.set_secure_cookie_and_authorization(user_id, "google")
 
@@ -4,6 +4,8 @@ import tornado
 from tornado.options import define, options
 import re
 
+from authauth_view_model_client import ModelClient, ShardedModelClient, parse_shard
+
 # ----------------------------------------------------------------------------
 #   Base request handler.
 # ----------------------------------------------------------------------------
@@ -12,12 +14,22 @@ class BaseHandler(tornado.web.RequestHandler):
 
     @property
     def db(self):
-        """ Create a database connection when a request handler is called
-        and store the connection in the application object.
+        """ Create a client for authauth_model when a request handler is
+        called and store it in the application object. We do this lazily
+        so that each forked process gets its own ZeroMQ sockets.
         """
         if not hasattr(self.application, 'db'):
-            self.application.db = None
-            #self.application.db = database.DatabaseManager()
+            if options.authauth_model_shards:
+                shards = [parse_shard(shard) for shard in options.authauth_model_shards]
+                self.application.db = ShardedModelClient(shards,
+                                                         pool_size = options.authauth_model_pool_size,
+                                                         timeout = options.authauth_model_timeout,
+                                                         attempts = options.authauth_model_retries)
+            else:
+                self.application.db = ModelClient(options.authauth_model_zeromq_binding,
+                                                  pool_size = options.authauth_model_pool_size,
+                                                  timeout = options.authauth_model_timeout,
+                                                  attempts = options.authauth_model_retries)
         return self.application.db
 
     @property
@@ -0,0 +1,405 @@
+import collections
+import functools
+import json
+import logging
+import time
+
+import zmq
+from zmq.eventloop import ioloop
+from zmq.eventloop.zmqstream import ZMQStream
+
+import tornado
+from tornado import stack_context
+from tornado.options import define, options
+
+from authauth_model_hash_ring import HashRing, parse_shard
+
+# ----------------------------------------------------------------------------
+#   Configuration constants.
+# ----------------------------------------------------------------------------
+define("authauth_model_zeromq_binding", default="tcp://localhost:5556", help="ZeroMQ binding authauth_model serves requests on")
+define("authauth_model_pool_size", default=4, type=int, help="Number of ZeroMQ sockets each process keeps open to authauth_model")
+define("authauth_model_timeout", default=2.5, type=float, help="Seconds to wait for authauth_model to reply before retrying")
+define("authauth_model_retries", default=3, type=int, help="Attempts at each authauth_model request before giving up")
+define("authauth_model_shards", default=[], multiple=True, help="NAME=BINDING of each authauth_model shard, to route requests to the shard owning each user ourselves rather than through authauth_model_zeromq_binding. The NAMEs must be those authauth_model was given")
+# ----------------------------------------------------------------------------
+
+class ModelUnavailableException(Exception):
+    def __init__(self, reason):
+        self.reason = reason
+    def __str__(self):
+        return repr(self.reason)
+
+class ModelErrorException(Exception):
+    def __init__(self, reason):
+        self.reason = reason
+    def __str__(self):
+        return repr(self.reason)
+
+class ModelRequest(object):
+    def __init__(self, message, callback, attempts):
+        self.message = message
+        self.callback = callback
+        self.attempts_left = attempts
+        # The stream the request was last sent on, and what to call if
+        # it doesn't get a reply in time.
+        self.stream = None
+        self.on_timeout = None
+
+# ----------------------------------------------------------------------------
+#   Requests the request handlers make, whichever client they make them
+#   through.
+# ----------------------------------------------------------------------------
+def get_reply_field(callback, field):
+    """ A callback for request() that calls back with the reply's field.
+    If authauth_model never replied raise ModelUnavailableException, and
+    if it couldn't do what we asked raise ModelErrorException, in the
+    stack context the request was made in."""
+    def on_reply(reply):
+        if reply["status"] == "unavailable":
+            raise ModelUnavailableException(reply["reason"])
+        if reply["status"] != "ok":
+            raise ModelErrorException(reply.get("reason", "'%s' failed" % (reply.get("message_type"), )))
+        callback(reply[field])
+    return on_reply
+
+def get_google_profile(first_name, last_name, name, locale):
+    return {"first_name": first_name,
+            "last_name": last_name,
+            "name": name,
+            "locale": locale}
+
+def get_twitter_profile(profile_image_url):
+    return {"profile_image_url": profile_image_url}
+
+def get_facebook_profile(link, access_token, locale, first_name, last_name, name, picture):
+    return {"link": link,
+            "access_token": access_token,
+            "locale": locale,
+            "first_name": first_name,
+            "last_name": last_name,
+            "name": name,
+            "picture": picture}
+
+class BaseModelClient(object):
+    """ Subclasses provide request(message_type, message_args, callback),
+    or override whichever of these use it."""
+    def ping(self, callback):
+        self.request("ping", {}, lambda reply: callback(reply["status"] == "ok"))
+
+    def get_user_id(self, user_type, external_id_field, external_id, callback):
+        """ Calls back with the internal user ID of the user who logs in
+        with user_type as external_id, or None if there isn't one."""
+        message_args = {"user_type": user_type,
+                        external_id_field: external_id}
+        self.request("get_user", message_args, get_reply_field(callback, "user_id"))
+
+    def add_user(self, user_type, external_id_field, external_id, profile, callback):
+        """ Calls back with the internal user ID of a newly created user
+        who logs in with user_type as external_id."""
+        message_args = {"user_type": user_type,
+                        external_id_field: external_id}
+        for (key, value) in profile.iteritems():
+            message_args[key] = value
+        self.request("add_user", message_args, get_reply_field(callback, "user_id"))
+
+    def get_or_create_user(self, user_type, external_id_field, external_id, profile, callback):
+        """ Calls back with the internal user ID of the user who logs in
+        with user_type as external_id, creating them with profile first if
+        there isn't one, in one round trip."""
+        message_args = {"user_type": user_type,
+                        external_id_field: external_id}
+        for (key, value) in profile.iteritems():
+            message_args[key] = value
+        self.request("get_or_create_user", message_args, get_reply_field(callback, "user_id"))
+
+    def authorize(self, user_id, privilege, callback):
+        """ Calls back with whether the user with user_id holds
+        privilege."""
+        message_args = {"user_id": user_id,
+                        "privilege": privilege}
+        self.request("authorize", message_args, get_reply_field(callback, "authorized"))
+
+    def check_access(self, checks, callback):
+        """ Calls back with whether each of checks, a (user_id, list_id,
+        action), is allowed, in one round trip however many there are."""
+        message_args = {"checks": [[user_id, list_id, action] for (user_id, list_id, action) in checks]}
+        self.request("check_access", message_args, get_reply_field(callback, "allowed"))
+
+    def get_user_id_from_google_email(self, email, callback):
+        self.get_user_id("google", "email", email, callback)
+
+    def get_user_id_from_browserid_email(self, email, callback):
+        self.get_user_id("browserid", "email", email, callback)
+
+    def get_user_id_from_twitter_username(self, username, callback):
+        self.get_user_id("twitter", "username", username, callback)
+
+    def get_user_id_from_facebook_id(self, facebook_id, callback):
+        self.get_user_id("facebook", "facebook_id", facebook_id, callback)
+
+    def get_user_id_from_api_secret_key(self, api_secret_key, callback):
+        self.get_user_id("api", "api_secret_key", api_secret_key, callback)
+
+    def add_google_user(self,
+                        email,
+                        first_name = None,
+                        last_name = None,
+                        name = None,
+                        locale = None,
+                        callback = None):
+        profile = get_google_profile(first_name, last_name, name, locale)
+        self.add_user("google", "email", email, profile, callback)
+
+    def add_browserid_user(self, email, callback = None):
+        self.add_user("browserid", "email", email, {}, callback)
+
+    def add_twitter_user(self,
+                         username,
+                         profile_image_url = None,
+                         callback = None):
+        profile = get_twitter_profile(profile_image_url)
+        self.add_user("twitter", "username", username, profile, callback)
+
+    def add_facebook_user(self,
+                          facebook_id,
+                          link = None,
+                          access_token = None,
+                          locale = None,
+                          first_name = None,
+                          last_name = None,
+                          name = None,
+                          picture = None,
+                          callback = None):
+        profile = get_facebook_profile(link, access_token, locale, first_name, last_name, name, picture)
+        self.add_user("facebook", "facebook_id", facebook_id, profile, callback)
+
+    def get_or_create_google_user(self,
+                                  email,
+                                  first_name = None,
+                                  last_name = None,
+                                  name = None,
+                                  locale = None,
+                                  callback = None):
+        profile = get_google_profile(first_name, last_name, name, locale)
+        self.get_or_create_user("google", "email", email, profile, callback)
+
+    def get_or_create_browserid_user(self, email, callback = None):
+        self.get_or_create_user("browserid", "email", email, {}, callback)
+
+    def get_or_create_twitter_user(self,
+                                   username,
+                                   profile_image_url = None,
+                                   callback = None):
+        profile = get_twitter_profile(profile_image_url)
+        self.get_or_create_user("twitter", "username", username, profile, callback)
+
+    def get_or_create_facebook_user(self,
+                                    facebook_id,
+                                    link = None,
+                                    access_token = None,
+                                    locale = None,
+                                    first_name = None,
+                                    last_name = None,
+                                    name = None,
+                                    picture = None,
+                                    callback = None):
+        profile = get_facebook_profile(link, access_token, locale, first_name, last_name, name, picture)
+        self.get_or_create_user("facebook", "facebook_id", facebook_id, profile, callback)
+
+    def expire_cache(self, user_id):
+        """ We don't cache anything about users in the view yet, so there
+        is nothing to expire."""
+        pass
+# ----------------------------------------------------------------------------
+
+# ----------------------------------------------------------------------------
+#   Asynchronous client for authauth_model.
+# ----------------------------------------------------------------------------
+class ModelClient(BaseModelClient):
+    """ Talks to authauth_model over ZeroMQ without ever blocking the
+    IOLoop. Every method takes a callback, so the request handlers can
+    call them through tornado.gen.Task.
+
+    We keep a small pool of REQ sockets and send each request on an idle
+    one; if every socket is busy the request waits its turn. If a reply
+    doesn't arrive within the timeout the REQ socket is stuck waiting for
+    it forever, so we close the socket, open a fresh one and try again
+    (the "Lazy Pirate" pattern). Once a request has used up its attempts
+    we call back with a reply of our own whose status is "unavailable";
+    see get_reply_field(). Callbacks and timeouts run in the stack
+    context of whoever made the request, so whatever they raise reaches
+    the request handler that made the call.
+    """
+    def __init__(self,
+                 zeromq_binding,
+                 pool_size = 4,
+                 timeout = 2.5,
+                 attempts = 3,
+                 io_loop = None,
+                 context = None):
+        self.zeromq_binding = zeromq_binding
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.attempts = attempts
+        self.io_loop = io_loop or ioloop.IOLoop.instance()
+        self.context = context or zmq.Context.instance()
+        self.idle_streams = []
+        # stream to the timeout of the request it's waiting on.
+        self.busy_streams = {}
+        self.number_of_streams = 0
+        self.waiting_requests = collections.deque()
+
+    def close(self):
+        """ Close every stream, abandoning the requests under way or
+        waiting; none of them will be called back."""
+        for stream in self.idle_streams:
+            stream.close()
+        for (stream, timeout) in self.busy_streams.iteritems():
+            self.io_loop.remove_timeout(timeout)
+            stream.stop_on_recv()
+            stream.close()
+        self.idle_streams = []
+        self.busy_streams = {}
+        self.number_of_streams = 0
+        self.waiting_requests.clear()
+
+    def request(self, message_type, message_args, callback):
+        """ Send a request to authauth_model and call back with the decoded
+        reply."""
+        message = {"version": "1.0",
+                   "message_type": message_type}
+        for (key, value) in message_args.iteritems():
+            message[key] = value
+        request = ModelRequest(message, stack_context.wrap(callback), self.attempts)
+        request.on_timeout = stack_context.wrap(functools.partial(self._on_timeout, request))
+        self.waiting_requests.append(request)
+        self._dispatch()
+
+    def _dispatch(self):
+        while self.waiting_requests:
+            stream = self._get_stream()
+            if stream is None:
+                return
+            self._send(stream, self.waiting_requests.popleft())
+
+    def _get_stream(self):
+        if self.idle_streams:
+            return self.idle_streams.pop()
+        if self.number_of_streams < self.pool_size:
+            socket = self.context.socket(zmq.REQ)
+            socket.setsockopt(zmq.LINGER, 0)
+            socket.connect(self.zeromq_binding)
+            self.number_of_streams += 1
+            return ZMQStream(socket, self.io_loop)
+        return None
+
+    def _send(self, stream, request):
+        request.stream = stream
+        timeout = self.io_loop.add_timeout(time.time() + self.timeout, request.on_timeout)
+        self.busy_streams[stream] = timeout
+        stream.on_recv(functools.partial(self._on_reply, stream, request, timeout))
+        stream.send(json.dumps(request.message))
+
+    def _on_reply(self, stream, request, timeout, frames):
+        self.io_loop.remove_timeout(timeout)
+        stream.stop_on_recv()
+        del self.busy_streams[stream]
+        self.idle_streams.append(stream)
+        self._dispatch()
+        request.callback(json.loads(frames[-1]))
+
+    def _on_timeout(self, request):
+        logger = logging.getLogger("ModelClient._on_timeout")
+        stream = request.stream
+        stream.stop_on_recv()
+        stream.close()
+        del self.busy_streams[stream]
+        self.number_of_streams -= 1
+        request.attempts_left -= 1
+        logger.debug("no reply to '%s', %s attempts left" % (request.message["message_type"], request.attempts_left))
+        if request.attempts_left > 0:
+            self.waiting_requests.appendleft(request)
+            self._dispatch()
+            return
+        self._dispatch()
+        request.callback({"message_type": "%s_response" % (request.message["message_type"], ),
+                          "status": "unavailable",
+                          "reason": "no reply from authauth_model at %s" % (self.zeromq_binding, )})
+# ----------------------------------------------------------------------------
+
+# ----------------------------------------------------------------------------
+#   Client for a sharded authauth_model.
+# ----------------------------------------------------------------------------
+class ShardedModelClient(BaseModelClient):
+    """ Sends each request straight to the authauth_model that owns its
+    user, routing exactly as authauth_model --shard does, so the view can
+    talk to shards on other machines without a hop through a sharding
+    authauth_model. shards is a list of (name, zeromq_binding); any other
+    keyword arguments are passed to each shard's ModelClient.
+    """
+    def __init__(self, shards, **kwds):
+        self.clients = dict((name, ModelClient(zeromq_binding, **kwds))
+                            for (name, zeromq_binding) in shards)
+        self.ring = HashRing(self.clients.keys())
+
+    def close(self):
+        for client in self.clients.itervalues():
+            client.close()
+
+    def ping(self, callback):
+        """ Calls back with whether every shard answered."""
+        replies = []
+        def on_reply(ok):
+            replies.append(ok)
+            if len(replies) == len(self.clients):
+                callback(all(replies))
+        for client in self.clients.itervalues():
+            client.ping(on_reply)
+
+    def get_client(self, user_type, external_id):
+        return self.clients[self.ring.get_identity_name(user_type, external_id)]
+
+    def get_user_id(self, user_type, external_id_field, external_id, callback):
+        client = self.get_client(user_type, external_id)
+        client.get_user_id(user_type, external_id_field, external_id, callback)
+
+    def add_user(self, user_type, external_id_field, external_id, profile, callback):
+        client = self.get_client(user_type, external_id)
+        client.add_user(user_type, external_id_field, external_id, profile, callback)
+
+    def get_or_create_user(self, user_type, external_id_field, external_id, profile, callback):
+        client = self.get_client(user_type, external_id)
+        client.get_or_create_user(user_type, external_id_field, external_id, profile, callback)
+
+    def authorize(self, user_id, privilege, callback):
+        """ A user_id doesn't say which shard its user is on, so ask them
+        all; only the one that has the user can say yes."""
+        replies = []
+        def on_reply(authorized):
+            replies.append(authorized)
+            if len(replies) == len(self.clients):
+                callback(any(replies))
+        for client in self.clients.itervalues():
+            client.authorize(user_id, privilege, on_reply)
+
+    def check_access(self, checks, callback):
+        """ Each list's ACL lives on the shard that owns the list, so send
+        each shard the checks about its lists."""
+        positions = {}
+        for (position, (user_id, list_id, action)) in enumerate(checks):
+            positions.setdefault(self.ring.get_list_name(list_id), []).append(position)
+        if not positions:
+            return callback([])
+        allowed = [False] * len(checks)
+        replies = []
+        def on_reply(shard_positions, shard_allowed):
+            for (position, value) in zip(shard_positions, shard_allowed):
+                allowed[position] = value
+            replies.append(shard_positions)
+            if len(replies) == len(positions):
+                callback(allowed)
+        for (name, shard_positions) in positions.iteritems():
+            self.clients[name].check_access([checks[position] for position in shard_positions],
+                                            functools.partial(on_reply, shard_positions))
+# ----------------------------------------------------------------------------
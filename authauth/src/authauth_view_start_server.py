@@ -1,5 +1,10 @@
 #!/usr/bin/env python2.7
 
+# Have tornado's IOLoop poll ZeroMQ sockets as well, for the authauth_model
+# client. This must happen before anything creates the IOLoop.
+from zmq.eventloop import ioloop
+ioloop.install()
+
 import tornado
 import tornado.ioloop
 import tornado.web
@@ -58,4 +58,14 @@ def convert_uuid_string_to_base64(uuid_string):
 def convert_base64_to_uuid_string(base64_string):
     logger = logging.getLogger("List.convert_base64_to_uuid_string")        
     decoded = base64.urlsafe_b64decode(base64_string)        
-    return uuid.UUID(bytes=decoded).hex
\ No newline at end of file
+    return uuid.UUID(bytes=decoded).hex
+
+def convert_uuid_bytes_to_string(uuid_bytes):
+    """ Given the 16 bytes of a UUID, as a str or a buffer, e.g. a user ID
+    as the model stores it, return the ASCII hex version we pass around."""
+    return uuid.UUID(bytes=str(uuid_bytes)).hex
+
+def convert_uuid_string_to_bytes(uuid_string):
+    """ Given the ASCII version of a UUID return its 16 bytes. Raises
+    ValueError if it isn't a UUID."""
+    return uuid.UUID(uuid_string).bytes
@@ -0,0 +1,330 @@
+#!/usr/bin/env python2.7
+
+# ---------------------------------------------------------------------------
+# Copyright (c) 2012 Asim Ihsan (asim dot ihsan at gmail dot com)
+# Distributed under the MIT/X11 software license, see the accompanying
+# file license.txt or http://www.opensource.org/licenses/mit-license.php.
+# ---------------------------------------------------------------------------
+
+# ---------------------------------------------------------------------------
+#   benchmark_model.py: load generator and latency benchmark for
+#   authauth_model.
+#
+#   Launches authauth_model the same way test_model_basic.py does (or uses
+#   an already running server with --zeromq_binding), drives it from a
+#   number of concurrent REQ clients with a weighted mix of message types,
+#   and reports throughput and p50/p95/p99/p99.9 latency per message type.
+#
+#   With --baseline the results are compared against a stored run and we
+#   exit non-zero if throughput dropped, or p50/p99 latency rose, by more
+#   than --tolerance. --save_baseline stores this run as the baseline.
+#
+#   e.g.
+#
+#   ./benchmark_model.py --concurrency 20 --duration 10 --mix ping:1,get_user:8,add_user:1 --server_args "--pool_size 50"
+# ---------------------------------------------------------------------------
+
+import os
+import sys
+import zmq
+import subprocess
+import time
+import json
+import random
+import argparse
+import threading
+
+from test_model_basic import CMD_TEMPLATE, SERVER_ZEROMQ_BINDING, CLIENT_ZEROMQ_BINDING, DATABASE_FILEPATH, script_under_test
+
+# ---------------------------------------------------------------------------
+#   Constants.
+# ---------------------------------------------------------------------------
+PERCENTILES = [("p50", 50.0), ("p95", 95.0), ("p99", 99.0), ("p999", 99.9)]
+
+# Which statistics may move in which direction before we call it a
+# regression.
+HIGHER_IS_BETTER = ["throughput"]
+LOWER_IS_BETTER = ["p50", "p99"]
+
+REQUEST_TIMEOUT = 5 * 1000
+STARTUP_DELAY = 1.0
+# ---------------------------------------------------------------------------
+
+def parse_mix(mix):
+    """ Parse 'ping:1,get_user:8' into [("ping", 1.0), ("get_user", 8.0)]."""
+    rv = []
+    for item in mix.split(","):
+        (message_type, weight) = item.split(":")
+        rv.append((message_type.strip(), float(weight)))
+    return rv
+
+def percentile(sorted_values, percent):
+    """ Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    rank = int(round(percent / 100.0 * len(sorted_values) + 0.5)) - 1
+    rank = max(0, min(rank, len(sorted_values) - 1))
+    return sorted_values[rank]
+
+class BenchmarkClient(threading.Thread):
+    """ One REQ client sending requests back to back until told to stop,
+    recording the latency of each by message type."""
+    def __init__(self, client_id, context, zeromq_binding, mix, emails, deadline, number_of_requests):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.client_id = client_id
+        self.context = context
+        self.zeromq_binding = zeromq_binding
+        self.mix = mix
+        self.total_weight = sum(weight for (message_type, weight) in mix)
+        self.emails = emails
+        self.deadline = deadline
+        self.number_of_requests = number_of_requests
+        self.latencies = dict((message_type, []) for (message_type, weight) in mix)
+        self.errors = dict((message_type, 0) for (message_type, weight) in mix)
+        self.random = random.Random(client_id)
+
+    def choose_message_type(self):
+        point = self.random.uniform(0, self.total_weight)
+        for (message_type, weight) in self.mix:
+            point -= weight
+            if point <= 0:
+                return message_type
+        return self.mix[-1][0]
+
+    def create_message(self, message_type, sequence):
+        message = {"version": "1.0",
+                   "message_type": message_type}
+        if message_type == "get_user":
+            message["user_type"] = "google"
+            message["email"] = self.random.choice(self.emails)
+        elif message_type == "add_user":
+            message["user_type"] = "google"
+            message["email"] = "benchmark-%s-%s@host.com" % (self.client_id, sequence)
+        elif message_type == "get_or_create_user":
+            # A returning user logging in.
+            message["user_type"] = "google"
+            message["email"] = self.random.choice(self.emails)
+        return message
+
+    def create_socket(self):
+        socket = self.context.socket(zmq.REQ)
+        socket.setsockopt(zmq.LINGER, 0)
+        socket.connect(self.zeromq_binding)
+        poller = zmq.Poller()
+        poller.register(socket, zmq.POLLIN)
+        return (socket, poller)
+
+    def run(self):
+        (socket, poller) = self.create_socket()
+        sequence = 0
+        while time.time() < self.deadline and sequence < self.number_of_requests:
+            message_type = self.choose_message_type()
+            data = json.dumps(self.create_message(message_type, sequence))
+            sequence += 1
+            start_time = time.time()
+            socket.send(data)
+            socks = dict(poller.poll(REQUEST_TIMEOUT))
+            if socks.get(socket, None) == zmq.POLLIN:
+                socket.recv()
+                self.latencies[message_type].append(time.time() - start_time)
+            else:
+                # The REQ socket is stuck without a reply; start afresh.
+                self.errors[message_type] += 1
+                poller.unregister(socket)
+                socket.close()
+                (socket, poller) = self.create_socket()
+        socket.close()
+
+def populate(context, zeromq_binding, number_of_users):
+    """ Add users for get_user to find, in one bulk request."""
+    emails = ["populated-%s@host.com" % (i, ) for i in xrange(number_of_users)]
+    socket = context.socket(zmq.REQ)
+    socket.setsockopt(zmq.LINGER, 0)
+    socket.connect(zeromq_binding)
+    message = {"version": "1.0",
+               "message_type": "add_users",
+               "users": [["google", email] for email in emails]}
+    socket.send(json.dumps(message))
+    poller = zmq.Poller()
+    poller.register(socket, zmq.POLLIN)
+    socks = dict(poller.poll(60 * 1000))
+    assert socks.get(socket, None) == zmq.POLLIN, "no reply when populating the database"
+    reply = json.loads(socket.recv())
+    socket.close()
+    # If we're reusing a populated database the users already exist, which
+    # is fine: they're there for get_user to find either way.
+    assert reply["status"] in ("ok", "error"), reply
+    return emails
+
+def run_benchmark(args):
+    mix = parse_mix(args.mix)
+    context = zmq.Context(1)
+    emails = populate(context, args.client_zeromq_binding, args.populate)
+
+    start_time = time.time()
+    deadline = start_time + args.duration
+    requests_per_client = (args.requests + args.concurrency - 1) // args.concurrency
+    clients = [BenchmarkClient(client_id,
+                               context,
+                               args.client_zeromq_binding,
+                               mix,
+                               emails,
+                               deadline,
+                               requests_per_client)
+               for client_id in xrange(args.concurrency)]
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    elapsed = time.time() - start_time
+    context.term()
+
+    results = {}
+    for (message_type, weight) in mix:
+        latencies = sorted(latency
+                           for client in clients
+                           for latency in client.latencies[message_type])
+        result = {"requests": len(latencies),
+                  "errors": sum(client.errors[message_type] for client in clients),
+                  "throughput": len(latencies) / elapsed}
+        for (name, percent) in PERCENTILES:
+            value = percentile(latencies, percent)
+            result[name] = None if value is None else value * 1000.0
+        results[message_type] = result
+    return results
+
+def format_results(results):
+    columns = ["requests", "errors", "throughput"] + [name for (name, percent) in PERCENTILES]
+    lines = ["%-12s" % ("message", ) + "".join("%12s" % (column, ) for column in columns)]
+    for (message_type, result) in sorted(results.iteritems()):
+        cells = []
+        for column in columns:
+            value = result[column]
+            if value is None:
+                cells.append("%12s" % ("-", ))
+            elif isinstance(value, float):
+                cells.append("%12.3f" % (value, ))
+            else:
+                cells.append("%12d" % (value, ))
+        lines.append("%-12s" % (message_type, ) + "".join(cells))
+    lines.append("(throughput in requests/s, latencies in ms)")
+    return "\n".join(lines)
+
+def find_regressions(results, baseline, tolerance):
+    """ Return a list of human-readable regressions of results against
+    baseline."""
+    regressions = []
+    for (message_type, baseline_result) in sorted(baseline.iteritems()):
+        result = results.get(message_type, None)
+        if result is None:
+            continue
+        for name in HIGHER_IS_BETTER:
+            if baseline_result.get(name) and result[name] < baseline_result[name] * (1.0 - tolerance):
+                regressions.append("%s %s fell from %.3f to %.3f" % (message_type, name, baseline_result[name], result[name]))
+        for name in LOWER_IS_BETTER:
+            if baseline_result.get(name) and result[name] is not None and result[name] > baseline_result[name] * (1.0 + tolerance):
+                regressions.append("%s %s rose from %.3f to %.3f" % (message_type, name, baseline_result[name], result[name]))
+    return regressions
+
+def get_args():
+    parser = argparse.ArgumentParser("Benchmark authauth_model.")
+    parser.add_argument("--concurrency",
+                        dest="concurrency",
+                        type=int,
+                        default=10,
+                        help="Number of concurrent REQ clients.")
+    parser.add_argument("--duration",
+                        dest="duration",
+                        type=float,
+                        default=10.0,
+                        help="Stop after this many seconds.")
+    parser.add_argument("--requests",
+                        dest="requests",
+                        type=int,
+                        default=sys.maxint,
+                        help="Stop after this many requests in total.")
+    parser.add_argument("--mix",
+                        dest="mix",
+                        default="ping:1,get_user:8,add_user:1",
+                        help="Comma-separated message_type:weight pairs.")
+    parser.add_argument("--populate",
+                        dest="populate",
+                        type=int,
+                        default=1000,
+                        help="Number of users to add before starting, for get_user to find.")
+    parser.add_argument("--server_args",
+                        dest="server_args",
+                        default="",
+                        help="Extra command-line arguments for the authauth_model we launch.")
+    parser.add_argument("--zeromq_binding",
+                        dest="zeromq_binding",
+                        default=None,
+                        help="Benchmark an already running authauth_model at this binding rather than launching one.")
+    parser.add_argument("--output",
+                        dest="output",
+                        default=None,
+                        help="Write the results as JSON to this filepath.")
+    parser.add_argument("--baseline",
+                        dest="baseline",
+                        default=None,
+                        help="JSON results to compare against, or to write with --save_baseline.")
+    parser.add_argument("--save_baseline",
+                        dest="save_baseline",
+                        action="store_true",
+                        default=False,
+                        help="Store this run's results as the baseline.")
+    parser.add_argument("--tolerance",
+                        dest="tolerance",
+                        type=float,
+                        default=0.2,
+                        help="Fraction by which a statistic may be worse than the baseline.")
+    args = parser.parse_args()
+    return args
+
+def main():
+    args = get_args()
+    process = None
+    if args.zeromq_binding:
+        args.client_zeromq_binding = args.zeromq_binding
+    else:
+        args.client_zeromq_binding = CLIENT_ZEROMQ_BINDING
+        devnull = open(os.devnull, "rb+")
+        process_cmd = CMD_TEMPLATE.substitute(executable = script_under_test,
+                                              zeromq_binding = SERVER_ZEROMQ_BINDING,
+                                              database_filepath = DATABASE_FILEPATH)
+        process_cmd += " " + args.server_args
+        process = subprocess.Popen(process_cmd,
+                                   shell = True,
+                                   stdin = devnull,
+                                   stdout = devnull)
+        time.sleep(STARTUP_DELAY)
+    try:
+        results = run_benchmark(args)
+    finally:
+        if process is not None:
+            process.kill()
+            process.wait()
+
+    print format_results(results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent = 4, sort_keys = True)
+
+    if args.baseline and args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent = 4, sort_keys = True)
+        print "saved baseline to %s" % (args.baseline, )
+    elif args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = find_regressions(results, baseline, args.tolerance)
+        if regressions:
+            print "REGRESSIONS against %s:" % (args.baseline, )
+            for regression in regressions:
+                print "    %s" % (regression, )
+            sys.exit(1)
+        print "no regressions against %s" % (args.baseline, )
+
+if __name__ == "__main__":
+    main()
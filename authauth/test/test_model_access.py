@@ -0,0 +1,109 @@
+#!/usr/bin/env python2.7
+
+# ---------------------------------------------------------------------------
+# Copyright (c) 2012 Asim Ihsan (asim dot ihsan at gmail dot com)
+# Distributed under the MIT/X11 software license, see the accompanying
+# file license.txt or http://www.opensource.org/licenses/mit-license.php.
+# ---------------------------------------------------------------------------
+
+# ---------------------------------------------------------------------------
+#   test_model_access.py: confirm that 'check_access' answers a batch of
+#   checks against lists' ACLs in one reply, from memory after the first,
+#   and that it goes by the latest ACLs, whether they're changed with
+#   'set_list_access' or by another process writing to the database.
+# ---------------------------------------------------------------------------
+
+import os
+import sys
+import time
+import json
+import sqlite3
+
+from nose.tools import raises, assert_false, assert_true, assert_not_equal, assert_equal, assert_less
+import unittest
+
+from test_model_basic import ModelTestCase, TimeoutException, DATABASE_FILEPATH
+
+# ---------------------------------------------------------------------------
+#   Constants.
+# ---------------------------------------------------------------------------
+NUMBER_OF_SUBSCRIBERS = 200
+# ---------------------------------------------------------------------------
+
+class TestAccess(ModelTestCase):
+    server_args = " --pool_size 10 --role_refresh_interval 0.2"
+
+    def _request(self, message_type, **kwds):
+        self.send_message(message_type, kwds)
+        reply_decoded = json.loads(self.get_message())
+        assert_equal(reply_decoded["message_type"], "%s_response" % (message_type, ))
+        return reply_decoded
+
+    def _check_access(self, checks):
+        reply_decoded = self._request("check_access", checks = checks)
+        assert_equal(reply_decoded["status"], "ok")
+        return reply_decoded["allowed"]
+
+    def _set_list_access(self, list_id, user_id, actions):
+        reply_decoded = self._request("set_list_access", list_id = list_id, user_id = user_id, actions = actions)
+        assert_equal(reply_decoded["status"], "ok")
+
+    def test_001_check_many_at_once(self):
+        """ Every check in a batch is answered, in order, by its list's
+        ACL."""
+        users = [["google", "user%s@host.com" % (i, )] for i in xrange(NUMBER_OF_SUBSCRIBERS)]
+        user_ids = self._add_users(users)["user_ids"]
+        for user_id in user_ids[::2]:
+            self._set_list_access("list1", user_id, ["read"])
+        self._set_list_access("list2", user_ids[1], ["read", "write"])
+
+        checks = [[user_id, "list1", "read"] for user_id in user_ids]
+        allowed = self._check_access(checks)
+        assert_equal(allowed, [i % 2 == 0 for i in xrange(NUMBER_OF_SUBSCRIBERS)])
+
+        allowed = self._check_access([[user_ids[1], "list2", "write"],
+                                      [user_ids[0], "list2", "read"],
+                                      [user_ids[0], "list1", "write"],
+                                      [user_ids[0], "list3", "read"],
+                                      ["0" * 32, "list1", "read"]])
+        assert_equal(allowed, [True, False, False, False, False])
+        assert_equal(self._check_access([]), [])
+
+        self.send_message("stats", {})
+        stats = json.loads(self.get_message())
+        assert_equal(stats["list_acl_cache"]["misses"], 3)
+
+    def test_002_acl_writes_apply_at_once(self):
+        """ Changing a user's access to a list applies to the very next
+        check, however recently the list was checked."""
+        user_id = self._add_user("google", email = "user@host.com")["user_id"]
+        self._set_list_access("list1", user_id, ["read"])
+        assert_equal(self._check_access([[user_id, "list1", "read"], [user_id, "list1", "write"]]), [True, False])
+
+        self._set_list_access("list1", user_id, ["read", "write"])
+        assert_equal(self._check_access([[user_id, "list1", "read"], [user_id, "list1", "write"]]), [True, True])
+        self._set_list_access("list1", user_id, [])
+        assert_equal(self._check_access([[user_id, "list1", "read"], [user_id, "list1", "write"]]), [False, False])
+
+    def test_003_other_processes_changes_are_picked_up(self):
+        """ ACLs changed in the database by another process are picked up
+        shortly after."""
+        user_id = self._add_user("google", email = "user@host.com")["user_id"]
+        assert_equal(self._check_access([[user_id, "list1", "read"]]), [False])
+
+        connection = sqlite3.connect(DATABASE_FILEPATH)
+        with connection:
+            connection.execute("INSERT INTO list_acl (list_id, user_id, actions) VALUES ('list1', ?, 'read');", (user_id, ))
+        connection.close()
+        time.sleep(1.0)
+        assert_equal(self._check_access([[user_id, "list1", "read"]]), [True])
+
+    def test_004_invalid_check_access(self):
+        """ 'check_access' with checks that aren't triples gets no reply."""
+        self.send_message("check_access", {"checks": [["0" * 32, "list1"]]})
+        try:
+            self.get_message(timeout = 1000)
+        except TimeoutException:
+            pass
+        else:
+            assert(False)
@@ -0,0 +1,178 @@
+#!/usr/bin/env python2.7
+
+# ---------------------------------------------------------------------------
+# Copyright (c) 2012 Asim Ihsan (asim dot ihsan at gmail dot com)
+# Distributed under the MIT/X11 software license, see the accompanying
+# file license.txt or http://www.opensource.org/licenses/mit-license.php.
+# ---------------------------------------------------------------------------
+
+# ---------------------------------------------------------------------------
+#   test_model_authorize.py: confirm that 'authorize' answers whether a
+#   user holds a privilege through their role, and that it goes by the
+#   latest roles, whether they're changed with 'set_role' and
+#   'set_user_role' or by another process writing to the database.
+# ---------------------------------------------------------------------------
+
+import os
+import sys
+import time
+import json
+import sqlite3
+import tempfile
+
+from nose.tools import raises, assert_false, assert_true, assert_not_equal, assert_equal, assert_less
+import unittest
+
+from test_model_basic import ModelTestCase, TimeoutException, DATABASE_FILEPATH, code_filepath
+
+sys.path.insert(0, code_filepath)
+from authauth_model_roles import RoleTable, is_privilege_name
+from authauth_model_cache import MISSING
+import authauth_model_database
+
+# ---------------------------------------------------------------------------
+#   Constants.
+# ---------------------------------------------------------------------------
+ROLE_CACHE_DATABASE_FILEPATH = os.path.join(tempfile.gettempdir(), "test_model_authorize.db")
+# ---------------------------------------------------------------------------
+
+class TestRoleTable(unittest.TestCase):
+    def test_001_roles_hold_their_privileges(self):
+        """ Each role holds the privileges stored for it and no others."""
+        roles = RoleTable([("editor", "read write"),
+                           ("reader", "read"),
+                           ("nobody", None)])
+        assert_equal(len(roles.privilege_bits), 2)
+        assert_true(roles.has_privilege("editor", "write"))
+        assert_true(roles.has_privilege("reader", "read"))
+        assert_false(roles.has_privilege("reader", "write"))
+        assert_false(roles.has_privilege("nobody", "read"))
+        assert_false(roles.has_privilege("stranger", "read"))
+        assert_false(roles.has_privilege("editor", "delete"))
+
+    def test_002_privilege_names_are_one_word(self):
+        """ A privilege name is one word, without so much as a trailing
+        newline."""
+        assert_true(is_privilege_name("lists:read"))
+        assert_false(is_privilege_name("read write"))
+        assert_false(is_privilege_name("read\n"))
+        assert_false(is_privilege_name(""))
+
+class TestDatabaseRoleCache(unittest.TestCase):
+    def setUp(self):
+        self.database = authauth_model_database.Database(ROLE_CACHE_DATABASE_FILEPATH,
+                                                         empty_database = True,
+                                                         role_cache_size = 10)
+
+    def tearDown(self):
+        self.database.close()
+        os.remove(ROLE_CACHE_DATABASE_FILEPATH)
+
+    def test_001_role_read_during_a_write_isnt_cached(self):
+        """ A role that authorize() read while the user's role was being
+        set isn't cached, as it may be the old one."""
+        self.database.set_role("editor", ["write"])
+        [user_id] = self.database.add_users([("google", u"user@host.com")])
+        user_id = self.database.user_id_to_string(user_id)
+
+        select_user_role = self.database._select_user_role
+        def select_while_setting(connection, stored_user_id):
+            rows = select_user_role(connection, stored_user_id)
+            self.database.set_user_role(user_id, "editor")
+            return rows
+        self.database._select_user_role = select_while_setting
+        assert_false(self.database.authorize(user_id, "write"))
+        assert_equal(self.database.user_role_cache.get(user_id), MISSING)
+
+        del self.database._select_user_role
+        assert_true(self.database.authorize(user_id, "write"))
+        assert_equal(self.database.user_role_cache.get(user_id), "editor")
+
+class TestAuthorize(ModelTestCase):
+    server_args = " --pool_size 10 --role_refresh_interval 0.2"
+
+    def _request(self, message_type, **kwds):
+        self.send_message(message_type, kwds)
+        reply_decoded = json.loads(self.get_message())
+        assert_equal(reply_decoded["message_type"], "%s_response" % (message_type, ))
+        return reply_decoded
+
+    def _authorize(self, user_id, privilege):
+        reply_decoded = self._request("authorize", user_id = user_id, privilege = privilege)
+        assert_equal(reply_decoded["status"], "ok")
+        return reply_decoded["authorized"]
+
+    def test_001_authorize_by_role(self):
+        """ A user holds their role's privileges, and only once they have
+        the role."""
+        user_id = self._add_user("google", email = "user@host.com")["user_id"]
+        assert_equal(self._request("set_role", role_id = "editor", privileges = ["read", "write"])["status"], "ok")
+        assert_false(self._authorize(user_id, "read"))
+
+        assert_equal(self._request("set_user_role", user_id = user_id, role_id = "editor")["status"], "ok")
+        assert_true(self._authorize(user_id, "read"))
+        assert_true(self._authorize(user_id, "write"))
+        assert_false(self._authorize(user_id, "delete"))
+        assert_false(self._authorize("0" * 32, "read"))
+        assert_equal(self._request("set_user_role", user_id = "0" * 32, role_id = "editor")["status"], "error")
+
+    def test_002_role_changes_apply_at_once(self):
+        """ Changing a role's privileges, or a user's role, applies to the
+        very next 'authorize'."""
+        user_id = self._add_user("google", email = "user@host.com")["user_id"]
+        self._request("set_role", role_id = "editor", privileges = ["read", "write"])
+        self._request("set_role", role_id = "reader", privileges = ["read"])
+        self._request("set_user_role", user_id = user_id, role_id = "editor")
+        assert_true(self._authorize(user_id, "write"))
+
+        self._request("set_role", role_id = "editor", privileges = ["read"])
+        assert_false(self._authorize(user_id, "write"))
+        self._request("set_role", role_id = "editor", privileges = ["write"])
+        assert_true(self._authorize(user_id, "write"))
+        self._request("set_user_role", user_id = user_id, role_id = "reader")
+        assert_false(self._authorize(user_id, "write"))
+        assert_true(self._authorize(user_id, "read"))
+
+    def test_003_other_processes_changes_are_picked_up(self):
+        """ Roles changed in the database by another process are picked up
+        shortly after."""
+        user_id = self._add_user("google", email = "user@host.com")["user_id"]
+        self._request("set_role", role_id = "editor", privileges = ["read"])
+        self._request("set_user_role", user_id = user_id, role_id = "editor")
+        assert_false(self._authorize(user_id, "write"))
+
+        connection = sqlite3.connect(DATABASE_FILEPATH)
+        with connection:
+            connection.execute("INSERT INTO role (role_id, role_name, privileges) VALUES ('admin', 'admin', 'read write');")
+            connection.execute("UPDATE user SET role_id = 'admin' WHERE user_id = ?;", (user_id, ))
+        connection.close()
+        time.sleep(1.0)
+        assert_true(self._authorize(user_id, "write"))
+
+    def test_004_invalid_authorize(self):
+        """ 'authorize' without a proper privilege name gets no reply."""
+        self.send_message("authorize", {"user_id": "0" * 32, "privilege": "read write"})
+        try:
+            self.get_message(timeout = 1000)
+        except TimeoutException:
+            pass
+        else:
+            assert(False)
+
+    def test_005_other_writes_keep_the_caches(self):
+        """ Another process's writes to anything but roles and ACLs don't
+        make us forget the users' roles or the lists' ACLs."""
+        user_id = self._add_user("google", email = "user@host.com")["user_id"]
+        self._authorize(user_id, "read")
+        self._request("check_access", checks = [[user_id, "list1", "read"]])
+
+        connection = sqlite3.connect(DATABASE_FILEPATH)
+        with connection:
+            connection.execute("INSERT INTO identity (provider, external_id, user_id) VALUES ('google', 'other@host.com', 'id0');")
+            connection.execute("INSERT INTO user (user_id, role_id) VALUES ('id0', 'regular');")
+        connection.close()
+        time.sleep(1.0)
+        self.send_message("stats", {})
+        stats = json.loads(self.get_message())
+        assert_equal(stats["user_role_cache"]["size"], 1)
+        assert_equal(stats["list_acl_cache"]["size"], 1)
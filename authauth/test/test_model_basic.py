@@ -24,6 +24,11 @@ import time
 import json
 import uuid
 
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
 from nose.tools import raises, assert_false, assert_true, assert_not_equal, assert_equal, assert_less
 from nose.plugins.skip import SkipTest, Skip
 import unittest
@@ -36,7 +41,7 @@ assert(os.path.isdir(code_filepath))
 script_under_test = os.path.join(code_filepath, "authauth_model.py")
 assert(os.path.isfile(script_under_test))
 
-CMD_TEMPLATE = Template(""" ${executable} --zeromq_binding ${zeromq_binding} --empty_database --database_filepath ${database_filepath} """)
+CMD_TEMPLATE = Template(""" exec ${executable} --zeromq_binding ${zeromq_binding} --empty_database --database_filepath ${database_filepath} """)
 SERVER_ZEROMQ_BINDING = "tcp://*:5556"
 CLIENT_ZEROMQ_BINDING = "tcp://localhost:5556"
 DATABASE_FILEPATH = "authauth.db"
@@ -46,7 +51,12 @@ VERBOSE = False
 class TimeoutException(Exception):
     pass
 
-class TestBasic(unittest.TestCase):
+class ModelTestCase(unittest.TestCase):
+    """ Launches authauth_model in a subprocess before each test and
+    connects a REQ client to it. Subclasses may set server_args to pass
+    extra command-line arguments to the server."""
+    server_args = ""
+
     def _execute_command(self, command, capture_output = False):
         devnull = open(os.devnull, "rb+")
         if capture_output:
@@ -68,6 +78,7 @@ class TestBasic(unittest.TestCase):
         self.process_cmd = CMD_TEMPLATE.substitute(executable = script_under_test,
                                                    zeromq_binding = SERVER_ZEROMQ_BINDING,
                                                    database_filepath = DATABASE_FILEPATH)
+        self.process_cmd += self.server_args
         if VERBOSE:
             self.process_cmd += " --verbose"
         self.process = self._execute_command(self.process_cmd,
@@ -123,6 +134,15 @@ class TestBasic(unittest.TestCase):
             if socks.get(self.client, None) == zmq.POLLIN:
                 return self.handle_message(self.client)
 
+    def send_msgpack_message(self, message_type, message_args):
+        if msgpack is None:
+            raise SkipTest("msgpack is not installed")
+        message = {"version": "1.1",
+                   "message_type": message_type}
+        for (key, value) in message_args.items():
+            message[key] = value
+        self.client.send(msgpack.packb(message))
+
     def handle_message(self, socket):
         message = socket.recv()
         return message
@@ -151,6 +171,23 @@ class TestBasic(unittest.TestCase):
         assert_equal(reply_decoded["message_type"], "add_user_response")
         return reply_decoded
 
+    def _get_users(self, users):
+        self.send_message("get_users", {"users": users})
+        reply = self.get_message()
+        assert_not_equal(reply, None)
+        reply_decoded = json.loads(reply)
+        assert_equal(reply_decoded["message_type"], "get_users_response")
+        return reply_decoded
+
+    def _add_users(self, users):
+        self.send_message("add_users", {"users": users})
+        reply = self.get_message()
+        assert_not_equal(reply, None)
+        reply_decoded = json.loads(reply)
+        assert_equal(reply_decoded["message_type"], "add_users_response")
+        return reply_decoded
+
+class TestBasic(ModelTestCase):
     def test_001_is_runnable(self):
         """ Still running after we launch it.
 
@@ -222,5 +259,102 @@ class TestBasic(unittest.TestCase):
         by internal user ID after and seeing 'user_id' = None."""
         assert()
 
+    def test_008_get_users_when_empty_returns_nothing(self):
+        """ When database empty getting many users returns a None for each."""
+        reply_decoded = self._get_users([["google", "user1@host.com"],
+                                         ["google", "user2@host.com"]])
+        assert_equal(reply_decoded["status"], "ok")
+        assert_equal(reply_decoded["user_ids"], [None, None])
+
+    def test_009_add_users_then_get_users_in_order(self):
+        """ Add many users at once, then get them back in request order.
+
+        Emails that weren't added come back as None in their position."""
+        users = [["google", "user%s@host.com" % (i, )] for i in xrange(100)]
+        reply_decoded = self._add_users(users)
+        assert_equal(reply_decoded["status"], "ok")
+        user_ids = reply_decoded["user_ids"]
+        assert_equal(len(user_ids), len(users))
+        assert_equal(len(set(user_ids)), len(users))
+
+        lookup = list(reversed(users)) + [["google", "nobody@host.com"]]
+        reply_decoded = self._get_users(lookup)
+        assert_equal(reply_decoded["status"], "ok")
+        assert_equal(reply_decoded["user_ids"], list(reversed(user_ids)) + [None])
+
+        reply_decoded = self._get_user("google", email = "user42@host.com")
+        assert_equal(reply_decoded["user_id"], user_ids[42])
+
+    def test_010_add_users_is_all_or_nothing(self):
+        """ If one user in a bulk add already exists none are added."""
+        reply_decoded = self._add_user("google", email = "user1@host.com")
+        assert_equal(reply_decoded["status"], "ok")
+
+        reply_decoded = self._add_users([["google", "user0@host.com"],
+                                         ["google", "user1@host.com"]])
+        assert_equal(reply_decoded["status"], "error")
+
+        reply_decoded = self._get_user("google", email = "user0@host.com")
+        assert_equal(reply_decoded["user_id"], None)
+
+    def test_011_ping_with_msgpack(self):
+        """ A msgpack ping asking for version 1.1 gets a msgpack pong, its
+        strings sent as strings rather than as binary."""
+        self.send_msgpack_message("ping", {})
+        reply_decoded = msgpack.unpackb(self.get_message(), raw = False)
+        assert_equal(reply_decoded["version"], "1.1")
+        assert_equal(reply_decoded["message_type"], "pong")
+        assert_equal(reply_decoded["status"], "ok")
+        assert_true(isinstance(reply_decoded["status"], unicode))
 
+    def test_012_add_then_get_user_with_msgpack(self):
+        """ Users added over msgpack can be got over JSON, and vice versa."""
+        self.send_msgpack_message("add_user", {"user_type": "google",
+                                               "email": "user@host.com"})
+        reply_decoded = msgpack.unpackb(self.get_message(), raw = False)
+        assert_equal(reply_decoded["message_type"], "add_user_response")
+        assert_equal(reply_decoded["status"], "ok")
+        user_id = reply_decoded["user_id"]
 
+        reply_decoded = self._get_user("google", email = "user@host.com")
+        assert_equal(reply_decoded["version"], "1.0")
+        assert_equal(reply_decoded["user_id"], user_id)
+
+        self.send_msgpack_message("get_user", {"user_type": "google",
+                                               "email": "user@host.com"})
+        reply_decoded = msgpack.unpackb(self.get_message(), raw = False)
+        assert_equal(reply_decoded["user_id"], user_id)
+
+    def test_013_unknown_version_gets_default_version(self):
+        """ Asking for a version we don't support gets a 1.0 JSON reply."""
+        self.send_message("ping", {"version": "99.0"})
+        reply_decoded = json.loads(self.get_message())
+        assert_equal(reply_decoded["version"], "1.0")
+        assert_equal(reply_decoded["message_type"], "pong")
+
+    def test_014_stats_counts_messages(self):
+        """ The stats message reports counts, latencies and uptime."""
+        for i in xrange(2):
+            self.send_message("ping", {})
+            self.get_message()
+        self._get_user("google", email = "user@host.com")
+
+        self.send_message("stats", {})
+        reply_decoded = json.loads(self.get_message())
+        assert_equal(reply_decoded["message_type"], "stats_response")
+        assert_equal(reply_decoded["status"], "ok")
+        assert_true(reply_decoded["uptime"] > 0)
+
+        messages = reply_decoded["messages"]
+        assert_equal(messages["ping"]["count"], 2)
+        assert_equal(messages["ping"]["errors"], 0)
+        assert_equal(messages["get_user"]["count"], 1)
+        assert_equal(sum(messages["get_user"]["latency"]["counts"]), 1)
+        assert_equal(len(messages["get_user"]["latency"]["counts"]),
+                     len(reply_decoded["latency_buckets"]) + 1)
+
+        statements = reply_decoded["statements"]
+        lookups = [histogram for (statement, histogram) in statements.items()
+                   if statement.startswith("SELECT user_id FROM identity")]
+        assert_equal(len(lookups), 1)
+        assert_equal(lookups[0]["count"], 1)
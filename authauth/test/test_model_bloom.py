@@ -0,0 +1,168 @@
+#!/usr/bin/env python2.7
+
+# ---------------------------------------------------------------------------
+# Copyright (c) 2012 Asim Ihsan (asim dot ihsan at gmail dot com)
+# Distributed under the MIT/X11 software license, see the accompanying
+# file license.txt or http://www.opensource.org/licenses/mit-license.php.
+# ---------------------------------------------------------------------------
+
+# ---------------------------------------------------------------------------
+#   test_model_bloom.py: confirm that authauth_model_bloom's Bloom filter
+#   never forgets a key and keeps to its false positive rate, and that
+#   authauth_model with --false_positive_rate answers lookups of unknown
+#   emails without querying the database.
+# ---------------------------------------------------------------------------
+
+import os
+import sys
+import zmq
+import time
+import json
+import sqlite3
+import tempfile
+
+from nose.tools import raises, assert_false, assert_true, assert_not_equal, assert_equal, assert_less
+import unittest
+
+from test_model_basic import ModelTestCase, code_filepath
+
+sys.path.insert(0, code_filepath)
+from authauth_model_bloom import BloomFilter
+import authauth_model_database
+
+# ---------------------------------------------------------------------------
+#   Constants.
+# ---------------------------------------------------------------------------
+FALSE_POSITIVE_RATE = 0.01
+GET_USER_STATEMENT = "SELECT user_id FROM identity WHERE provider = ? AND external_id = ?;"
+FILTERED_DATABASE_FILEPATH = os.path.join(tempfile.gettempdir(), "test_model_bloom.db")
+# ---------------------------------------------------------------------------
+
+class TestBloomFilter(unittest.TestCase):
+    def test_001_no_false_negatives(self):
+        """ Every key added is in the filter."""
+        bloom_filter = BloomFilter(1000, FALSE_POSITIVE_RATE)
+        for i in xrange(1000):
+            bloom_filter.add("user%s@host.com" % (i, ))
+        for i in xrange(1000):
+            assert_true("user%s@host.com" % (i, ) in bloom_filter)
+        assert_false(bloom_filter.is_full())
+
+    def test_002_false_positive_rate(self):
+        """ Keys never added are rarely in a filter at capacity."""
+        bloom_filter = BloomFilter(1000, FALSE_POSITIVE_RATE)
+        for i in xrange(1000):
+            bloom_filter.add("user%s@host.com" % (i, ))
+        false_positives = sum(1 for i in xrange(10000)
+                              if "stranger%s@host.com" % (i, ) in bloom_filter)
+        assert_less(false_positives, 10000 * FALSE_POSITIVE_RATE * 2)
+        assert_less(bloom_filter.estimated_false_positive_rate(), FALSE_POSITIVE_RATE * 1.5)
+
+    def test_003_counts_distinct_keys(self):
+        """ Adding a key twice counts it once."""
+        bloom_filter = BloomFilter(100, FALSE_POSITIVE_RATE)
+        assert_true(bloom_filter.add(u"user@host.com"))
+        assert_false(bloom_filter.add(u"user@host.com"))
+        assert_equal(bloom_filter.count, 1)
+
+class TestDatabaseBloomFilter(unittest.TestCase):
+    def setUp(self):
+        self.database = authauth_model_database.Database(FILTERED_DATABASE_FILEPATH,
+                                                         empty_database = True,
+                                                         false_positive_rate = FALSE_POSITIVE_RATE)
+
+    def tearDown(self):
+        self.database.close()
+        os.remove(FILTERED_DATABASE_FILEPATH)
+
+    def _insert_elsewhere(self, external_ids):
+        connection = sqlite3.connect(FILTERED_DATABASE_FILEPATH)
+        with connection:
+            connection.executemany("INSERT INTO identity (provider, external_id, user_id) VALUES ('google', ?, ?);",
+                                   [(external_id, "id%s" % (i, )) for (i, external_id) in enumerate(external_ids)])
+        connection.close()
+
+    def test_001_rebuild_keeps_users_added_meanwhile(self):
+        """ A rebuild of a full filter picks up another process's users,
+        and users added while it's under way are in the filter it swaps
+        in."""
+        old_filter = BloomFilter(1, FALSE_POSITIVE_RATE)
+        old_filter.add(u"google:one@host.com")
+        old_filter.add(u"google:two@host.com")
+        self.database.identity_filter = old_filter
+        self._insert_elsewhere([u"other@host.com"])
+
+        build_identity_filter = self.database._build_identity_filter
+        def build_while_adding(connection):
+            identity_filter = build_identity_filter(connection)
+            self.database.add_users([("google", u"meanwhile@host.com")])
+            return identity_filter
+        self.database._build_identity_filter = build_while_adding
+        self.database.refresh_identity_filter()
+
+        assert_not_equal(self.database.identity_filter, old_filter)
+        assert_true(u"google:other@host.com" in self.database.identity_filter)
+        assert_true(u"google:meanwhile@host.com" in self.database.identity_filter)
+        assert_equal(self.database.identity_filter_additions, None)
+
+    def test_002_refresh_reads_only_new_users(self):
+        """ A refresh adds another process's new users to the filter it
+        has, without scanning identity again."""
+        old_filter = self.database.identity_filter
+        self._insert_elsewhere([u"other@host.com"])
+        def build_identity_filter(connection):
+            raise AssertionError("rebuilt the identity filter")
+        self.database._build_identity_filter = build_identity_filter
+        self.database.refresh_identity_filter()
+
+        assert_equal(self.database.identity_filter, old_filter)
+        assert_true(u"google:other@host.com" in self.database.identity_filter)
+
+    def test_003_rebuild_once_behind_trimmed_sequences(self):
+        """ Once the users a refresh hasn't seen yet have been trimmed
+        away, it rebuilds the filter from identity instead."""
+        old_filter = self.database.identity_filter
+        self.database.IDENTITY_SEQUENCES_KEPT = 2
+        self._insert_elsewhere([u"other%s@host.com" % (i, ) for i in xrange(5)])
+        self.database.run_write(self.database._trim_identity_sequences)
+        self.database.refresh_identity_filter()
+
+        assert_not_equal(self.database.identity_filter, old_filter)
+        for i in xrange(5):
+            assert_true(u"google:other%s@host.com" % (i, ) in self.database.identity_filter)
+
+        # And carries on from the last one.
+        self._insert_elsewhere([u"later@host.com"])
+        new_filter = self.database.identity_filter
+        self.database.refresh_identity_filter()
+        assert_equal(self.database.identity_filter, new_filter)
+        assert_true(u"google:later@host.com" in self.database.identity_filter)
+
+class TestModelBloomFilter(ModelTestCase):
+    server_args = " --false_positive_rate %s" % (FALSE_POSITIVE_RATE, )
+
+    def _get_stats(self):
+        self.send_message("stats", {})
+        return json.loads(self.get_message())
+
+    def test_001_unknown_emails_skip_the_database(self):
+        """ get_user of emails nobody has added doesn't query the database."""
+        for i in xrange(20):
+            reply_decoded = self._get_user("google", email = "stranger%s@host.com" % (i, ))
+            assert_equal(reply_decoded["status"], "ok")
+            assert_equal(reply_decoded["user_id"], None)
+        stats = self._get_stats()
+        assert_false(GET_USER_STATEMENT in stats["statements"])
+        assert_equal(stats["identity_filter"]["rejections"], 20)
+        assert_equal(stats["identity_filter"]["false_positive_rate"], FALSE_POSITIVE_RATE)
+
+    def test_002_added_users_are_found(self):
+        """ Users added one at a time or in bulk pass the filter."""
+        user_id = self._add_user("google", email = "single@host.com")["user_id"]
+        user_ids = self._add_users([["google", "bulk%s@host.com" % (i, )] for i in xrange(5)])["user_ids"]
+        reply_decoded = self._get_user("google", email = "single@host.com")
+        assert_equal(reply_decoded["user_id"], user_id)
+        reply_decoded = self._get_users([["google", "bulk%s@host.com" % (i, )] for i in xrange(5)] +
+                                        [["google", "stranger@host.com"]])
+        assert_equal(reply_decoded["user_ids"], user_ids + [None])
+        assert_equal(self._get_stats()["identity_filter"]["count"], 6)
@@ -0,0 +1,117 @@
+#!/usr/bin/env python2.7
+
+# ---------------------------------------------------------------------------
+# Copyright (c) 2012 Asim Ihsan (asim dot ihsan at gmail dot com)
+# Distributed under the MIT/X11 software license, see the accompanying
+# file license.txt or http://www.opensource.org/licenses/mit-license.php.
+# ---------------------------------------------------------------------------
+
+# ---------------------------------------------------------------------------
+#   test_model_broker.py: run authauth_model_broker with two authauth_model
+#   workers behind it and confirm that clients are served through it, and
+#   that they keep being served after a worker dies.
+# ---------------------------------------------------------------------------
+
+import os
+import sys
+import zmq
+from string import Template
+import time
+import json
+
+from nose.tools import raises, assert_false, assert_true, assert_not_equal, assert_equal, assert_less
+import unittest
+
+from test_model_basic import ModelTestCase, CLIENT_ZEROMQ_BINDING, SERVER_ZEROMQ_BINDING, DATABASE_FILEPATH, script_under_test, code_filepath
+
+# ---------------------------------------------------------------------------
+#   Constants.
+# ---------------------------------------------------------------------------
+broker_under_test = os.path.join(code_filepath, "authauth_model_broker.py")
+assert(os.path.isfile(broker_under_test))
+
+BROKER_CMD_TEMPLATE = Template(""" exec ${executable} --frontend_binding ${frontend_binding} --backend_binding ${backend_binding} --heartbeat_interval ${heartbeat_interval} """)
+WORKER_CMD_TEMPLATE = Template(""" exec ${executable} --broker_binding ${broker_binding} --database_filepath ${database_filepath} --pool_size 5 --heartbeat_interval ${heartbeat_interval} """)
+BACKEND_SERVER_ZEROMQ_BINDING = "tcp://*:5561"
+BACKEND_CLIENT_ZEROMQ_BINDING = "tcp://localhost:5561"
+HEARTBEAT_INTERVAL = 0.2
+HEARTBEAT_LIVENESS = 3
+# ---------------------------------------------------------------------------
+
+class TestBroker(ModelTestCase):
+    def setUp(self):
+        # --------------------------------------------------------------------
+        #   Launch the broker, then two workers sharing one database. Only
+        #   the first empties it.
+        # --------------------------------------------------------------------
+        broker_cmd = BROKER_CMD_TEMPLATE.substitute(executable = broker_under_test,
+                                                    frontend_binding = SERVER_ZEROMQ_BINDING,
+                                                    backend_binding = BACKEND_SERVER_ZEROMQ_BINDING,
+                                                    heartbeat_interval = HEARTBEAT_INTERVAL)
+        self.broker_process = self._execute_command(broker_cmd)
+        worker_cmd = WORKER_CMD_TEMPLATE.substitute(executable = script_under_test,
+                                                    broker_binding = BACKEND_CLIENT_ZEROMQ_BINDING,
+                                                    database_filepath = DATABASE_FILEPATH,
+                                                    heartbeat_interval = HEARTBEAT_INTERVAL)
+        self.worker_processes = [self._execute_command(worker_cmd + " --empty_database")]
+        time.sleep(0.5)
+        self.worker_processes.append(self._execute_command(worker_cmd))
+        time.sleep(0.5)
+        self.process = self.broker_process
+        # --------------------------------------------------------------------
+
+        self.context = zmq.Context(1)
+        self.client = self.context.socket(zmq.REQ)
+        self.client.connect(CLIENT_ZEROMQ_BINDING)
+        self.poller = zmq.Poller()
+        self.poller.register(self.client, zmq.POLLIN)
+        self.poll_interval = 1000
+
+    def tearDown(self):
+        for process in self.worker_processes:
+            if process.poll() is None:
+                process.kill()
+        super(TestBroker, self).tearDown()
+
+    def test_001_is_pingable(self):
+        """ Responds to pings through the broker."""
+        self.send_message("ping", {})
+        reply_decoded = json.loads(self.get_message())
+        assert_equal(reply_decoded["message_type"], "pong")
+
+    def test_002_add_then_get_user(self):
+        """ Users added through one worker can be got through any."""
+        user_ids = []
+        for i in xrange(10):
+            reply_decoded = self._add_user("google", email = "user%s@host.com" % (i, ))
+            assert_equal(reply_decoded["status"], "ok")
+            user_ids.append(reply_decoded["user_id"])
+        for i in xrange(10):
+            reply_decoded = self._get_user("google", email = "user%s@host.com" % (i, ))
+            assert_equal(reply_decoded["user_id"], user_ids[i])
+
+    def test_003_survives_dead_worker(self):
+        """ Once a dead worker misses its heartbeats requests go elsewhere."""
+        self.worker_processes[0].kill()
+        time.sleep(HEARTBEAT_INTERVAL * (HEARTBEAT_LIVENESS + 2))
+        for i in xrange(10):
+            self.send_message("ping", {})
+            reply_decoded = json.loads(self.get_message(timeout = 1000))
+            assert_equal(reply_decoded["message_type"], "pong")
+
+    def test_004_survives_unanswered_requests(self):
+        """ Requests a worker never answers, e.g. invalid ones, don't count
+        against it for ever: once it has heartbeated, others get through."""
+        dealer = self.context.socket(zmq.DEALER)
+        dealer.setsockopt(zmq.LINGER, 0)
+        dealer.connect(CLIENT_ZEROMQ_BINDING)
+        try:
+            for i in xrange(20):
+                dealer.send_multipart(["", json.dumps({"version": "1.0", "message_type": "get_user"})])
+            time.sleep(HEARTBEAT_INTERVAL * 3)
+            for i in xrange(10):
+                self.send_message("ping", {})
+                reply_decoded = json.loads(self.get_message(timeout = 1000))
+                assert_equal(reply_decoded["message_type"], "pong")
+        finally:
+            dealer.close()
@@ -0,0 +1,126 @@
+#!/usr/bin/env python2.7
+
+# ---------------------------------------------------------------------------
+# Copyright (c) 2012 Asim Ihsan (asim dot ihsan at gmail dot com)
+# Distributed under the MIT/X11 software license, see the accompanying
+# file license.txt or http://www.opensource.org/licenses/mit-license.php.
+# ---------------------------------------------------------------------------
+
+# ---------------------------------------------------------------------------
+#   test_model_bulk.py: confirm that authauth_model_bulk imports users that
+#   a running authauth_model can then find, exports them again, and resumes
+#   an import from its checkpoint.
+# ---------------------------------------------------------------------------
+
+import os
+import sys
+import zmq
+import subprocess
+import tempfile
+import time
+import json
+import sqlite3
+import csv
+
+from nose.tools import raises, assert_false, assert_true, assert_not_equal, assert_equal, assert_less
+import unittest
+
+from test_model_basic import ModelTestCase, DATABASE_FILEPATH, code_filepath
+
+# ---------------------------------------------------------------------------
+#   Constants.
+# ---------------------------------------------------------------------------
+bulk_under_test = os.path.join(code_filepath, "authauth_model_bulk.py")
+assert(os.path.isfile(bulk_under_test))
+# ---------------------------------------------------------------------------
+
+class TestBulk(ModelTestCase):
+    def setUp(self):
+        super(TestBulk, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self._wait_for_server()
+
+    def tearDown(self):
+        super(TestBulk, self).tearDown()
+        for filename in os.listdir(self.directory):
+            os.remove(os.path.join(self.directory, filename))
+        os.rmdir(self.directory)
+
+    def _wait_for_server(self):
+        """ Wait until authauth_model has emptied the database, so that it
+        doesn't empty it again under us."""
+        self.send_message("ping", {})
+        self.get_message()
+
+    def _run_bulk(self, *args):
+        command = [bulk_under_test, "--database_filepath", DATABASE_FILEPATH] + list(args)
+        devnull = open(os.devnull, "rb+")
+        assert_equal(subprocess.call(command, stdout = devnull, stderr = devnull), 0)
+
+    def _write_csv(self, filename, records):
+        filepath = os.path.join(self.directory, filename)
+        with open(filepath, "wb") as f:
+            writer = csv.writer(f)
+            writer.writerow(["email", "user_id", "first_name"])
+            for record in records:
+                writer.writerow(record)
+        return filepath
+
+    def test_001_import_csv(self):
+        """ Imported users can be got through authauth_model."""
+        records = [("user%s@host.com" % (i, ), "id%s" % (i, ), "First%s" % (i, )) for i in xrange(25)]
+        filepath = self._write_csv("users.csv", records)
+        self._run_bulk("import", filepath, "--chunk_size", "10")
+        for (email, user_id, first_name) in records:
+            reply_decoded = self._get_user("google", email = email)
+            assert_equal(reply_decoded["user_id"], user_id)
+
+    def test_002_export_then_import_jsonl(self):
+        """ An export imported into an empty database is the same export."""
+        for i in xrange(10):
+            self._add_user("google", email = "user%s@host.com" % (i, ), first_name = u"Fran\u00e7ois")
+        first_filepath = os.path.join(self.directory, "first.jsonl")
+        self._run_bulk("export", first_filepath)
+        with open(first_filepath) as f:
+            records = [json.loads(line) for line in f]
+        assert_equal(len(records), 10)
+        assert_equal(records[0]["first_name"], u"Fran\u00e7ois")
+
+        self.process.kill()
+        self.process.wait()
+        self.process = self._execute_command(self.process_cmd)
+        self._wait_for_server()
+        self._run_bulk("import", first_filepath)
+        second_filepath = os.path.join(self.directory, "second.jsonl")
+        self._run_bulk("export", second_filepath)
+        with open(first_filepath) as f:
+            with open(second_filepath) as g:
+                assert_equal(f.read(), g.read())
+
+    def test_003_import_resumes_from_checkpoint(self):
+        """ Re-running an import skips the records it has already done."""
+        records = [("user%s@host.com" % (i, ), "id%s" % (i, ), "") for i in xrange(20)]
+        self._run_bulk("import", self._write_csv("partial.csv", records[:8]), "--chunk_size", "3", "--checkpoint", "users")
+        # Importing the first 8 records again would fail, as their emails
+        # are taken.
+        self._run_bulk("import", self._write_csv("full.csv", records), "--chunk_size", "3", "--checkpoint", "users")
+        reply_decoded = self._get_users([["google", email] for (email, user_id, first_name) in records])
+        assert_equal(reply_decoded["user_ids"], [user_id for (email, user_id, first_name) in records])
+
+    def test_004_import_replaces_existing_users(self):
+        """ Importing an email that's taken with REPLACE gives it to the
+        imported user, who keeps the old user's role, and the old user is
+        gone."""
+        old_user_id = self._add_user("google", email = "user@host.com")["user_id"]
+        self.send_message("set_role", {"role_id": "editor", "privileges": ["write"]})
+        self.get_message()
+        self.send_message("set_user_role", {"user_id": old_user_id, "role_id": "editor"})
+        self.get_message()
+
+        self._run_bulk("import", self._write_csv("users.csv", [("user@host.com", "id0", "")]), "--on_conflict", "REPLACE")
+        assert_equal(self._get_user("google", email = "user@host.com")["user_id"], "id0")
+        connection = sqlite3.connect(DATABASE_FILEPATH)
+        try:
+            assert_equal(connection.execute("SELECT user_id, role_id FROM user;").fetchall(), [("id0", "editor")])
+        finally:
+            connection.close()
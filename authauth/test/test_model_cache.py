@@ -0,0 +1,125 @@
+#!/usr/bin/env python2.7
+
+# ---------------------------------------------------------------------------
+# Copyright (c) 2012 Asim Ihsan (asim dot ihsan at gmail dot com)
+# Distributed under the MIT/X11 software license, see the accompanying
+# file license.txt or http://www.opensource.org/licenses/mit-license.php.
+# ---------------------------------------------------------------------------
+
+# ---------------------------------------------------------------------------
+#   test_model_cache.py: confirm that authauth_model with --cache_size
+#   answers repeated get_user requests from memory, and that with
+#   --cache_dump_filepath it comes back from a restart with a warm cache.
+# ---------------------------------------------------------------------------
+
+import os
+import sys
+import zmq
+import time
+import json
+import tempfile
+
+from nose.tools import raises, assert_false, assert_true, assert_not_equal, assert_equal, assert_less
+import unittest
+
+from test_model_basic import ModelTestCase, CMD_TEMPLATE, SERVER_ZEROMQ_BINDING, DATABASE_FILEPATH, script_under_test
+
+# ---------------------------------------------------------------------------
+#   Constants.
+# ---------------------------------------------------------------------------
+CACHE_DUMP_FILEPATH = os.path.join(tempfile.gettempdir(), "test_model_cache.json")
+NUMBER_OF_WORKERS = 2
+GET_USER_STATEMENT = "SELECT user_id FROM identity WHERE provider = ? AND external_id = ?;"
+# ---------------------------------------------------------------------------
+
+class TestCache(ModelTestCase):
+    server_args = " --cache_size 100 --cache_ttl 60 --cache_dump_filepath %s" % (CACHE_DUMP_FILEPATH, )
+
+    def setUp(self):
+        if os.path.isfile(CACHE_DUMP_FILEPATH):
+            os.remove(CACHE_DUMP_FILEPATH)
+        super(TestCache, self).setUp()
+
+    def tearDown(self):
+        super(TestCache, self).tearDown()
+        if os.path.isfile(CACHE_DUMP_FILEPATH):
+            os.remove(CACHE_DUMP_FILEPATH)
+
+    def _get_stats(self):
+        self.send_message("stats", {})
+        return json.loads(self.get_message())
+
+    def _get_user_queries(self):
+        statement = self._get_stats()["statements"].get(GET_USER_STATEMENT, None)
+        if statement is None:
+            return 0
+        return statement["count"]
+
+    def test_001_repeated_get_user_is_cached(self):
+        """ Only the first get_user for an email queries the database."""
+        user_id = self._add_user("google", email = "cached@host.com")["user_id"]
+        for i in xrange(5):
+            reply_decoded = self._get_user("google", email = "cached@host.com")
+            assert_equal(reply_decoded["user_id"], user_id)
+        assert_equal(self._get_user_queries(), 1)
+        cache = self._get_stats()["user_id_cache"]
+        assert_equal(cache["hits"], 4)
+        assert_equal(cache["size"], 1)
+
+    def test_002_missing_users_are_not_cached(self):
+        """ A user added after a miss is found straight away."""
+        reply_decoded = self._get_user("google", email = "late@host.com")
+        assert_equal(reply_decoded["user_id"], None)
+        user_id = self._add_user("google", email = "late@host.com")["user_id"]
+        reply_decoded = self._get_user("google", email = "late@host.com")
+        assert_equal(reply_decoded["user_id"], user_id)
+
+    def test_003_warm_restart(self):
+        """ Cached emails survive a restart without querying them one by one."""
+        user_ids = []
+        for i in xrange(5):
+            user_ids.append(self._add_user("google", email = "warm%s@host.com" % (i, ))["user_id"])
+            self._get_user("google", email = "warm%s@host.com" % (i, ))
+
+        # SIGTERM, unlike the SIGKILL tearDown sends, lets the server save
+        # its cache.
+        self.process.terminate()
+        self.process.wait()
+        assert_true(os.path.isfile(CACHE_DUMP_FILEPATH))
+
+        process_cmd = self.process_cmd.replace(" --empty_database", "")
+        self.process = self._execute_command(process_cmd)
+        for i in xrange(5):
+            reply_decoded = self._get_user("google", email = "warm%s@host.com" % (i, ))
+            assert_equal(reply_decoded["user_id"], user_ids[i])
+        assert_equal(self._get_user_queries(), 0)
+
+class TestWorkersCache(ModelTestCase):
+    server_args = " --workers %s --cache_size 100 --cache_dump_filepath %s" % (NUMBER_OF_WORKERS, CACHE_DUMP_FILEPATH)
+
+    def _remove_cache_dumps(self):
+        for i in xrange(NUMBER_OF_WORKERS):
+            if os.path.isfile("%s.%s" % (CACHE_DUMP_FILEPATH, i)):
+                os.remove("%s.%s" % (CACHE_DUMP_FILEPATH, i))
+
+    def setUp(self):
+        self._remove_cache_dumps()
+        super(TestWorkersCache, self).setUp()
+
+    def tearDown(self):
+        super(TestWorkersCache, self).tearDown()
+        self._remove_cache_dumps()
+
+    def test_001_workers_save_caches_on_terminate(self):
+        """ Terminating the device process stops every worker, each saving
+        its cache, before it exits."""
+        user_id = self._add_user("google", email = "warm@host.com")["user_id"]
+        assert_equal(self._get_user("google", email = "warm@host.com")["user_id"], user_id)
+        self.process.terminate()
+        self.process.wait()
+        for i in xrange(NUMBER_OF_WORKERS):
+            assert_true(os.path.isfile("%s.%s" % (CACHE_DUMP_FILEPATH, i)))
+
+        process_cmd = self.process_cmd.replace(" --empty_database", "")
+        self.process = self._execute_command(process_cmd)
+        assert_equal(self._get_user("google", email = "warm@host.com")["user_id"], user_id)
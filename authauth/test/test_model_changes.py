@@ -0,0 +1,161 @@
+#!/usr/bin/env python2.7
+
+# ---------------------------------------------------------------------------
+# Copyright (c) 2012 Asim Ihsan (asim dot ihsan at gmail dot com)
+# Distributed under the MIT/X11 software license, see the accompanying
+# file license.txt or http://www.opensource.org/licenses/mit-license.php.
+# ---------------------------------------------------------------------------
+
+# ---------------------------------------------------------------------------
+#   test_model_changes.py: confirm that authauth_model with
+#   --changes_binding publishes every user it adds, in order, and that a
+#   subscriber can catch up on what it missed with 'get_changes'.
+# ---------------------------------------------------------------------------
+
+import os
+import sys
+import zmq
+import time
+import json
+import tempfile
+
+from nose.tools import raises, assert_false, assert_true, assert_not_equal, assert_equal, assert_less
+import unittest
+
+from test_model_basic import ModelTestCase, TimeoutException, code_filepath
+
+sys.path.insert(0, code_filepath)
+import authauth_model_database
+
+# ---------------------------------------------------------------------------
+#   Constants.
+# ---------------------------------------------------------------------------
+CHANGES_SERVER_ZEROMQ_BINDING = "tcp://*:5557"
+CHANGES_CLIENT_ZEROMQ_BINDING = "tcp://localhost:5557"
+NUMBER_OF_USERS = 5
+CHANGE_LOG_SIZE = 2
+IMPORT_DATABASE_FILEPATH = os.path.join(tempfile.gettempdir(), "test_model_changes.db")
+# ---------------------------------------------------------------------------
+
+class TestChanges(ModelTestCase):
+    server_args = " --pool_size 10 --changes_binding %s" % (CHANGES_SERVER_ZEROMQ_BINDING, )
+
+    def setUp(self):
+        super(TestChanges, self).setUp()
+        self.subscriber = self.context.socket(zmq.SUB)
+        self.subscriber.setsockopt(zmq.SUBSCRIBE, "")
+        self.subscriber.connect(CHANGES_CLIENT_ZEROMQ_BINDING)
+
+    def tearDown(self):
+        self.subscriber.close(linger = 0)
+        super(TestChanges, self).tearDown()
+
+    def _get_change(self):
+        if not self.subscriber.poll(3000):
+            raise TimeoutException
+        change = json.loads(self.subscriber.recv())
+        assert_equal(change["message_type"], "change")
+        return change
+
+    def _get_changes(self, after, **kwds):
+        message_args = {"after": after}
+        message_args.update(kwds)
+        self.send_message("get_changes", message_args)
+        reply_decoded = json.loads(self.get_message())
+        assert_equal(reply_decoded["message_type"], "get_changes_response")
+        return reply_decoded
+
+    def _wait_for_subscription(self):
+        """ Add users until the first reaches the subscriber; a SUB socket
+        misses whatever is published before it has connected."""
+        start_time = time.time()
+        while not self.subscriber.poll(100):
+            assert_less(time.time() - start_time, 5.0)
+            self._add_user("google", email = "early%s@host.com" % (time.time(), ))
+        while self.subscriber.poll(500):
+            self.subscriber.recv()
+
+    def test_001_changes_are_published(self):
+        """ Each user added is published, with a sequence number, in order."""
+        self._wait_for_subscription()
+        emails = ["user%s@host.com" % (i, ) for i in xrange(NUMBER_OF_USERS)]
+        user_ids = [self._add_user("google", email = email)["user_id"] for email in emails]
+        changes = [self._get_change() for email in emails]
+        assert_equal([change["external_id"] for change in changes], emails)
+        assert_equal([change["user_id"] for change in changes], user_ids)
+        assert_true(all(change["change_type"] == "add" and change["user_type"] == "google" for change in changes))
+        sequences = [change["sequence"] for change in changes]
+        assert_equal(sequences, range(sequences[0], sequences[0] + NUMBER_OF_USERS))
+
+    def test_002_get_changes_catches_up(self):
+        """ get_changes returns what a subscriber missed, from any point."""
+        users = [["google", "user%s@host.com" % (i, )] for i in xrange(NUMBER_OF_USERS)]
+        user_ids = self._add_users(users)["user_ids"]
+        reply_decoded = self._get_changes(0)
+        assert_equal(reply_decoded["status"], "ok")
+        assert_false(reply_decoded["truncated"])
+        assert_equal(reply_decoded["last_sequence"], NUMBER_OF_USERS)
+        assert_equal([change["user_id"] for change in reply_decoded["changes"]], user_ids)
+
+        reply_decoded = self._get_changes(2, limit = 2)
+        assert_equal([change["sequence"] for change in reply_decoded["changes"]], [3, 4])
+        assert_equal(self._get_changes(NUMBER_OF_USERS)["changes"], [])
+
+    def test_003_role_changes_are_logged(self):
+        """ Setting a role, and giving a user a role, are changes too."""
+        user_id = self._add_user("google", email = "user@host.com")["user_id"]
+        self.send_message("set_role", {"role_id": "editor", "privileges": ["write"]})
+        self.get_message()
+        self.send_message("set_user_role", {"user_id": user_id, "role_id": "editor"})
+        self.get_message()
+        changes = self._get_changes(1)["changes"]
+        assert_equal([(change["change_type"], change["external_id"], change["user_id"]) for change in changes],
+                     [("role", "editor", None), ("user_role", "editor", user_id)])
+
+    def test_004_invalid_get_changes(self):
+        """ get_changes without a sensible 'after' gets no reply."""
+        self.send_message("get_changes", {"after": "yesterday"})
+        try:
+            self.get_message(timeout = 1000)
+        except TimeoutException:
+            pass
+        else:
+            assert(False)
+
+class TestTrimmedChanges(ModelTestCase):
+    server_args = " --pool_size 10 --changes_binding %s --change_log_size %s" % (CHANGES_SERVER_ZEROMQ_BINDING, CHANGE_LOG_SIZE)
+
+    def test_001_trimmed_changes_are_reported(self):
+        """ A subscriber asking for trimmed changes is told so."""
+        users = [["google", "user%s@host.com" % (i, )] for i in xrange(NUMBER_OF_USERS)]
+        self._add_users(users)
+        time.sleep(1.5)
+        self.send_message("get_changes", {"after": 0})
+        reply_decoded = json.loads(self.get_message())
+        assert_true(reply_decoded["truncated"])
+        assert_equal([change["sequence"] for change in reply_decoded["changes"]], [4, 5])
+        self.send_message("get_changes", {"after": 3})
+        reply_decoded = json.loads(self.get_message())
+        assert_false(reply_decoded["truncated"])
+
+class TestImportChanges(unittest.TestCase):
+    def setUp(self):
+        self.database = authauth_model_database.Database(IMPORT_DATABASE_FILEPATH,
+                                                         empty_database = True,
+                                                         change_log = True)
+
+    def tearDown(self):
+        self.database.close()
+        os.remove(IMPORT_DATABASE_FILEPATH)
+
+    def test_001_only_written_rows_are_logged(self):
+        """ Importing with IGNORE logs the users it added, and not those
+        that were already there."""
+        user_id = self.database.add_users([("google", u"old@host.com")])[0]
+        rows = [(u"old@host.com", u"id0", u"", u"", u"", u""),
+                (u"new@host.com", u"id1", u"", u"", u"", u"")]
+        self.database.import_google_users(rows, on_conflict = "IGNORE")
+        changes = self.database.get_changes(0, 10)
+        assert_equal([(change[1], change[3], change[4]) for change in changes],
+                     [("add", u"old@host.com", user_id),
+                      ("add", u"new@host.com", u"id1")])
@@ -0,0 +1,65 @@
+#!/usr/bin/env python2.7
+
+# ---------------------------------------------------------------------------
+# Copyright (c) 2012 Asim Ihsan (asim dot ihsan at gmail dot com)
+# Distributed under the MIT/X11 software license, see the accompanying
+# file license.txt or http://www.opensource.org/licenses/mit-license.php.
+# ---------------------------------------------------------------------------
+
+# ---------------------------------------------------------------------------
+#   test_model_compact.py: confirm that authauth_model with
+#   --compact_user_ids stores user IDs as 16-byte BLOBs in WITHOUT ROWID
+#   tables, while clients still see the same hex user IDs as ever.
+# ---------------------------------------------------------------------------
+
+import os
+import sys
+import zmq
+import time
+import json
+import uuid
+import sqlite3
+
+from nose.tools import raises, assert_false, assert_true, assert_not_equal, assert_equal, assert_less
+import unittest
+
+from test_model_basic import ModelTestCase, DATABASE_FILEPATH
+
+class TestCompact(ModelTestCase):
+    server_args = " --compact_user_ids --false_positive_rate 0.01"
+
+    def _query(self, statement, args = ()):
+        connection = sqlite3.connect(DATABASE_FILEPATH)
+        try:
+            return connection.execute(statement, args).fetchall()
+        finally:
+            connection.close()
+
+    def test_001_user_ids_are_hex(self):
+        """ Added users get hex user IDs back, and get_user finds them."""
+        reply_decoded = self._add_user("google", email = "user@host.com")
+        user_id = reply_decoded["user_id"]
+        assert_equal(uuid.UUID(user_id).hex, user_id)
+        reply_decoded = self._get_user("google", email = "user@host.com")
+        assert_equal(reply_decoded["user_id"], user_id)
+
+    def test_002_user_ids_are_stored_as_blobs(self):
+        """ The database holds the 16 bytes of each user ID."""
+        user_id = self._add_user("google", email = "user@host.com")["user_id"]
+        rows = self._query("SELECT typeof(user_id), length(user_id), hex(user_id) FROM identity WHERE provider = ? AND external_id = ?", ("google", "user@host.com"))
+        assert_equal(rows, [(u"blob", 16, user_id.upper())])
+
+    def test_003_tables_are_without_rowid(self):
+        """ identity, auth_google and user are WITHOUT ROWID tables."""
+        for table in ["identity", "auth_google", "user"]:
+            rows = self._query("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (table, ))
+            assert_true("WITHOUT ROWID" in rows[0][0].upper())
+
+    def test_004_bulk_users(self):
+        """ Bulk adds and gets use hex user IDs too."""
+        users = [["google", "user%s@host.com" % (i, )] for i in xrange(10)]
+        user_ids = self._add_users(users)["user_ids"]
+        for user_id in user_ids:
+            assert_equal(uuid.UUID(user_id).hex, user_id)
+        reply_decoded = self._get_users(users + [["google", "stranger@host.com"]])
+        assert_equal(reply_decoded["user_ids"], user_ids + [None])
@@ -0,0 +1,132 @@
+#!/usr/bin/env python2.7
+
+# ---------------------------------------------------------------------------
+# Copyright (c) 2012 Asim Ihsan (asim dot ihsan at gmail dot com)
+# Distributed under the MIT/X11 software license, see the accompanying
+# file license.txt or http://www.opensource.org/licenses/mit-license.php.
+# ---------------------------------------------------------------------------
+
+# ---------------------------------------------------------------------------
+#   test_model_concurrent.py: confirm that authauth_model, when run with a
+#   ROUTER socket and a pool of greenlets, still serves plain REQ clients
+#   and routes every reply back to the client that asked for it.
+# ---------------------------------------------------------------------------
+
+import os
+import sys
+import zmq
+import time
+import json
+
+from nose.tools import raises, assert_false, assert_true, assert_not_equal, assert_equal, assert_less
+import unittest
+
+from test_model_basic import ModelTestCase, TimeoutException, CLIENT_ZEROMQ_BINDING
+
+# ---------------------------------------------------------------------------
+#   Constants.
+# ---------------------------------------------------------------------------
+POOL_SIZE = 10
+NUMBER_OF_CLIENTS = 25
+# ---------------------------------------------------------------------------
+
+class TestConcurrent(ModelTestCase):
+    server_args = " --pool_size %s" % (POOL_SIZE, )
+
+    def _create_clients(self, number_of_clients):
+        clients = []
+        for i in xrange(number_of_clients):
+            client = self.context.socket(zmq.REQ)
+            client.connect(CLIENT_ZEROMQ_BINDING)
+            clients.append(client)
+        return clients
+
+    def _close_clients(self, clients):
+        for client in clients:
+            client.close(linger = 0)
+
+    def test_001_is_pingable(self):
+        """ Responds to pings from a REQ client via the ROUTER socket."""
+        self.send_message("ping", {})
+        reply_decoded = json.loads(self.get_message())
+        assert_equal(reply_decoded["message_type"], "pong")
+        assert_equal(reply_decoded["status"], "ok")
+
+    def test_002_many_clients_in_flight(self):
+        """ Many REQ clients each with a request in flight at once.
+
+        Every client must get back the reply to its own request, and not
+        some other client's."""
+        clients = self._create_clients(NUMBER_OF_CLIENTS)
+        try:
+            for (i, client) in enumerate(clients):
+                message = self._create_basic_message()
+                message["message_type"] = "add_user"
+                message["user_type"] = "google"
+                message["email"] = "user%s@host.com" % (i, )
+                client.send(json.dumps(message))
+
+            poller = zmq.Poller()
+            for client in clients:
+                poller.register(client, zmq.POLLIN)
+            user_ids = {}
+            start_time = time.time()
+            while len(user_ids) < len(clients):
+                if time.time() - start_time >= 5:
+                    raise TimeoutException
+                socks = dict(poller.poll(self.poll_interval))
+                for (i, client) in enumerate(clients):
+                    if socks.get(client, None) == zmq.POLLIN:
+                        reply_decoded = json.loads(client.recv())
+                        assert_equal(reply_decoded["message_type"], "add_user_response")
+                        assert_equal(reply_decoded["status"], "ok")
+                        user_ids[i] = reply_decoded["user_id"]
+        finally:
+            self._close_clients(clients)
+
+        for (i, user_id) in user_ids.iteritems():
+            reply_decoded = self._get_user("google",
+                                           email = "user%s@host.com" % (i, ))
+            assert_equal(reply_decoded["user_id"], user_id)
+
+    def test_003_pipelined_requests_on_one_dealer(self):
+        """ A DEALER client pipelines many requests on one socket.
+
+        Every reply echoes the request_id of the request it answers, so the
+        client can match them up whatever order they come back in."""
+        dealer = self.context.socket(zmq.DEALER)
+        dealer.connect(CLIENT_ZEROMQ_BINDING)
+        try:
+            for i in xrange(NUMBER_OF_CLIENTS):
+                message = self._create_basic_message()
+                message["message_type"] = "add_user"
+                message["user_type"] = "google"
+                message["email"] = "user%s@host.com" % (i, )
+                message["request_id"] = "add-%s" % (i, )
+                dealer.send(json.dumps(message))
+            message = self._create_basic_message()
+            message["message_type"] = "ping"
+            message["request_id"] = "ping"
+            dealer.send(json.dumps(message))
+
+            poller = zmq.Poller()
+            poller.register(dealer, zmq.POLLIN)
+            replies = {}
+            start_time = time.time()
+            while len(replies) < NUMBER_OF_CLIENTS + 1:
+                if time.time() - start_time >= 5:
+                    raise TimeoutException
+                socks = dict(poller.poll(self.poll_interval))
+                if socks.get(dealer, None) == zmq.POLLIN:
+                    reply_decoded = json.loads(dealer.recv())
+                    replies[reply_decoded["request_id"]] = reply_decoded
+        finally:
+            dealer.close(linger = 0)
+
+        assert_equal(replies["ping"]["message_type"], "pong")
+        for i in xrange(NUMBER_OF_CLIENTS):
+            reply_decoded = replies["add-%s" % (i, )]
+            assert_equal(reply_decoded["message_type"], "add_user_response")
+            user_id = self._get_user("google",
+                                     email = "user%s@host.com" % (i, ))["user_id"]
+            assert_equal(reply_decoded["user_id"], user_id)
@@ -0,0 +1,114 @@
+#!/usr/bin/env python2.7
+
+# ---------------------------------------------------------------------------
+# Copyright (c) 2012 Asim Ihsan (asim dot ihsan at gmail dot com)
+# Distributed under the MIT/X11 software license, see the accompanying
+# file license.txt or http://www.opensource.org/licenses/mit-license.php.
+# ---------------------------------------------------------------------------
+
+# ---------------------------------------------------------------------------
+#   test_model_executor.py: confirm that authauth_model with --read_threads
+#   runs its SQL on native threads, so that pings and reads are answered
+#   while a write waits on a lock another process holds.
+# ---------------------------------------------------------------------------
+
+import os
+import sys
+import zmq
+import time
+import json
+import sqlite3
+
+from nose.tools import raises, assert_false, assert_true, assert_not_equal, assert_equal, assert_less
+import unittest
+
+from test_model_basic import ModelTestCase, TimeoutException, CLIENT_ZEROMQ_BINDING, DATABASE_FILEPATH
+
+# ---------------------------------------------------------------------------
+#   Constants.
+# ---------------------------------------------------------------------------
+READ_THREADS = 2
+NUMBER_OF_REQUESTS = 400
+# ---------------------------------------------------------------------------
+
+class TestExecutor(ModelTestCase):
+    server_args = " --pool_size 10 --read_threads %s --journal_mode WAL --busy_timeout 4000" % (READ_THREADS, )
+
+    def tearDown(self):
+        super(TestExecutor, self).tearDown()
+        for suffix in ["-wal", "-shm"]:
+            if os.path.isfile(DATABASE_FILEPATH + suffix):
+                os.remove(DATABASE_FILEPATH + suffix)
+
+    def test_001_users_through_threads(self):
+        """ Users are added and got as ever, and stats report the threads."""
+        user_id = self._add_user("google", email = "user@host.com")["user_id"]
+        assert_equal(self._get_user("google", email = "user@host.com")["user_id"], user_id)
+        users = [["google", "user%s@host.com" % (i, )] for i in xrange(10)]
+        user_ids = self._add_users(users)["user_ids"]
+        reply_decoded = self._get_users(users + [["google", "user@host.com"], ["google", "stranger@host.com"]])
+        assert_equal(reply_decoded["user_ids"], user_ids + [user_id, None])
+
+        self.send_message("stats", {})
+        stats = json.loads(self.get_message())
+        assert_equal(stats["executor"]["read_threads"], READ_THREADS)
+        assert_equal(stats["executor"]["writes_in_flight"], 0)
+
+    def test_002_stalled_write_does_not_block_reads(self):
+        """ While a write waits on a lock, pings and reads are answered."""
+        user_id = self._add_user("google", email = "existing@host.com")["user_id"]
+
+        connection = sqlite3.connect(DATABASE_FILEPATH, isolation_level = None)
+        connection.execute("BEGIN IMMEDIATE")
+        dealer = self.context.socket(zmq.DEALER)
+        dealer.connect(CLIENT_ZEROMQ_BINDING)
+        try:
+            message = self._create_basic_message()
+            message["message_type"] = "add_user"
+            message["user_type"] = "google"
+            message["email"] = "stalled@host.com"
+            message["request_id"] = "stalled"
+            dealer.send(json.dumps(message))
+            time.sleep(0.2)
+
+            start_time = time.time()
+            self.send_message("ping", {})
+            assert_equal(json.loads(self.get_message(timeout = 1000))["message_type"], "pong")
+            reply_decoded = self._get_user("google", email = "existing@host.com")
+            assert_equal(reply_decoded["user_id"], user_id)
+            assert_less(time.time() - start_time, 1.0)
+            assert_false(dealer.poll(0))
+
+            connection.execute("ROLLBACK")
+            assert_true(dealer.poll(3000))
+            reply_decoded = json.loads(dealer.recv())
+            assert_equal(reply_decoded["status"], "ok")
+        finally:
+            dealer.close(linger = 0)
+            connection.close()
+
+class TestRollbackJournalExecutor(ModelTestCase):
+    server_args = " --pool_size 10 --read_threads %s" % (READ_THREADS, )
+
+    def test_001_reads_wait_for_writes(self):
+        """ Without WAL, reads that overlap a write wait for it rather than
+        failing, so every request is answered."""
+        dealer = self.context.socket(zmq.DEALER)
+        dealer.connect(CLIENT_ZEROMQ_BINDING)
+        try:
+            for i in xrange(NUMBER_OF_REQUESTS):
+                for (message_type, email) in [("add_user", "user%s@host.com" % (i, )),
+                                              ("get_user", "user%s@host.com" % (i // 2, ))]:
+                    message = self._create_basic_message()
+                    message["message_type"] = message_type
+                    message["user_type"] = "google"
+                    message["email"] = email
+                    message["request_id"] = "%s-%s" % (message_type, i)
+                    dealer.send(json.dumps(message))
+            replies = 0
+            while replies < NUMBER_OF_REQUESTS * 2:
+                assert_true(dealer.poll(5000))
+                assert_equal(json.loads(dealer.recv())["status"], "ok")
+                replies += 1
+        finally:
+            dealer.close(linger = 0)
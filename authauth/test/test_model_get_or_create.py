@@ -0,0 +1,93 @@
+#!/usr/bin/env python2.7
+
+# ---------------------------------------------------------------------------
+# Copyright (c) 2012 Asim Ihsan (asim dot ihsan at gmail dot com)
+# Distributed under the MIT/X11 software license, see the accompanying
+# file license.txt or http://www.opensource.org/licenses/mit-license.php.
+# ---------------------------------------------------------------------------
+
+# ---------------------------------------------------------------------------
+#   test_model_get_or_create.py: confirm that 'get_or_create_user' creates
+#   a user the first time and finds them every time after, and that
+#   concurrent requests for the same new user all get the one user_id.
+# ---------------------------------------------------------------------------
+
+import os
+import sys
+import zmq
+import time
+import json
+import sqlite3
+
+from nose.tools import raises, assert_false, assert_true, assert_not_equal, assert_equal, assert_less
+import unittest
+
+from test_model_basic import ModelTestCase, TimeoutException, CLIENT_ZEROMQ_BINDING, DATABASE_FILEPATH
+
+# ---------------------------------------------------------------------------
+#   Constants.
+# ---------------------------------------------------------------------------
+NUMBER_OF_REQUESTS = 20
+# ---------------------------------------------------------------------------
+
+class TestGetOrCreate(ModelTestCase):
+    server_args = " --pool_size 10"
+
+    def _get_or_create_user(self, user_type, **kwds):
+        message_args = {"user_type": user_type}
+        message_args.update(kwds)
+        self.send_message("get_or_create_user", message_args)
+        reply_decoded = json.loads(self.get_message())
+        assert_equal(reply_decoded["message_type"], "get_or_create_user_response")
+        assert_equal(reply_decoded["status"], "ok")
+        return reply_decoded
+
+    def test_001_creates_then_gets(self):
+        """ The first request creates the user, with their profile, and the
+        next finds them."""
+        reply_decoded = self._get_or_create_user("google", email = "user@host.com", first_name = "First")
+        assert_true(reply_decoded["created"])
+        user_id = reply_decoded["user_id"]
+        assert_not_equal(user_id, None)
+
+        reply_decoded = self._get_or_create_user("google", email = "user@host.com", first_name = "Other")
+        assert_false(reply_decoded["created"])
+        assert_equal(reply_decoded["user_id"], user_id)
+        assert_equal(self._get_user("google", email = "user@host.com")["user_id"], user_id)
+
+        connection = sqlite3.connect(DATABASE_FILEPATH)
+        try:
+            rows = connection.execute("SELECT first_name FROM auth_google WHERE email = ?", ("user@host.com", )).fetchall()
+        finally:
+            connection.close()
+        assert_equal(rows, [(u"First", )])
+
+    def test_002_every_user_type(self):
+        """ Users of every type can be got or created."""
+        for (user_type, field) in [("browserid", "email"), ("twitter", "username"), ("facebook", "facebook_id")]:
+            user_id = self._get_or_create_user(user_type, **{field: "someone"})["user_id"]
+            reply_decoded = self._get_or_create_user(user_type, **{field: "someone"})
+            assert_false(reply_decoded["created"])
+            assert_equal(reply_decoded["user_id"], user_id)
+
+    def test_003_concurrent_requests_agree(self):
+        """ Of many requests for the same new user at once, one creates
+        them and all get the same user_id."""
+        dealer = self.context.socket(zmq.DEALER)
+        dealer.connect(CLIENT_ZEROMQ_BINDING)
+        try:
+            for i in xrange(NUMBER_OF_REQUESTS):
+                message = self._create_basic_message()
+                message["message_type"] = "get_or_create_user"
+                message["user_type"] = "google"
+                message["email"] = "user@host.com"
+                message["request_id"] = str(i)
+                dealer.send(json.dumps(message))
+            replies = []
+            for i in xrange(NUMBER_OF_REQUESTS):
+                assert_true(dealer.poll(3000))
+                replies.append(json.loads(dealer.recv()))
+        finally:
+            dealer.close(linger = 0)
+        assert_equal(len(set(reply["user_id"] for reply in replies)), 1)
+        assert_equal(len([reply for reply in replies if reply["created"]]), 1)
@@ -0,0 +1,89 @@
+#!/usr/bin/env python2.7
+
+# ---------------------------------------------------------------------------
+# Copyright (c) 2012 Asim Ihsan (asim dot ihsan at gmail dot com)
+# Distributed under the MIT/X11 software license, see the accompanying
+# file license.txt or http://www.opensource.org/licenses/mit-license.php.
+# ---------------------------------------------------------------------------
+
+# ---------------------------------------------------------------------------
+#   test_model_group_commit.py: confirm that authauth_model with
+#   --group_commit_window writes concurrent add_user requests in shared
+#   transactions, and that one bad request doesn't sink the rest of its
+#   batch.
+# ---------------------------------------------------------------------------
+
+import os
+import sys
+import zmq
+import time
+import json
+
+from nose.tools import raises, assert_false, assert_true, assert_not_equal, assert_equal, assert_less
+import unittest
+
+from test_model_basic import ModelTestCase, TimeoutException, CLIENT_ZEROMQ_BINDING
+
+# ---------------------------------------------------------------------------
+#   Constants.
+# ---------------------------------------------------------------------------
+GROUP_COMMIT_SIZE = 5
+NUMBER_OF_USERS = 20
+CREATE_IDENTITY_STATEMENT = "INSERT INTO identity (provider, external_id, user_id) VALUES (?, ?, ?);"
+# ---------------------------------------------------------------------------
+
+class TestGroupCommit(ModelTestCase):
+    server_args = " --pool_size 50 --group_commit_window 0.05 --group_commit_size %s" % (GROUP_COMMIT_SIZE, )
+
+    def _add_users_pipelined(self, emails, expected_replies):
+        """ Send an add_user for each email on one DEALER socket without
+        waiting, and return the replies keyed by email."""
+        dealer = self.context.socket(zmq.DEALER)
+        dealer.connect(CLIENT_ZEROMQ_BINDING)
+        try:
+            for email in emails:
+                message = self._create_basic_message()
+                message["message_type"] = "add_user"
+                message["user_type"] = "google"
+                message["email"] = email
+                message["request_id"] = email
+                dealer.send(json.dumps(message))
+
+            poller = zmq.Poller()
+            poller.register(dealer, zmq.POLLIN)
+            replies = {}
+            start_time = time.time()
+            while len(replies) < expected_replies:
+                if time.time() - start_time >= 5:
+                    raise TimeoutException
+                socks = dict(poller.poll(self.poll_interval))
+                if socks.get(dealer, None) == zmq.POLLIN:
+                    reply_decoded = json.loads(dealer.recv())
+                    replies[reply_decoded["request_id"]] = reply_decoded
+        finally:
+            dealer.close(linger = 0)
+        return replies
+
+    def test_001_concurrent_adds_share_transactions(self):
+        """ Concurrent add_user requests are written in batches."""
+        emails = ["user%s@host.com" % (i, ) for i in xrange(NUMBER_OF_USERS)]
+        replies = self._add_users_pipelined(emails, NUMBER_OF_USERS)
+        for email in emails:
+            assert_equal(replies[email]["status"], "ok")
+            reply_decoded = self._get_user("google", email = email)
+            assert_equal(reply_decoded["user_id"], replies[email]["user_id"])
+
+        self.send_message("stats", {})
+        stats = json.loads(self.get_message())
+        batches = stats["statements"][CREATE_IDENTITY_STATEMENT]["count"]
+        assert_less(batches, NUMBER_OF_USERS)
+
+    def test_002_bad_add_does_not_sink_batch(self):
+        """ An email that's taken fails alone; the rest of its batch is added."""
+        self._add_user("google", email = "taken@host.com")
+        emails = ["taken@host.com"] + ["user%s@host.com" % (i, ) for i in xrange(GROUP_COMMIT_SIZE - 1)]
+        replies = self._add_users_pipelined(emails, GROUP_COMMIT_SIZE - 1)
+        for email in emails[1:]:
+            assert_equal(replies[email]["status"], "ok")
+            reply_decoded = self._get_user("google", email = email)
+            assert_equal(reply_decoded["user_id"], replies[email]["user_id"])
@@ -0,0 +1,105 @@
+#!/usr/bin/env python2.7
+
+# ---------------------------------------------------------------------------
+# Copyright (c) 2012 Asim Ihsan (asim dot ihsan at gmail dot com)
+# Distributed under the MIT/X11 software license, see the accompanying
+# file license.txt or http://www.opensource.org/licenses/mit-license.php.
+# ---------------------------------------------------------------------------
+
+# ---------------------------------------------------------------------------
+#   test_model_identity.py: confirm that authauth_model looks up and adds
+#   users of every user type through the one identity table, and moves the
+#   Google users of a database from before it across.
+# ---------------------------------------------------------------------------
+
+import os
+import sys
+import zmq
+import time
+import json
+import sqlite3
+
+from nose.tools import raises, assert_false, assert_true, assert_not_equal, assert_equal, assert_less
+import unittest
+
+from test_model_basic import ModelTestCase, DATABASE_FILEPATH
+
+# ---------------------------------------------------------------------------
+#   Constants.
+# ---------------------------------------------------------------------------
+# How a database from before the identity table stored its Google users.
+OLD_STATEMENTS = [ \
+    """CREATE TABLE role (role_id TEXT PRIMARY KEY, role_name TEXT NOT NULL, privileges TEXT);""",
+    """CREATE TABLE user (user_id TEXT PRIMARY KEY, role_id TEXT NOT NULL);""",
+    """CREATE TABLE auth_google (email TEXT PRIMARY KEY, user_id TEXT UNIQUE NOT NULL, first_name TEXT, last_name TEXT, name TEXT, locale TEXT);""",
+    """CREATE INDEX user_id_on_auth_google on auth_google(user_id);""",
+]
+# ---------------------------------------------------------------------------
+
+class TestIdentity(ModelTestCase):
+    def _query(self, statement, args = ()):
+        connection = sqlite3.connect(DATABASE_FILEPATH)
+        try:
+            return connection.execute(statement, args).fetchall()
+        finally:
+            connection.close()
+
+    def test_001_add_then_get_user_of_each_type(self):
+        """ Every user type can be added and then got."""
+        identities = [("google", "email", "user@host.com"),
+                      ("browserid", "email", "user@host.com"),
+                      ("twitter", "username", "user"),
+                      ("facebook", "facebook_id", "12345"),
+                      ("api", "api_secret_key", "secret")]
+        user_ids = []
+        for (user_type, field, external_id) in identities:
+            reply_decoded = self._get_user(user_type, **{field: external_id})
+            assert_equal(reply_decoded["user_id"], None)
+            reply_decoded = self._add_user(user_type, **{field: external_id})
+            assert_equal(reply_decoded["status"], "ok")
+            user_ids.append(reply_decoded["user_id"])
+        for ((user_type, field, external_id), user_id) in zip(identities, user_ids):
+            reply_decoded = self._get_user(user_type, **{field: external_id})
+            assert_equal(reply_decoded["user_id"], user_id)
+
+        # The same email with Google and with BrowserID is two users.
+        assert_equal(len(set(user_ids)), len(identities))
+        rows = self._query("SELECT COUNT(*) FROM user WHERE role_id = 'regular'")
+        assert_equal(rows, [(len(identities), )])
+
+    def test_002_profiles_go_in_side_tables(self):
+        """ Profile fields an add_user carries are stored for its provider."""
+        self._add_user("twitter", username = "user", profile_image_url = "http://host.com/user.png")
+        rows = self._query("SELECT username, profile_image_url FROM auth_twitter")
+        assert_equal(rows, [(u"user", u"http://host.com/user.png")])
+
+    def test_003_bulk_users_of_mixed_types(self):
+        """ get_users and add_users take any mix of user types."""
+        users = [["google", "user@host.com"], ["twitter", "user"], ["api", "secret"]]
+        user_ids = self._add_users(users)["user_ids"]
+        reply_decoded = self._get_users(users + [["facebook", "12345"]])
+        assert_equal(reply_decoded["user_ids"], user_ids + [None])
+
+    def test_004_old_database_is_migrated(self):
+        """ Google users from before the identity table can still log in."""
+        self.send_message("ping", {})
+        self.get_message()
+        self.process.kill()
+        self.process.wait()
+
+        os.remove(DATABASE_FILEPATH)
+        connection = sqlite3.connect(DATABASE_FILEPATH)
+        for statement in OLD_STATEMENTS:
+            connection.execute(statement)
+        connection.execute("INSERT INTO auth_google (email, user_id, first_name) VALUES (?, ?, ?)", ("old@host.com", "old_user_id", "Old"))
+        connection.commit()
+        connection.close()
+
+        process_cmd = self.process_cmd.replace(" --empty_database", "")
+        self.process = self._execute_command(process_cmd)
+        reply_decoded = self._get_user("google", email = "old@host.com")
+        assert_equal(reply_decoded["user_id"], "old_user_id")
+        rows = self._query("SELECT email, first_name FROM auth_google")
+        assert_equal(rows, [(u"old@host.com", u"Old")])
+        rows = self._query("SELECT user_id, role_id FROM user")
+        assert_equal(rows, [(u"old_user_id", u"regular")])
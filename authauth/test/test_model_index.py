@@ -0,0 +1,132 @@
+#!/usr/bin/env python2.7
+
+# ---------------------------------------------------------------------------
+# Copyright (c) 2012 Asim Ihsan (asim dot ihsan at gmail dot com)
+# Distributed under the MIT/X11 software license, see the accompanying
+# file license.txt or http://www.opensource.org/licenses/mit-license.php.
+# ---------------------------------------------------------------------------
+
+# ---------------------------------------------------------------------------
+#   test_model_index.py: confirm that authauth_model_build_index.py indexes
+#   every identity, that the index finds each of them and nothing else, and
+#   that authauth_model with --index_filepath answers from it, falling back
+#   on the database for users added since.
+# ---------------------------------------------------------------------------
+
+import os
+import sys
+import subprocess
+import tempfile
+import time
+import json
+
+from nose.tools import raises, assert_false, assert_true, assert_not_equal, assert_equal, assert_less
+import unittest
+
+from test_model_basic import ModelTestCase, code_filepath
+
+sys.path.insert(0, code_filepath)
+import authauth_model_database
+from authauth_model_index import IdentityIndex, IndexFormatException
+
+# ---------------------------------------------------------------------------
+#   Constants.
+# ---------------------------------------------------------------------------
+build_index_under_test = os.path.join(code_filepath, "authauth_model_build_index.py")
+assert(os.path.isfile(build_index_under_test))
+INDEXED_DATABASE_FILEPATH = os.path.join(tempfile.gettempdir(), "test_model_index.db")
+INDEX_FILEPATH = os.path.join(tempfile.gettempdir(), "test_model_index.idx")
+NUMBER_OF_USERS = 100
+# ---------------------------------------------------------------------------
+
+def remove_index_files():
+    for filepath in [INDEXED_DATABASE_FILEPATH, INDEX_FILEPATH]:
+        if os.path.isfile(filepath):
+            os.remove(filepath)
+
+def build_index(compact_user_ids = False):
+    """ Index a database of users of every type. Returns the identities
+    and their user IDs."""
+    database = authauth_model_database.Database(INDEXED_DATABASE_FILEPATH,
+                                                empty_database = True,
+                                                compact_user_ids = compact_user_ids)
+    try:
+        identities = [("google", u"user%s@host.com" % (i, )) for i in xrange(NUMBER_OF_USERS)]
+        identities += [("twitter", u"user%s" % (i, )) for i in xrange(NUMBER_OF_USERS)]
+        identities.append(("facebook", u"1234"))
+        user_ids = database.add_users(identities)
+    finally:
+        database.close()
+    devnull = open(os.devnull, "rb+")
+    assert_equal(subprocess.call([build_index_under_test,
+                                  "--database_filepath", INDEXED_DATABASE_FILEPATH,
+                                  "--index_filepath", INDEX_FILEPATH],
+                                 stdout = devnull,
+                                 stderr = devnull), 0)
+    return (identities, user_ids)
+
+class TestIdentityIndex(unittest.TestCase):
+    def setUp(self):
+        remove_index_files()
+
+    def tearDown(self):
+        remove_index_files()
+
+    def _check_index(self, compact_user_ids):
+        (identities, user_ids) = build_index(compact_user_ids)
+        index = IdentityIndex(INDEX_FILEPATH)
+        database = authauth_model_database.Database(INDEXED_DATABASE_FILEPATH)
+        try:
+            assert_equal(index.records, len(identities))
+            for ((provider, external_id), user_id) in zip(identities, user_ids):
+                assert_equal(database.user_id_from_bytes(index.get(provider, external_id)), user_id)
+            assert_equal(index.get("google", "stranger@host.com"), None)
+            assert_equal(index.get("twitter", "user0@host.com"), None)
+            assert_equal(index.hits, len(identities))
+        finally:
+            database.close()
+            index.close()
+
+    def test_001_finds_every_identity(self):
+        """ Every identity is found, with its user_id, and nothing else."""
+        self._check_index(False)
+
+    def test_002_finds_every_compact_identity(self):
+        """ As above, with user IDs stored as bytes."""
+        self._check_index(True)
+
+    @raises(IndexFormatException)
+    def test_003_rejects_truncated_index(self):
+        """ An index that's been cut short is refused."""
+        build_index()
+        with open(INDEX_FILEPATH, "rb+") as f:
+            f.truncate(os.path.getsize(INDEX_FILEPATH) - 1)
+        IdentityIndex(INDEX_FILEPATH)
+
+class TestIndexedModel(ModelTestCase):
+    server_args = " --index_filepath %s" % (INDEX_FILEPATH, )
+
+    def setUp(self):
+        remove_index_files()
+        (self.identities, self.user_ids) = build_index()
+        super(TestIndexedModel, self).setUp()
+
+    def tearDown(self):
+        super(TestIndexedModel, self).tearDown()
+        remove_index_files()
+
+    def test_001_lookups_from_index(self):
+        """ Indexed users are found, though the database is empty, and
+        users added since are found in the database."""
+        assert_equal(self._get_user("google", email = "user0@host.com")["user_id"], self.user_ids[0])
+        reply_decoded = self._get_users([list(identity) for identity in self.identities])
+        assert_equal(reply_decoded["user_ids"], self.user_ids)
+
+        user_id = self._add_user("google", email = "new@host.com")["user_id"]
+        assert_equal(self._get_user("google", email = "new@host.com")["user_id"], user_id)
+        assert_equal(self._get_user("google", email = "stranger@host.com")["user_id"], None)
+
+        self.send_message("stats", {})
+        stats = json.loads(self.get_message())
+        assert_equal(stats["identity_index"]["records"], len(self.identities))
+        assert_equal(stats["identity_index"]["hits"], len(self.identities) + 1)
@@ -0,0 +1,126 @@
+#!/usr/bin/env python2.7
+
+# ---------------------------------------------------------------------------
+# Copyright (c) 2012 Asim Ihsan (asim dot ihsan at gmail dot com)
+# Distributed under the MIT/X11 software license, see the accompanying
+# file license.txt or http://www.opensource.org/licenses/mit-license.php.
+# ---------------------------------------------------------------------------
+
+# ---------------------------------------------------------------------------
+#   test_model_replica.py: confirm that an authauth_model run with
+#   --replica_of serves the users added to a primary publishing snapshots
+#   with --snapshot_filepath, reports how stale it is, refuses to add users,
+#   and with --max_staleness refuses lookups once its snapshot is too old.
+# ---------------------------------------------------------------------------
+
+import os
+import sys
+import zmq
+import subprocess
+import tempfile
+import time
+import json
+
+from nose.tools import raises, assert_false, assert_true, assert_not_equal, assert_equal, assert_less
+import unittest
+
+from test_model_basic import ModelTestCase, TimeoutException, script_under_test
+
+# ---------------------------------------------------------------------------
+#   Constants.
+# ---------------------------------------------------------------------------
+SNAPSHOT_FILEPATH = os.path.join(tempfile.gettempdir(), "test_model_replica.db")
+REPLICA_SERVER_ZEROMQ_BINDING = "tcp://*:5557"
+REPLICA_CLIENT_ZEROMQ_BINDING = "tcp://localhost:5557"
+SNAPSHOT_INTERVAL = 0.2
+MAX_STALENESS = 3
+# ---------------------------------------------------------------------------
+
+def remove_snapshot_files():
+    for suffix in ["", "-journal"]:
+        if os.path.isfile(SNAPSHOT_FILEPATH + suffix):
+            os.remove(SNAPSHOT_FILEPATH + suffix)
+
+class ReplicaTestCase(ModelTestCase):
+    """ Launches a replica of the usual server, once it has published its
+    first snapshot, and connects self.replica to it."""
+    server_args = " --pool_size 10 --snapshot_filepath %s --snapshot_interval %s" % (SNAPSHOT_FILEPATH, SNAPSHOT_INTERVAL)
+    replica_args = ""
+
+    def setUp(self):
+        remove_snapshot_files()
+        super(ReplicaTestCase, self).setUp()
+        start_time = time.time()
+        while not os.path.isfile(SNAPSHOT_FILEPATH):
+            assert_less(time.time() - start_time, 5.0)
+            time.sleep(0.1)
+        replica_cmd = " exec %s --zeromq_binding %s --replica_of %s --snapshot_interval %s --pool_size 10" % \
+            (script_under_test, REPLICA_SERVER_ZEROMQ_BINDING, SNAPSHOT_FILEPATH, SNAPSHOT_INTERVAL)
+        self.replica_process = self._execute_command(replica_cmd + self.replica_args)
+        self.replica = self.context.socket(zmq.REQ)
+        self.replica.connect(REPLICA_CLIENT_ZEROMQ_BINDING)
+
+    def tearDown(self):
+        self.replica_process.kill()
+        self.replica_process.wait()
+        self.replica.close(linger = 0)
+        super(ReplicaTestCase, self).tearDown()
+        remove_snapshot_files()
+
+    def _ask_replica(self, message_type, message_args):
+        message = self._create_basic_message()
+        message["message_type"] = message_type
+        message.update(message_args)
+        self.replica.send(json.dumps(message))
+        if not self.replica.poll(3000):
+            raise TimeoutException
+        reply_decoded = json.loads(self.replica.recv())
+        assert_equal(reply_decoded["message_type"], "%s_response" % (message_type, ))
+        return reply_decoded
+
+class TestReplica(ReplicaTestCase):
+    def test_001_replica_serves_users_added_to_primary(self):
+        """ Users added to the primary are soon found on the replica."""
+        reply_decoded = self._ask_replica("get_user", {"user_type": "google", "email": "user@host.com"})
+        assert_equal(reply_decoded["user_id"], None)
+        user_id = self._add_user("google", email = "user@host.com")["user_id"]
+        start_time = time.time()
+        while True:
+            reply_decoded = self._ask_replica("get_user", {"user_type": "google", "email": "user@host.com"})
+            if reply_decoded["user_id"] is not None:
+                break
+            assert_less(time.time() - start_time, 5.0)
+            time.sleep(SNAPSHOT_INTERVAL)
+        assert_equal(reply_decoded["status"], "ok")
+        assert_equal(reply_decoded["user_id"], user_id)
+        assert_less(reply_decoded["staleness"], MAX_STALENESS)
+
+        reply_decoded = self._ask_replica("get_users", {"users": [["google", "user@host.com"], ["google", "stranger@host.com"]]})
+        assert_equal(reply_decoded["user_ids"], [user_id, None])
+        stats = self._ask_replica("stats", {})
+        assert_true(stats["replica"]["loads"] >= 2)
+        assert_less(stats["replica"]["staleness"], MAX_STALENESS)
+
+    def test_002_replica_refuses_writes(self):
+        """ Adding users to the replica fails, and they aren't added."""
+        reply_decoded = self._ask_replica("add_user", {"user_type": "google", "email": "user@host.com"})
+        assert_equal(reply_decoded["status"], "error")
+        assert_true("read-only" in reply_decoded["reason"])
+        reply_decoded = self._ask_replica("add_users", {"users": [["google", "user@host.com"]]})
+        assert_equal(reply_decoded["status"], "error")
+        assert_equal(self._get_user("google", email = "user@host.com")["user_id"], None)
+
+class TestStaleReplica(ReplicaTestCase):
+    # The primary publishes once, at startup, and then not again for the
+    # length of the test.
+    server_args = " --pool_size 10 --snapshot_filepath %s --snapshot_interval 60" % (SNAPSHOT_FILEPATH, )
+    replica_args = " --max_staleness %s" % (MAX_STALENESS, )
+
+    def test_001_stale_replica_refuses_lookups(self):
+        """ Lookups fail once the snapshot is older than --max_staleness."""
+        reply_decoded = self._ask_replica("get_user", {"user_type": "google", "email": "user@host.com"})
+        assert_equal(reply_decoded["status"], "ok")
+        time.sleep(MAX_STALENESS + 0.5)
+        reply_decoded = self._ask_replica("get_user", {"user_type": "google", "email": "user@host.com"})
+        assert_equal(reply_decoded["status"], "error")
+        assert_true("seconds old" in reply_decoded["reason"])
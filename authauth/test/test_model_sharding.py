@@ -0,0 +1,274 @@
+#!/usr/bin/env python2.7
+
+# ---------------------------------------------------------------------------
+# Copyright (c) 2012 Asim Ihsan (asim dot ihsan at gmail dot com)
+# Distributed under the MIT/X11 software license, see the accompanying
+# file license.txt or http://www.opensource.org/licenses/mit-license.php.
+# ---------------------------------------------------------------------------
+
+# ---------------------------------------------------------------------------
+#   test_model_sharding.py: confirm that the hash ring spreads identities
+#   evenly and moves few of them when a shard is added, that authauth_model
+#   with --shard keeps each user on the shard that owns them, locally or on
+#   another node, and that authauth_model_rebalance moves users onto a new
+#   shard.
+# ---------------------------------------------------------------------------
+
+import os
+import sys
+import zmq
+import subprocess
+import tempfile
+import time
+import json
+import sqlite3
+
+from nose.tools import raises, assert_false, assert_true, assert_not_equal, assert_equal, assert_less
+import unittest
+
+from test_model_basic import ModelTestCase, CMD_TEMPLATE, DATABASE_FILEPATH, script_under_test, code_filepath
+
+sys.path.insert(0, code_filepath)
+from authauth_model_hash_ring import HashRing
+from authauth_model_sharding import RemoteDatabase, RemoteShardException
+
+# ---------------------------------------------------------------------------
+#   Constants.
+# ---------------------------------------------------------------------------
+rebalance_under_test = os.path.join(code_filepath, "authauth_model_rebalance.py")
+assert(os.path.isfile(rebalance_under_test))
+REMOTE_SERVER_ZEROMQ_BINDING = "tcp://*:5557"
+REMOTE_CLIENT_ZEROMQ_BINDING = "tcp://localhost:5557"
+NUMBER_OF_KEYS = 10000
+NUMBER_OF_USERS = 30
+# ---------------------------------------------------------------------------
+
+def get_shard_filepath(name):
+    return os.path.join(tempfile.gettempdir(), "test_model_sharding_%s.db" % (name, ))
+
+def remove_shard_files(names):
+    for name in names:
+        for suffix in ["", "-wal", "-shm"]:
+            if os.path.isfile(get_shard_filepath(name) + suffix):
+                os.remove(get_shard_filepath(name) + suffix)
+
+def get_shard_identities(name):
+    connection = sqlite3.connect(get_shard_filepath(name))
+    try:
+        return set(connection.execute("SELECT provider, external_id FROM identity").fetchall())
+    finally:
+        connection.close()
+
+def get_shard_args(names):
+    return "".join(" --shard %s=%s" % (name, get_shard_filepath(name)) for name in names)
+
+class TestHashRing(unittest.TestCase):
+    def test_001_keys_are_spread_evenly(self):
+        """ Every shard gets a fair share of keys, the same ones each time."""
+        ring = HashRing(["a", "b", "c", "d"])
+        counts = {}
+        for i in xrange(NUMBER_OF_KEYS):
+            name = ring.get_identity_name("google", "user%s@host.com" % (i, ))
+            counts[name] = counts.get(name, 0) + 1
+        assert_equal(sorted(counts), ["a", "b", "c", "d"])
+        for count in counts.itervalues():
+            assert_less(NUMBER_OF_KEYS * 0.15, count)
+            assert_less(count, NUMBER_OF_KEYS * 0.35)
+        assert_equal(HashRing(["d", "c", "b", "a"]).get_identity_name("google", "user0@host.com"),
+                     ring.get_identity_name("google", "user0@host.com"))
+
+    def test_002_adding_a_shard_moves_few_keys(self):
+        """ Only keys the new shard takes over move."""
+        old_ring = HashRing(["a", "b", "c", "d"])
+        new_ring = HashRing(["a", "b", "c", "d", "e"])
+        moved = 0
+        for i in xrange(NUMBER_OF_KEYS):
+            old_name = old_ring.get_identity_name("google", "user%s@host.com" % (i, ))
+            new_name = new_ring.get_identity_name("google", "user%s@host.com" % (i, ))
+            if old_name != new_name:
+                assert_equal(new_name, "e")
+                moved += 1
+        assert_less(moved, NUMBER_OF_KEYS * 0.3)
+
+class TestRemoteDatabase(unittest.TestCase):
+    def test_001_error_replies_raise(self):
+        """ A remote shard's error reply raises RemoteShardException with
+        its reason, rather than KeyError."""
+        database = RemoteDatabase(REMOTE_CLIENT_ZEROMQ_BINDING, {"google": "email"})
+        database.request = lambda message_type, message_args: {"status": "error", "reason": "database busy"}
+        for (method, args) in [(database.get_user_id, ("google", "user@host.com")),
+                               (database.get_user_ids, ([("google", "user@host.com")], ))]:
+            try:
+                method(*args)
+            except RemoteShardException as e:
+                assert_true("database busy" in str(e))
+            else:
+                assert(False)
+
+class TestSharding(ModelTestCase):
+    shard_names = ["a", "b"]
+
+    def setUp(self):
+        remove_shard_files(["a", "b", "c"])
+        super(TestSharding, self).setUp()
+
+    def tearDown(self):
+        super(TestSharding, self).tearDown()
+        remove_shard_files(["a", "b", "c"])
+
+    def _execute_command(self, command, capture_output = False):
+        command = command.replace(" --database_filepath %s" % (DATABASE_FILEPATH, ), get_shard_args(self.shard_names))
+        return super(TestSharding, self)._execute_command(command, capture_output)
+
+    def test_001_users_live_on_their_shard(self):
+        """ Each user is added to, and got from, the shard that owns them."""
+        emails = ["user%s@host.com" % (i, ) for i in xrange(NUMBER_OF_USERS)]
+        user_ids = [self._add_user("google", email = email)["user_id"] for email in emails]
+        for (email, user_id) in zip(emails, user_ids):
+            assert_equal(self._get_user("google", email = email)["user_id"], user_id)
+        reply_decoded = self._get_users([["google", email] for email in emails] + [["google", "stranger@host.com"]])
+        assert_equal(reply_decoded["user_ids"], user_ids + [None])
+
+        ring = HashRing(self.shard_names)
+        for name in self.shard_names:
+            expected = set((u"google", unicode(email)) for email in emails
+                           if ring.get_identity_name("google", email) == name)
+            assert_true(len(expected) > 0)
+            assert_equal(get_shard_identities(name), expected)
+
+    def test_002_bulk_add_across_shards(self):
+        """ add_users splits its users between the shards."""
+        users = [["google", "user%s@host.com" % (i, )] for i in xrange(NUMBER_OF_USERS)]
+        user_ids = self._add_users(users)["user_ids"]
+        assert_equal(self._get_users(users)["user_ids"], user_ids)
+        assert_equal(sum(len(get_shard_identities(name)) for name in self.shard_names), NUMBER_OF_USERS)
+
+    def test_003_rebalance_onto_new_shard(self):
+        """ After adding a shard and rebalancing every user is still found,
+        and every list's ACL still applies."""
+        emails = ["user%s@host.com" % (i, ) for i in xrange(NUMBER_OF_USERS)]
+        user_ids = [self._add_user("google", email = email, first_name = "First")["user_id"] for email in emails]
+        list_ids = ["list%s" % (i, ) for i in xrange(NUMBER_OF_USERS)]
+        for (list_id, user_id) in zip(list_ids, user_ids):
+            self.send_message("set_list_access", {"list_id": list_id, "user_id": user_id, "actions": ["read"]})
+            assert_equal(json.loads(self.get_message())["status"], "ok")
+        self.process.kill()
+        self.process.wait()
+
+        self.shard_names = ["a", "b", "c"]
+        command = [rebalance_under_test] + get_shard_args(self.shard_names).split()
+        devnull = open(os.devnull, "rb+")
+        assert_equal(subprocess.call(command, stdout = devnull, stderr = devnull), 0)
+        assert_true(len(get_shard_identities("c")) > 0)
+        assert_equal(sum(len(get_shard_identities(name)) for name in self.shard_names), NUMBER_OF_USERS)
+
+        process_cmd = self.process_cmd.replace(" --empty_database", "")
+        self.process = self._execute_command(process_cmd)
+        for (email, user_id) in zip(emails, user_ids):
+            assert_equal(self._get_user("google", email = email)["user_id"], user_id)
+
+        ring = HashRing(self.shard_names)
+        connection = sqlite3.connect(get_shard_filepath("c"))
+        try:
+            moved_list_ids = set(row[0] for row in connection.execute("SELECT list_id FROM list_acl"))
+        finally:
+            connection.close()
+        assert_true(len(moved_list_ids) > 0)
+        assert_equal(moved_list_ids, set(list_id for list_id in list_ids if ring.get_list_name(list_id) == "c"))
+        self.send_message("check_access", {"checks": [[user_id, list_id, "read"] for (list_id, user_id) in zip(list_ids, user_ids)]})
+        assert_equal(json.loads(self.get_message())["allowed"], [True] * NUMBER_OF_USERS)
+
+class TestRemoteSharding(ModelTestCase):
+    server_args = " --pool_size 10"
+
+    def setUp(self):
+        remove_shard_files(["a", "b"])
+        devnull = open(os.devnull, "rb+")
+        remote_cmd = CMD_TEMPLATE.substitute(executable = script_under_test,
+                                             zeromq_binding = REMOTE_SERVER_ZEROMQ_BINDING,
+                                             database_filepath = get_shard_filepath("b"))
+        self.remote_process = subprocess.Popen(remote_cmd,
+                                               shell = True,
+                                               stdin = devnull,
+                                               stdout = devnull)
+        super(TestRemoteSharding, self).setUp()
+
+    def tearDown(self):
+        super(TestRemoteSharding, self).tearDown()
+        self.remote_process.kill()
+        self.remote_process.wait()
+        remove_shard_files(["a", "b"])
+
+    def _execute_command(self, command, capture_output = False):
+        shard_args = " --shard a=%s --shard b=%s" % (get_shard_filepath("a"), REMOTE_CLIENT_ZEROMQ_BINDING)
+        command = command.replace(" --database_filepath %s" % (DATABASE_FILEPATH, ), shard_args)
+        return super(TestRemoteSharding, self)._execute_command(command, capture_output)
+
+    def test_001_remote_shard(self):
+        """ Users owned by a remote shard are added to and got from it."""
+        emails = ["user%s@host.com" % (i, ) for i in xrange(NUMBER_OF_USERS)]
+        user_ids = [self._add_user("google", email = email)["user_id"] for email in emails]
+        for (email, user_id) in zip(emails, user_ids):
+            assert_equal(self._get_user("google", email = email)["user_id"], user_id)
+        reply_decoded = self._get_users([["google", email] for email in emails])
+        assert_equal(reply_decoded["user_ids"], user_ids)
+
+        ring = HashRing(["a", "b"])
+        expected = set((u"google", unicode(email)) for email in emails
+                       if ring.get_identity_name("google", email) == "b")
+        assert_true(len(expected) > 0)
+        assert_equal(get_shard_identities("b"), expected)
+
+    def test_002_authorize_across_shards(self):
+        """ Roles are set on every shard, and a user is authorized by
+        whichever shard has them."""
+        emails = ["user%s@host.com" % (i, ) for i in xrange(NUMBER_OF_USERS)]
+        user_ids = [self._add_user("google", email = email)["user_id"] for email in emails]
+        self.send_message("set_role", {"role_id": "editor", "privileges": ["write"]})
+        assert_equal(json.loads(self.get_message())["status"], "ok")
+        for user_id in user_ids:
+            self.send_message("authorize", {"user_id": user_id, "privilege": "write"})
+            assert_false(json.loads(self.get_message())["authorized"])
+            self.send_message("set_user_role", {"user_id": user_id, "role_id": "editor"})
+            assert_equal(json.loads(self.get_message())["status"], "ok")
+            self.send_message("authorize", {"user_id": user_id, "privilege": "write"})
+            assert_true(json.loads(self.get_message())["authorized"])
+
+    def test_003_check_access_across_shards(self):
+        """ Each list's ACL is kept on, and checked by, the shard that owns
+        the list."""
+        user_id = self._add_user("google", email = "user@host.com")["user_id"]
+        list_ids = ["list%s" % (i, ) for i in xrange(NUMBER_OF_USERS)]
+        for list_id in list_ids[::2]:
+            self.send_message("set_list_access", {"list_id": list_id, "user_id": user_id, "actions": ["read"]})
+            assert_equal(json.loads(self.get_message())["status"], "ok")
+        self.send_message("check_access", {"checks": [[user_id, list_id, "read"] for list_id in list_ids]})
+        assert_equal(json.loads(self.get_message())["allowed"], [i % 2 == 0 for i in xrange(NUMBER_OF_USERS)])
+
+        ring = HashRing(["a", "b"])
+        connection = sqlite3.connect(get_shard_filepath("b"))
+        try:
+            remote_list_ids = set(row[0] for row in connection.execute("SELECT list_id FROM list_acl"))
+        finally:
+            connection.close()
+        expected = set(list_id for list_id in list_ids[::2] if ring.get_list_name(list_id) == "b")
+        assert_true(len(expected) > 0)
+        assert_equal(remote_list_ids, expected)
+
+    def test_004_bulk_add_with_profiles(self):
+        """ Profiles given to add_users reach the remote shard too."""
+        users = [["google", "user%s@host.com" % (i, )] for i in xrange(NUMBER_OF_USERS)]
+        profiles = [{"first_name": "First%s" % (i, )} for i in xrange(NUMBER_OF_USERS)]
+        self.send_message("add_users", {"users": users, "profiles": profiles})
+        assert_equal(json.loads(self.get_message())["status"], "ok")
+
+        ring = HashRing(["a", "b"])
+        expected = set((u"user%s@host.com" % (i, ), u"First%s" % (i, )) for i in xrange(NUMBER_OF_USERS)
+                       if ring.get_identity_name("google", "user%s@host.com" % (i, )) == "b")
+        connection = sqlite3.connect(get_shard_filepath("b"))
+        try:
+            remote_profiles = set(connection.execute("SELECT email, first_name FROM auth_google"))
+        finally:
+            connection.close()
+        assert_true(len(expected) > 0)
+        assert_equal(remote_profiles, expected)
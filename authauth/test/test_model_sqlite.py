@@ -0,0 +1,74 @@
+#!/usr/bin/env python2.7
+
+# ---------------------------------------------------------------------------
+# Copyright (c) 2012 Asim Ihsan (asim dot ihsan at gmail dot com)
+# Distributed under the MIT/X11 software license, see the accompanying
+# file license.txt or http://www.opensource.org/licenses/mit-license.php.
+# ---------------------------------------------------------------------------
+
+# ---------------------------------------------------------------------------
+#   test_model_sqlite.py: confirm that authauth_model takes the SQLite
+#   settings it's given on the command line, and checkpoints the
+#   write-ahead log in the background.
+# ---------------------------------------------------------------------------
+
+import os
+import sys
+import zmq
+import time
+import json
+
+from nose.tools import raises, assert_false, assert_true, assert_not_equal, assert_equal, assert_less
+import unittest
+
+from test_model_basic import ModelTestCase, DATABASE_FILEPATH
+
+# ---------------------------------------------------------------------------
+#   Constants.
+# ---------------------------------------------------------------------------
+CHECKPOINT_INTERVAL = 0.2
+CHECKPOINT_STATEMENT = "PRAGMA wal_checkpoint(PASSIVE);"
+
+# Bytes 18 and 19 of an SQLite database file are 2 in WAL mode, 1 otherwise.
+WAL_HEADER_OFFSET = 18
+# ---------------------------------------------------------------------------
+
+class TestSQLite(ModelTestCase):
+    server_args = " --journal_mode WAL --synchronous NORMAL --mmap_size 1048576 --page_cache_size -4000 --busy_timeout 1000 --checkpoint_interval %s" % (CHECKPOINT_INTERVAL, )
+
+    def tearDown(self):
+        super(TestSQLite, self).tearDown()
+        for suffix in ["-wal", "-shm"]:
+            if os.path.isfile(DATABASE_FILEPATH + suffix):
+                os.remove(DATABASE_FILEPATH + suffix)
+
+    def _get_stats(self):
+        self.send_message("stats", {})
+        return json.loads(self.get_message())
+
+    def test_001_add_then_get_users(self):
+        """ Users can be added and got in WAL mode."""
+        user_ids = []
+        for i in xrange(10):
+            reply_decoded = self._add_user("google", email = "user%s@host.com" % (i, ))
+            assert_equal(reply_decoded["status"], "ok")
+            user_ids.append(reply_decoded["user_id"])
+        for i in xrange(10):
+            reply_decoded = self._get_user("google", email = "user%s@host.com" % (i, ))
+            assert_equal(reply_decoded["user_id"], user_ids[i])
+
+    def test_002_database_is_in_wal_mode(self):
+        """ The database file says it's in WAL mode."""
+        self._add_user("google", email = "user@host.com")
+        with open(DATABASE_FILEPATH, "rb") as f:
+            f.seek(WAL_HEADER_OFFSET)
+            assert_equal(f.read(2), "\x02\x02")
+        assert_true(os.path.isfile(DATABASE_FILEPATH + "-wal"))
+
+    def test_003_checkpoints_in_background(self):
+        """ The write-ahead log is checkpointed without being asked."""
+        self._add_user("google", email = "user@host.com")
+        time.sleep(CHECKPOINT_INTERVAL * 3)
+        stats = self._get_stats()
+        assert_true(CHECKPOINT_STATEMENT in stats["statements"])
+        assert_less(0, stats["statements"][CHECKPOINT_STATEMENT]["count"])
@@ -0,0 +1,50 @@
+#!/usr/bin/env python2.7
+
+# ---------------------------------------------------------------------------
+# Copyright (c) 2012 Asim Ihsan (asim dot ihsan at gmail dot com)
+# Distributed under the MIT/X11 software license, see the accompanying
+# file license.txt or http://www.opensource.org/licenses/mit-license.php.
+# ---------------------------------------------------------------------------
+
+# ---------------------------------------------------------------------------
+#   test_model_workers.py: run the concurrency tests again with authauth_model
+#   forking several worker processes behind its queue device. Writes made
+#   through one worker must be visible to reads served by the others.
+# ---------------------------------------------------------------------------
+
+import os
+import sys
+import time
+
+from nose.tools import raises, assert_false, assert_true, assert_not_equal, assert_equal, assert_less
+from nose.plugins.skip import SkipTest
+import unittest
+
+import test_model_concurrent
+
+# ---------------------------------------------------------------------------
+#   Constants.
+# ---------------------------------------------------------------------------
+NUMBER_OF_WORKERS = 3
+# ---------------------------------------------------------------------------
+
+class TestWorkers(test_model_concurrent.TestConcurrent):
+    server_args = " --workers %s --pool_size %s" % (NUMBER_OF_WORKERS,
+                                                    test_model_concurrent.POOL_SIZE)
+
+    def test_003_forks_workers(self):
+        """ The device process forks the requested number of workers."""
+        if not os.path.isdir("/proc"):
+            raise SkipTest("needs /proc to find child processes")
+        time.sleep(1)
+        assert_equal(self.process.poll(), None)
+        worker_pids = [pid for pid in os.listdir("/proc")
+                       if pid.isdigit() and self._read_ppid(pid) == self.process.pid]
+        assert_equal(len(worker_pids), NUMBER_OF_WORKERS)
+
+    def _read_ppid(self, pid):
+        try:
+            with open(os.path.join("/proc", pid, "stat")) as f:
+                return int(f.read().rsplit(")", 1)[1].split()[1])
+        except (IOError, IndexError, ValueError):
+            return None
@@ -0,0 +1,222 @@
+#!/usr/bin/env python2.7
+
+# ---------------------------------------------------------------------------
+# Copyright (c) 2012 Asim Ihsan (asim dot ihsan at gmail dot com)
+# Distributed under the MIT/X11 software license, see the accompanying
+# file license.txt or http://www.opensource.org/licenses/mit-license.php.
+# ---------------------------------------------------------------------------
+
+# ---------------------------------------------------------------------------
+#   test_view_model_client.py: check that the view's asynchronous
+#   authauth_model client talks to a real authauth_model from a tornado
+#   IOLoop, shares its socket pool between concurrent requests, gives up
+#   cleanly when nobody answers, and routes requests between shards.
+# ---------------------------------------------------------------------------
+
+import os
+import sys
+import subprocess
+import tempfile
+import time
+
+from nose.tools import raises, assert_false, assert_true, assert_not_equal, assert_equal, assert_less
+import unittest
+
+from zmq.eventloop import ioloop
+from tornado import stack_context
+import tornado.testing
+
+from test_model_basic import CMD_TEMPLATE, SERVER_ZEROMQ_BINDING, CLIENT_ZEROMQ_BINDING, DATABASE_FILEPATH, script_under_test, code_filepath
+
+sys.path.insert(0, code_filepath)
+from authauth_view_model_client import ModelClient, ShardedModelClient, ModelUnavailableException
+from authauth_model_hash_ring import HashRing
+
+# ---------------------------------------------------------------------------
+#   Constants.
+# ---------------------------------------------------------------------------
+UNUSED_ZEROMQ_BINDING = "tcp://localhost:5557"
+SECOND_SERVER_ZEROMQ_BINDING = "tcp://*:5557"
+SECOND_DATABASE_FILEPATH = os.path.join(tempfile.gettempdir(), "test_view_model_client.db")
+POOL_SIZE = 2
+NUMBER_OF_REQUESTS = 10
+# ---------------------------------------------------------------------------
+
+class TestModelClient(tornado.testing.AsyncTestCase):
+    def get_new_ioloop(self):
+        return ioloop.IOLoop()
+
+    def setUp(self):
+        super(TestModelClient, self).setUp()
+        devnull = open(os.devnull, "rb+")
+        process_cmd = CMD_TEMPLATE.substitute(executable = script_under_test,
+                                              zeromq_binding = SERVER_ZEROMQ_BINDING,
+                                              database_filepath = DATABASE_FILEPATH)
+        self.process = subprocess.Popen(process_cmd,
+                                        shell = True,
+                                        stdin = devnull,
+                                        stdout = devnull)
+        self.client = ModelClient(CLIENT_ZEROMQ_BINDING,
+                                  pool_size = POOL_SIZE,
+                                  io_loop = self.io_loop)
+
+    def tearDown(self):
+        self.client.close()
+        self.process.kill()
+        time.sleep(0.5)
+        assert_not_equal(self.process.poll(), None)
+        super(TestModelClient, self).tearDown()
+
+    def test_001_ping(self):
+        """ Pings authauth_model from the IOLoop."""
+        self.client.ping(self.stop)
+        assert_true(self.wait())
+
+    def test_002_add_then_get_google_user(self):
+        """ Adds a Google user, then gets its user ID back."""
+        self.client.get_user_id_from_google_email("user@host.com", self.stop)
+        assert_equal(self.wait(), None)
+
+        self.client.add_google_user("user@host.com",
+                                    first_name = "First",
+                                    callback = self.stop)
+        user_id = self.wait()
+        assert_not_equal(user_id, None)
+
+        self.client.get_user_id_from_google_email("user@host.com", self.stop)
+        assert_equal(self.wait(), user_id)
+
+    def test_003_more_requests_than_sockets(self):
+        """ Requests beyond the pool size wait for a socket, then complete."""
+        replies = []
+        def on_reply(user_id):
+            replies.append(user_id)
+            if len(replies) == NUMBER_OF_REQUESTS:
+                self.stop()
+        for i in xrange(NUMBER_OF_REQUESTS):
+            self.client.add_google_user("user%s@host.com" % (i, ), callback = on_reply)
+        self.wait()
+        assert_equal(len(set(replies)), NUMBER_OF_REQUESTS)
+        assert_less(self.client.number_of_streams, POOL_SIZE + 1)
+
+    def test_004_gives_up_when_nobody_answers(self):
+        """ Retries on fresh sockets, then gives up, when nobody answers."""
+        client = ModelClient(UNUSED_ZEROMQ_BINDING,
+                             timeout = 0.1,
+                             attempts = 3,
+                             io_loop = self.io_loop)
+        client.ping(self.stop)
+        try:
+            assert_false(self.wait(timeout = 2))
+        finally:
+            assert_equal(client.number_of_streams, 0)
+            client.close()
+
+    def test_005_sharded_client_routes_by_identity(self):
+        """ Each user is added to, and got from, the shard that owns them."""
+        devnull = open(os.devnull, "rb+")
+        process_cmd = CMD_TEMPLATE.substitute(executable = script_under_test,
+                                              zeromq_binding = SECOND_SERVER_ZEROMQ_BINDING,
+                                              database_filepath = SECOND_DATABASE_FILEPATH)
+        process = subprocess.Popen(process_cmd,
+                                   shell = True,
+                                   stdin = devnull,
+                                   stdout = devnull)
+        shards = [("a", CLIENT_ZEROMQ_BINDING), ("b", UNUSED_ZEROMQ_BINDING)]
+        client = ShardedModelClient(shards, io_loop = self.io_loop)
+        try:
+            client.ping(self.stop)
+            assert_true(self.wait())
+            emails = ["user%s@host.com" % (i, ) for i in xrange(NUMBER_OF_REQUESTS)]
+            user_ids = []
+            for email in emails:
+                client.add_google_user(email, callback = self.stop)
+                user_ids.append(self.wait())
+
+            ring = HashRing(["a", "b"])
+            for (email, user_id) in zip(emails, user_ids):
+                client.get_user_id_from_google_email(email, self.stop)
+                assert_equal(self.wait(), user_id)
+                for (name, shard_client) in client.clients.iteritems():
+                    shard_client.get_user_id_from_google_email(email, self.stop)
+                    if name == ring.get_identity_name("google", email):
+                        assert_equal(self.wait(), user_id)
+                    else:
+                        assert_equal(self.wait(), None)
+        finally:
+            client.close()
+            process.kill()
+            process.wait()
+            if os.path.isfile(SECOND_DATABASE_FILEPATH):
+                os.remove(SECOND_DATABASE_FILEPATH)
+
+    def test_006_get_or_create_google_user(self):
+        """ The first login creates the user, and every other one finds
+        them, however many arrive at once."""
+        replies = []
+        def on_reply(user_id):
+            replies.append(user_id)
+            if len(replies) == NUMBER_OF_REQUESTS:
+                self.stop()
+        for i in xrange(NUMBER_OF_REQUESTS):
+            self.client.get_or_create_google_user("user@host.com",
+                                                  first_name = "First",
+                                                  callback = on_reply)
+        self.wait()
+        assert_equal(len(set(replies)), 1)
+        assert_not_equal(replies[0], None)
+
+        self.client.get_user_id_from_google_email("user@host.com", self.stop)
+        assert_equal(self.wait(), replies[0])
+
+    def test_007_authorize(self):
+        """ A new user's default role holds no privileges."""
+        self.client.add_google_user("user@host.com", callback = self.stop)
+        user_id = self.wait()
+        self.client.authorize(user_id, "read", self.stop)
+        assert_false(self.wait())
+
+    def test_008_check_access(self):
+        """ A batch of checks is answered in order, in one reply."""
+        self.client.add_google_user("user@host.com", callback = self.stop)
+        user_id = self.wait()
+        self.client.check_access([(user_id, "list1", "read"), (user_id, "list2", "read")], self.stop)
+        assert_equal(self.wait(), [False, False])
+
+    def test_009_unavailable_reaches_the_caller(self):
+        """ When nobody answers, the requester, and no one else, gets
+        ModelUnavailableException."""
+        client = ModelClient(UNUSED_ZEROMQ_BINDING,
+                             timeout = 0.1,
+                             attempts = 2,
+                             io_loop = self.io_loop)
+        errors = []
+        def on_error(exc_type, exc_value, exc_traceback):
+            errors.append(exc_value)
+            self.stop()
+            return True
+        with stack_context.ExceptionStackContext(on_error):
+            client.get_user_id_from_google_email("user@host.com", self.stop)
+        try:
+            self.wait(timeout = 2)
+        finally:
+            client.close()
+        assert_equal(len(errors), 1)
+        assert_true(isinstance(errors[0], ModelUnavailableException))
+
+    def test_010_close_closes_busy_streams(self):
+        """ close() closes the streams waiting on replies too, and their
+        requests never time out."""
+        client = ModelClient(UNUSED_ZEROMQ_BINDING,
+                             timeout = 0.1,
+                             pool_size = POOL_SIZE,
+                             io_loop = self.io_loop)
+        streams = []
+        for i in xrange(POOL_SIZE):
+            client.ping(self.stop)
+            streams.extend(client.busy_streams)
+        client.close()
+        assert_equal(client.number_of_streams, 0)
+        assert_true(all(stream.closed() for stream in set(streams)))
+        self.io_loop.add_timeout(time.time() + 0.5, lambda: self.stop("timed out"))
+        assert_equal(self.wait(), "timed out")